@@ -1,108 +1,298 @@
 # Полная реализация системы контроля
 
 import asyncio
-import aiohttp
-import json
+import time
 from typing import Dict, Set, Optional
-from dataclasses import dataclass
 from datetime import datetime, timedelta
 
-@dataclass
-class DeviceInfo:
-    ip: str
-    first_seen: datetime
-    last_seen: datetime
-    fingerprint: str
-    blocked: bool = False
+from common.cluster import ClusterPresence
+from common.device_expiry import IdleExpiry
+from common.device_registry import DeviceRecord, DeviceRegistry
+from common.fingerprint import canonical, fingerprint
+from common.http_client import HTTPClient
+from limits import LimitService
+from common.metrics import (CACHE_HIT_RATIO, CONNECTIONS, ERRORS, QUEUE_DEPTH, REJECTED, USERS_AT_LIMIT,
+                     MetricsServer, hit_ratio, observe_tick, stage_timings)
+from common.notify_outbox import NotificationOutbox, RetryAfter
+from common.routing_rules import RoutingRuleManager
+from state_loader import load_plans, restore_state
+
+XRAY_API_URL = 'http://localhost:10085'
+TELEGRAM_API_URL = 'https://api.telegram.org'
 
 class XRayDeviceController:
-    def __init__(self, xray_config_path: str, bot_token: str):
+    def __init__(self, xray_config_path: str, bot_token: str, db_path: Optional[str] = None,
+                 cluster: Optional[ClusterPresence] = None,
+                 idle_timeouts: Optional[Dict[str, float]] = None,
+                 metrics_port: Optional[int] = None, xray_api_url: str = XRAY_API_URL,
+                 telegram_api_url: str = TELEGRAM_API_URL):
         self.config_path = xray_config_path
         self.bot_token = bot_token
-        self.user_devices: Dict[str, Set[DeviceInfo]] = {}
-        self.user_limits: Dict[str, int] = {}
+        self.xray_api_url = xray_api_url
+        self.telegram_api_url = telegram_api_url
+        self.db_path = db_path
+        # Компактные записи устройств: user_id -> fingerprint -> DeviceRecord
+        self.user_devices = DeviceRegistry()
+        # Лимит тарифа + купленные слоты, в памяти; после покупки - refresh_limit()
+        self.limits = LimitService(db_path)
+        # Лимит (и версия устройств на других узлах), с которыми пользователь проверялся последний раз
+        self.evaluated_limits: Dict[str, tuple] = {}
+        # Кластерный режим: лимит считается по устройствам всех узлов
+        self.cluster = cluster
+        # Устройства, не появлявшиеся дольше таймаута тарифа, освобождают слот
+        self.expiry = IdleExpiry(self.user_devices, plan_timeouts=idle_timeouts)
+        # Один пул соединений на все исходящие запросы
+        self.http = HTTPClient()
+        self.routing = RoutingRuleManager(self.apply_routing_batch)
+        # Уведомления отправляются в фоне, мониторинг их не ждет
+        self.outbox = NotificationOutbox(self.send_telegram_message)
+        # Выставляется, когда устройства и лимиты восстановлены после рестарта
+        self.ready = asyncio.Event()
+        # Время стадий текущего тика и пользователи без свободных слотов
+        self.stage_seconds = stage_timings()
+        self.users_at_limit: Set[str] = set()
+        self.metrics_server = MetricsServer(port=metrics_port) if metrics_port is not None else None
+        self.register_metrics()
+    
+    def register_metrics(self):
+        """Метрики, которые вычисляются при чтении /metrics, а не на горячем пути"""
+        QUEUE_DEPTH.labels('outbox').set_function(lambda: self.outbox.depth)
+        QUEUE_DEPTH.labels('routing').set_function(lambda: self.routing.pending)
+        CACHE_HIT_RATIO.labels('fingerprint').set_function(
+            lambda: hit_ratio(*fingerprint.cache_info()[:2])
+        )
+        USERS_AT_LIMIT.set_function(lambda: len(self.users_at_limit))
         
     async def start_monitoring(self):
         """Запуск системы мониторинга"""
+        await self.restore_state()
+        if self.metrics_server is not None:
+            await self.metrics_server.start()
+        
         tasks = [
             self.monitor_connections(),
             self.cleanup_old_devices(),
             self.sync_with_xray()
         ]
-        await asyncio.gather(*tasks)
+        try:
+            await asyncio.gather(*tasks)
+        finally:
+            await self.close()
+    
+    async def restore_state(self):
+        """Загрузка устройств и лимитов из снимка/БД до начала проверок"""
+        if self.db_path:
+            stats = await asyncio.to_thread(
+                restore_state, self.db_path, self.user_devices, f"{self.db_path}.snapshot"
+            )
+            await self.limits.load()
+            for user_id, plan in (await asyncio.to_thread(load_plans, self.db_path)).items():
+                self.expiry.set_plan(user_id, plan)
+            self.expiry.track_all()
+            print(
+                f"State restored from {stats['source']}: "
+                f"{stats['devices']} devices in {stats['seconds']:.2f}s"
+            )
+        self.ready.set()
+    
+    async def close(self):
+        """Закрытие сетевых соединений и снимок состояния"""
+        if self.metrics_server is not None:
+            await self.metrics_server.close()
+        await self.outbox.close()
+        await self.http.close()
+        if self.cluster is not None:
+            await self.cluster.close()
+        if self.db_path:
+            await asyncio.to_thread(self.user_devices.save_snapshot, f"{self.db_path}.snapshot")
     
     async def monitor_connections(self):
         """Основной цикл мониторинга"""
         while True:
             try:
-                # Парсим логи xRay для получения подключений
-                connections = await self.parse_xray_logs()
-                
-                for user_id, conn_data in connections.items():
-                    await self.process_user_connections(user_id, conn_data)
-                    
+                await self.tick()
             except Exception as e:
+                ERRORS.labels('monitor').inc()
                 print(f"Monitor error: {e}")
                 
             await asyncio.sleep(3)
     
+    async def tick(self):
+        """Один проход мониторинга; время тика и стадий уходит в метрики"""
+        start = time.perf_counter()
+        self.stage_seconds = stages = stage_timings()
+        
+        # Парсим логи xRay для получения подключений
+        connections = await self.parse_xray_logs()
+        t0 = time.perf_counter()
+        stages['read'] += t0 - start
+        CONNECTIONS.inc(sum(len(conn_data) for conn_data in connections.values()))
+        
+        # Устройства пользователей на других узлах - одним запросом, по истечении аренды
+        if self.cluster is not None:
+            await self.cluster.prefetch(connections.keys())
+        
+        for user_id, conn_data in connections.items():
+            # Без изменений с прошлого тика лимит не пересчитываем
+            if self.connections_unchanged(user_id, conn_data):
+                continue
+            await self.process_user_connections(user_id, conn_data)
+        # Отпечатки, блокировки и уведомления внутри проверки учтены в своих стадиях
+        stages['decide'] += (time.perf_counter() - t0
+                             - stages['fingerprint'] - stages['enforce'] - stages['notify'])
+        
+        # Все блокировки тика уходят в xRay одним запросом
+        t0 = time.perf_counter()
+        await self.routing.sync()
+        stages['enforce'] += time.perf_counter() - t0
+        
+        if self.cluster is not None:
+            await self.cluster.flush()
+        
+        observe_tick(time.perf_counter() - start, stages)
+    
+    def evaluation_key(self, user_id: str) -> tuple:
+        limit = self.limits.get(user_id)
+        if self.cluster is None:
+            return (limit, 0)
+        return (limit, self.cluster.version(user_id))
+    
+    def connections_unchanged(self, user_id: str, connections: list) -> bool:
+        """Тот же набор устройств и тот же лимит, что при прошлой проверке"""
+        if self.evaluated_limits.get(user_id) != self.evaluation_key(user_id):
+            return False
+        
+        devices = self.user_devices.devices(user_id)
+        fingerprints = {self.generate_fingerprint(conn) for conn in connections}
+        if len(fingerprints) != len(devices):
+            return False
+        for device in devices:
+            if device.fingerprint not in fingerprints:
+                return False
+        
+        # Устройства те же - обновляем только время активности
+        now = int(time.time())
+        for device in devices:
+            device.touch(now)
+        return True
+    
     async def process_user_connections(self, user_id: str, connections: list):
         """Обработка подключений пользователя"""
-        current_devices = set()
-        
-        for conn in connections:
-            device = DeviceInfo(
-                ip=conn['ip'],
-                first_seen=datetime.now(),
-                last_seen=datetime.now(),
-                fingerprint=self.generate_fingerprint(conn)
-            )
-            current_devices.add(device)
+        current_devices = {}
+        stages = self.stage_seconds
+        
+        t0 = time.perf_counter()
+        fingerprints = [self.generate_fingerprint(conn) for conn in connections]
+        stages['fingerprint'] += time.perf_counter() - t0
+        
+        for conn, device_fingerprint in zip(connections, fingerprints):
+            # Уже известное устройство сохраняет время первого подключения
+            device, created = self.user_devices.upsert(user_id, device_fingerprint, conn['ip'])
+            if created:
+                self.expiry.track(user_id, device)
+            current_devices[device.fingerprint] = device
         
         # Проверяем лимит
-        limit = self.user_limits.get(user_id, 1)
+        limit = self.limits.get(user_id)
+        
+        # Устройства на других узлах тоже занимают слоты
+        remote = self.cluster.remote_devices(user_id) if self.cluster is not None else {}
         
-        if len(current_devices) > limit:
-            # Сортируем по времени подключения
-            sorted_devices = sorted(
-                current_devices, 
-                key=lambda x: x.first_seen
+        if len(current_devices) + len(remote) > limit:
+            # Сортируем по времени подключения; при равенстве - по отпечатку,
+            # чтобы все узлы пришли к одному и тому же решению
+            ranked = sorted(
+                [(device.first_seen, device.fingerprint, device) for device in current_devices.values()]
+                + [(first_seen, fp, None) for fp, (first_seen, _) in remote.items()
+                   if fp not in current_devices],
+                key=lambda x: x[:2]
             )
             
-            # Блокируем лишние
-            for device in sorted_devices[limit:]:
-                await self.block_device(user_id, device)
-                await self.notify_user(user_id, device, limit)
+            # Блокируем лишние (чужие устройства блокирует их узел)
+            for _, _, device in ranked[limit:]:
+                if device is not None:
+                    t0 = time.perf_counter()
+                    await self.block_device(user_id, device)
+                    t1 = time.perf_counter()
+                    await self.notify_user(user_id, device, limit)
+                    stages['enforce'] += t1 - t0
+                    stages['notify'] += time.perf_counter() - t1
+                    REJECTED.inc()
+        
+        if len(current_devices) + len(remote) >= limit:
+            self.users_at_limit.add(user_id)
+        else:
+            self.users_at_limit.discard(user_id)
+        
+        # Устройства, пропавшие из подключений, забываем
+        removed = self.user_devices.retain(user_id, current_devices)
+        if self.cluster is not None:
+            for device in current_devices.values():
+                self.cluster.add(user_id, device.fingerprint, 0, device.first_seen)
+            for device in removed:
+                self.cluster.remove(user_id, device.fingerprint)
+        self.evaluated_limits[user_id] = self.evaluation_key(user_id)
+    
+    async def refresh_limit(self, user_id: str) -> int:
+        """Покупка слотов записана в БД - новый лимит действует сразу"""
+        limit = await self.limits.invalidate(user_id)
+        # Заблокированное устройство не может подключиться и не появится в логах -
+        # снимаем блокировки, лишние устройства заблокируются на следующем тике
+        for ip in self.routing.blocked_ips(user_id):
+            self.routing.unblock(user_id, ip)
+        for device in self.user_devices.devices(user_id):
+            device.blocked = False
+        self.evaluated_limits.pop(user_id, None)
+        self.users_at_limit.discard(user_id)
+        return limit
+    
+    async def cleanup_old_devices(self, interval: float = 30.0):
+        """Освобождение слотов устройств, простаивающих дольше таймаута тарифа"""
+        while True:
+            try:
+                self.expire_idle_devices()
+            except Exception as e:
+                ERRORS.labels('cleanup').inc()
+                print(f"Cleanup error: {e}")
+            
+            await asyncio.sleep(interval)
+    
+    def expire_idle_devices(self, now: Optional[float] = None) -> int:
+        """Удаление устройств из реестра, снятие их блокировок и присутствия в кластере"""
+        expired = self.expiry.expire(now)
         
-        self.user_devices[user_id] = current_devices
+        for user_id, device in expired:
+            self.users_at_limit.discard(user_id)
+            # IP мог остаться заблокированным из-за другого устройства пользователя
+            if device.blocked and not any(
+                other.blocked and other.ip == device.ip
+                for other in self.user_devices.devices(user_id)
+            ):
+                self.routing.unblock(user_id, device.ip)
+            if self.cluster is not None:
+                self.cluster.remove(user_id, device.fingerprint)
+            if user_id not in self.user_devices:
+                self.evaluated_limits.pop(user_id, None)
+        
+        return len(expired)
     
-    async def block_device(self, user_id: str, device: DeviceInfo):
+    async def block_device(self, user_id: str, device: DeviceRecord):
         """Блокировка устройства через xRay API"""
-        # Добавляем правило в routing для блокировки
-        rule = {
-            "type": "field",
-            "source": [device.ip],
-            "user": [user_id],
-            "outboundTag": "blocked"
-        }
-        
-        await self.add_routing_rule(rule)
+        # Правило попадет в xRay при ближайшей синхронизации routing
+        self.routing.block(user_id, device.ip)
         device.blocked = True
     
     async def add_routing_rule(self, rule: dict):
         """Добавление правила маршрутизации в xRay"""
         # Используем xRay API для добавления правила
-        async with aiohttp.ClientSession() as session:
-            async with session.post(
-                'http://localhost:10085/v1/routing/rules',
-                json=rule
-            ) as resp:
-                return await resp.json()
-    
-    async def notify_user(self, user_id: str, device: DeviceInfo, limit: int):
-        """Отправка уведомления пользователю"""
-        telegram_id = await self.get_telegram_id(user_id)
-        
+        return await self.http.post_json(f'{self.xray_api_url}/v1/routing/rules', rule)
+    
+    async def apply_routing_batch(self, batch: dict):
+        """Пакетное обновление правил: новые/измененные правила и теги на удаление"""
+        return await self.http.post_json(f'{self.xray_api_url}/v1/routing/rules/batch', batch)
+    
+    async def notify_user(self, user_id: str, device: DeviceRecord, limit: int):
+        """Постановка уведомления пользователю в очередь"""
         message = (
             f"⚠️ Превышен лимит подключений!\n\n"
             f"Текущий лимит: {limit} устройств\n"
@@ -110,28 +300,34 @@ class XRayDeviceController:
             f"💳 Купить дополнительное подключение: /buy_device"
         )
         
-        async with aiohttp.ClientSession() as session:
-            await session.post(
-                f'https://api.telegram.org/bot{self.bot_token}/sendMessage',
-                json={
-                    'chat_id': telegram_id,
-                    'text': message,
-                    'parse_mode': 'HTML'
-                }
-            )
+        self.outbox.enqueue(user_id, "limit_exceeded", {
+            'text': message,
+            'parse_mode': 'HTML'
+        })
+    
+    async def send_telegram_message(self, user_id: str, payload: dict):
+        """Отправка сообщения через Bot API (вызывается из очереди)"""
+        telegram_id = await self.get_telegram_id(user_id)
+        
+        result = await self.http.post_json(
+            f'{self.telegram_api_url}/bot{self.bot_token}/sendMessage',
+            {'chat_id': telegram_id, **payload},
+            check_status=False  # ошибки Bot API - в теле ответа (ok, retry_after)
+        )
+        
+        if not result.get('ok'):
+            retry_after = result.get('parameters', {}).get('retry_after')
+            if retry_after is not None:
+                raise RetryAfter(retry_after)
+            raise RuntimeError(result.get('description', 'Telegram API error'))
     
-    def generate_fingerprint(self, connection_data: dict) -> str:
+    def generate_fingerprint(self, connection_data: dict) -> bytes:
         """Генерация уникального отпечатка устройства"""
-        import hashlib
-        
-        # Собираем уникальные параметры
-        fingerprint_data = {
-            'ip': connection_data.get('ip'),
-            'port': connection_data.get('port'),
-            'cipher': connection_data.get('cipher'),
-            'sni': connection_data.get('sni'),
-            'alpn': connection_data.get('alpn'),
-        }
-        
-        fingerprint_str = json.dumps(fingerprint_data, sort_keys=True)
-        return hashlib.sha256(fingerprint_str.encode()).hexdigest()
\ No newline at end of file
+        # Собираем уникальные параметры в фиксированном порядке
+        return fingerprint((
+            connection_data.get('ip'),
+            connection_data.get('port'),
+            canonical(connection_data.get('cipher')),
+            connection_data.get('sni'),
+            canonical(connection_data.get('alpn')),
+        ))
@@ -0,0 +1,126 @@
+# Задержка опроса StatsService на 50k пользователей и простой event loop во время опроса
+#
+#   python bench_stats_poll.py --users 50000 --polls 10
+
+import argparse
+import asyncio
+import random
+import statistics
+import threading
+import time
+
+import grpc
+
+from fake_stats_server import FakeStatsService, populate, start_server
+from stats_client import SERVICE, StatsClient, decode_stats, encode_query_request
+
+
+async def loop_lag(stop: asyncio.Event, interval: float = 0.005) -> float:
+    """Максимальная задержка пробуждения корутины - насколько опрос блокирует loop"""
+    worst = 0.0
+    while not stop.is_set():
+        start = time.perf_counter()
+        await asyncio.sleep(interval)
+        worst = max(worst, time.perf_counter() - start - interval)
+    return worst
+
+
+def legacy_poll(address: str) -> int:
+    """Прежняя схема: новый синхронный канал и блокирующий QueryStats на каждый опрос"""
+    channel = grpc.insecure_channel(
+        address, options=[('grpc.max_receive_message_length', 64 * 1024 * 1024)]
+    )
+    try:
+        call = channel.unary_unary(f'/{SERVICE}/QueryStats')
+        return len(decode_stats(call(encode_query_request(['user>>>'], True))))
+    finally:
+        channel.close()
+
+
+def serve_in_thread(service: FakeStatsService) -> str:
+    """Сервер в отдельном потоке со своим loop - иначе блокирующий legacy-вызов его бы остановил"""
+    started = threading.Event()
+    address = []
+
+    async def serve():
+        server = await start_server(service)
+        address.append(f'localhost:{server.port}')
+        started.set()
+        await server.wait_for_termination()
+
+    threading.Thread(target=asyncio.run, args=(serve(),), daemon=True).start()
+    started.wait()
+    return address[0]
+
+
+def churn(service: FakeStatsService, users: int, share: float, rnd: random.Random):
+    """Трафик у доли пользователей между опросами"""
+    for i in rnd.sample(range(users), int(users * share)):
+        service.add_traffic(f'user-{i:06d}@vpn', rnd.randrange(1 << 16), rnd.randrange(1 << 20))
+
+
+def report(name: str, latencies, lags):
+    latencies = sorted(latencies)
+    p95 = latencies[int(len(latencies) * 0.95) - 1] if len(latencies) >= 20 else latencies[-1]
+    print(f"{name:<8} p50 {statistics.median(latencies) * 1000:8.1f} мс  "
+          f"p95/max {p95 * 1000:8.1f} мс  простой loop до {max(lags) * 1000:8.1f} мс")
+
+
+async def measure(name: str, service: FakeStatsService, args, poll):
+    rnd = random.Random(7)
+    latencies, lags = [], []
+    for _ in range(args.polls):
+        churn(service, args.users, args.churn, rnd)
+        stop = asyncio.Event()
+        lag_task = asyncio.create_task(loop_lag(stop))
+        await asyncio.sleep(0)
+
+        start = time.perf_counter()
+        await poll()
+        latencies.append(time.perf_counter() - start)
+
+        stop.set()
+        lags.append(await lag_task)
+    report(name, latencies, lags)
+
+
+async def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--users', type=int, default=50000)
+    parser.add_argument('--polls', type=int, default=10)
+    parser.add_argument('--churn', type=float, default=0.2)
+    args = parser.parse_args()
+
+    service = FakeStatsService()
+    populate(service, args.users)
+    address = serve_in_thread(service)
+    client = StatsClient(address)
+
+    async def legacy():
+        # Прямо в корутине, как в прежнем get_xray_stats
+        legacy_poll(address)
+
+    async def query_only():
+        await client.poll_user_traffic()
+
+    async def full_poll():
+        traffic = await client.poll_user_traffic()
+        online_users = await client.online_users()
+        active = [user for user, (up, down) in traffic.items()
+                  if (up or down) and user in online_users]
+        await client.online_ips(active)
+
+    try:
+        # Первый опрос запоминает начальные счетчики всех пользователей
+        await client.poll_user_traffic()
+        print(f"пользователей {args.users:,}, трафик за опрос у {args.churn:.0%}, "
+              f"онлайн {len(service.online):,}")
+        await measure('legacy', service, args, legacy)
+        await measure('aio', service, args, query_only)
+        await measure('aio+ip', service, args, full_poll)
+    finally:
+        await client.close()
+
+
+if __name__ == '__main__':
+    asyncio.run(main())
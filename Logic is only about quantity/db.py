@@ -4,6 +4,7 @@ CREATE TABLE users (
     telegram_id BIGINT UNIQUE,
     uuid VARCHAR(36) UNIQUE,
     device_limit INTEGER DEFAULT 1,
+    plan VARCHAR(20) DEFAULT 'basic',  -- таймаут простоя устройств (device_expiry.py)
     created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
 );
 
@@ -11,7 +12,7 @@ CREATE TABLE users (
 CREATE TABLE devices (
     id INTEGER PRIMARY KEY,
     user_id INTEGER REFERENCES users(id),
-    fingerprint VARCHAR(64),
+    fingerprint BLOB,  -- 16 байт blake2b (fingerprint.py)
     ip_address VARCHAR(45),
     first_seen TIMESTAMP,
     last_seen TIMESTAMP,
@@ -1,22 +1,20 @@
 # Система отпечатков устройств (Fingerprinting)
+
+from common.fingerprint import canonical, fingerprint
+
 class DeviceFingerprint:
     def __init__(self):
         self.user_fingerprints = defaultdict(dict)
         
     def generate_fingerprint(self, connection_data):
-        """Генерация отпечатка устройства"""
-        fingerprint_data = {
-            'ip': connection_data.get('ip'),
-            'user_agent': connection_data.get('user_agent'),
-            'tls_fingerprint': connection_data.get('tls_fingerprint'),
-            'tcp_fingerprint': self.get_tcp_fingerprint(connection_data),
-            'timezone': connection_data.get('timezone'),
-        }
-        
-        # Создаем хеш отпечатка
-        import hashlib
-        fingerprint_str = json.dumps(fingerprint_data, sort_keys=True)
-        return hashlib.sha256(fingerprint_str.encode()).hexdigest()
+        """Генерация отпечатка устройства (16 байт)"""
+        return fingerprint((
+            connection_data.get('ip'),
+            connection_data.get('user_agent'),
+            canonical(connection_data.get('tls_fingerprint')),
+            canonical(self.get_tcp_fingerprint(connection_data)),
+            connection_data.get('timezone'),
+        ))
     
     def check_device_limit(self, user_id, fingerprint, limit=1):
         """Проверка лимита устройств"""
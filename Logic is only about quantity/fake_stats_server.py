@@ -0,0 +1,116 @@
+# Локальный поддельный StatsService xRay для проверки клиента и бенчмарков
+#
+#   python fake_stats_server.py --users 1000 --port 10085
+
+import argparse
+import asyncio
+import random
+from typing import Dict, List, Optional
+
+import grpc
+
+from stats_client import (
+    SERVICE, decode_get_request, decode_query_request, encode_ip_list, encode_names, encode_stats
+)
+
+
+def _identity(data: bytes) -> bytes:
+    return data
+
+
+class FakeStatsService:
+    """Счетчики user>>>{email}>>>traffic>>>uplink/downlink и онлайн-IP пользователей"""
+
+    def __init__(self):
+        self.counters: Dict[str, int] = {}
+        self.online: Dict[str, Dict[str, int]] = {}  # email -> IP -> время последней активности
+        self.calls = {'QueryStats': 0, 'GetStatsOnlineIpList': 0, 'GetAllOnlineUsers': 0}
+
+    def add_traffic(self, user: str, uplink: int, downlink: int):
+        for direction, value in (('uplink', uplink), ('downlink', downlink)):
+            name = f'user>>>{user}>>>traffic>>>{direction}'
+            self.counters[name] = self.counters.get(name, 0) + value
+
+    def set_online(self, user: str, ips: List[str], now: int = 0):
+        if ips:
+            self.online[user] = {ip: now for ip in ips}
+        else:
+            self.online.pop(user, None)
+
+    async def query_stats(self, request: bytes, context) -> bytes:
+        self.calls['QueryStats'] += 1
+        patterns, reset = decode_query_request(request)
+        # Как в xRay: без regexp шаблон - подстрока, пустой список - все счетчики
+        matched = [
+            name for name in self.counters
+            if not patterns or any(pattern in name for pattern in patterns)
+        ]
+        response = encode_stats((name, self.counters[name]) for name in matched)
+        if reset:
+            for name in matched:
+                self.counters[name] = 0
+        return response
+
+    async def get_online_ip_list(self, request: bytes, context) -> bytes:
+        self.calls['GetStatsOnlineIpList'] += 1
+        name, _ = decode_get_request(request)
+        user = name.split('>>>')[1] if name.count('>>>') == 2 else ''
+        ips = self.online.get(user)
+        if ips is None:
+            await context.abort(grpc.StatusCode.UNKNOWN, f'{name} not found.')
+        return encode_ip_list(name, ips)
+
+    async def get_all_online_users(self, request: bytes, context) -> bytes:
+        self.calls['GetAllOnlineUsers'] += 1
+        return encode_names(f'user>>>{user}>>>online' for user in self.online)
+
+    def handler(self) -> grpc.GenericRpcHandler:
+        return grpc.method_handlers_generic_handler(SERVICE, {
+            'QueryStats': grpc.unary_unary_rpc_method_handler(
+                self.query_stats, request_deserializer=_identity, response_serializer=_identity
+            ),
+            'GetStatsOnlineIpList': grpc.unary_unary_rpc_method_handler(
+                self.get_online_ip_list, request_deserializer=_identity, response_serializer=_identity
+            ),
+            'GetAllOnlineUsers': grpc.unary_unary_rpc_method_handler(
+                self.get_all_online_users, request_deserializer=_identity, response_serializer=_identity
+            ),
+        })
+
+
+async def start_server(service: FakeStatsService, address: str = 'localhost:0') -> grpc.aio.Server:
+    """Запуск сервера; фактический порт - в server.port"""
+    server = grpc.aio.server(options=[('grpc.max_send_message_length', 64 * 1024 * 1024)])
+    server.add_generic_rpc_handlers((service.handler(),))
+    server.port = server.add_insecure_port(address)
+    await server.start()
+    return server
+
+
+def populate(service: FakeStatsService, users: int, online_share: float = 0.2,
+             seed: Optional[int] = 1):
+    """Синтетические пользователи: трафик у всех, онлайн-IP у части"""
+    rnd = random.Random(seed)
+    for i in range(users):
+        user = f'user-{i:06d}@vpn'
+        service.add_traffic(user, rnd.randrange(1 << 20), rnd.randrange(1 << 24))
+        if rnd.random() < online_share:
+            service.set_online(user, [f'10.{i // 65536 % 256}.{i // 256 % 256}.{k}'
+                                      for k in range(rnd.randint(1, 3))])
+
+
+async def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--users', type=int, default=1000)
+    parser.add_argument('--port', type=int, default=10085)
+    args = parser.parse_args()
+
+    service = FakeStatsService()
+    populate(service, args.users)
+    server = await start_server(service, f'localhost:{args.port}')
+    print(f"Fake StatsService on localhost:{server.port}, {args.users} users")
+    await server.wait_for_termination()
+
+
+if __name__ == '__main__':
+    asyncio.run(main())
@@ -0,0 +1,259 @@
+# Блокировка IP в ядре: именованные множества nftables с таймаутом, одна транзакция за тик
+
+import asyncio
+import heapq
+import ipaddress
+import json
+import math
+import sys
+import time
+from typing import Dict, FrozenSet, List, Optional, Set, Tuple
+
+
+class NftablesFirewall:
+    """Заблокированные IP пользователей в множествах nftables (IP . порт inbound).
+
+    В цепочке всего два правила - по одному на множество IPv4 и IPv6, поиск
+    в множестве хэшем, а не перебором правил на каждое устройство. Изменения
+    копятся в памяти, sync() отправляет добавления и удаления тика одним
+    скриптом `nft -f -`, который ядро применяет атомарно. Таймаут элемента
+    держит ядро: если процесс упал, блокировки истекут сами.
+
+    Один IP могут заблокировать несколько пользователей (NAT): элемент
+    удаляется, когда его не держит ни один из них.
+    В режиме dry_run скрипты не выполняются, а печатаются - для проверки без root.
+    """
+
+    def __init__(self, table: str = 'vpn_limiter', port: int = 443, ttl: float = 3600.0,
+                 dry_run: bool = False, nft: str = 'nft'):
+        self.table = table
+        self.port = port  # порт inbound xRay: другие сервисы на хосте блокировка не трогает
+        self.ttl = ttl
+        self.dry_run = dry_run
+        self.nft = nft
+        self.last_script = ''
+
+        self._blocked: Dict[str, Dict[str, float]] = {}  # user_id -> ip -> expires_at
+        self._owners: Dict[str, Set[str]] = {}  # ip -> пользователи, заблокировавшие его
+        self._applied: Dict[str, float] = {}  # ip -> срок элемента в ядре
+        self._dirty: Set[str] = set()  # IP, чей элемент нужно добавить, продлить или удалить
+        self._expiry: List[Tuple[float, str, str]] = []  # min-heap (expires_at, user_id, ip)
+
+    def block(self, user_id: str, ip: str, ttl: Optional[float] = None) -> bool:
+        """Блокировка IP пользователя; True если он не был заблокирован"""
+        if self.ip_version(ip) is None:
+            print(f"Firewall block skipped: bad IP {ip!r}")
+            return False
+
+        expires_at = time.time() + (ttl if ttl is not None else self.ttl)
+        user_blocked = self._blocked.setdefault(user_id, {})
+        is_new = ip not in user_blocked
+
+        # Повторная блокировка продлевает TTL: элемент в ядре обновится при sync()
+        user_blocked[ip] = expires_at
+        if is_new:
+            heapq.heappush(self._expiry, (expires_at, user_id, ip))
+            self._owners.setdefault(ip, set()).add(user_id)
+        self._dirty.add(ip)
+        return is_new
+
+    def unblock(self, user_id: str, ip: str) -> bool:
+        user_blocked = self._blocked.get(user_id)
+        if not user_blocked or ip not in user_blocked:
+            return False
+
+        del user_blocked[ip]
+        if not user_blocked:
+            del self._blocked[user_id]
+        owners = self._owners[ip]
+        owners.discard(user_id)
+        if not owners:
+            del self._owners[ip]
+        self._dirty.add(ip)
+        return True
+
+    def is_blocked(self, user_id: str, ip: str) -> bool:
+        return ip in self._blocked.get(user_id, ())
+
+    def blocked_ips(self, user_id: str) -> FrozenSet[str]:
+        return frozenset(self._blocked.get(user_id, ()))
+
+    @property
+    def pending(self) -> int:
+        """IP с изменениями, еще не отправленными в ядро"""
+        return len(self._dirty)
+
+    def expire(self, now: Optional[float] = None) -> int:
+        """Снятие блокировок с истекшим TTL (элементы в ядре истекают сами)"""
+        now = now if now is not None else time.time()
+        expired = 0
+
+        while self._expiry and self._expiry[0][0] <= now:
+            expires_at, user_id, ip = heapq.heappop(self._expiry)
+            current = self._blocked.get(user_id, {}).get(ip)
+            if current is None:
+                continue
+            if current > expires_at:
+                # TTL продлен повторной блокировкой - переносим запись
+                heapq.heappush(self._expiry, (current, user_id, ip))
+                continue
+            self.unblock(user_id, ip)
+            expired += 1
+
+        return expired
+
+    def desired_expiry(self, ip: str) -> Optional[float]:
+        """Срок элемента IP: самая поздняя блокировка среди пользователей"""
+        owners = self._owners.get(ip)
+        if not owners:
+            return None
+        return max(self._blocked[user_id][ip] for user_id in owners)
+
+    async def sync(self) -> int:
+        """Изменения тика одной транзакцией nft; возвращает число измененных элементов"""
+        now = time.time()
+        self.expire(now)
+        if not self._dirty:
+            return 0
+
+        upserts: Dict[str, int] = {}  # ip -> таймаут элемента, секунд
+        removals: List[str] = []
+        for ip in self._dirty:
+            desired = self.desired_expiry(ip)
+            applied = self._applied.get(ip)
+            if desired is None:
+                # Истекший в ядре элемент удалять не нужно
+                if applied is not None and applied > now:
+                    removals.append(ip)
+            elif applied is None or desired > applied:
+                upserts[ip] = max(1, math.ceil(desired - now))
+
+        if upserts or removals:
+            await self.run(self.batch_script(upserts, removals))
+
+        # Грязные IP сбрасываются только после успешного применения
+        for ip in self._dirty:
+            if ip in upserts:
+                self._applied[ip] = now + upserts[ip]
+            elif self.desired_expiry(ip) is None:
+                self._applied.pop(ip, None)
+        self._dirty.clear()
+
+        return len(upserts) + len(removals)
+
+    async def reconcile(self, flush: bool = True) -> dict:
+        """Старт: таблица и правила на месте, содержимое множеств = состояние в памяти.
+
+        Множества очищаются и заполняются заново в той же транзакции, так что
+        блокировки прошлого запуска не остаются висеть до истечения таймаута.
+        flush=False - состояние в памяти неполное (холодный старт без БД):
+        элементы прошлого запуска остаются в ядре до своего таймаута.
+        """
+        now = time.time()
+        self.expire(now)
+        current = set() if self.dry_run else await self.list_elements()
+
+        upserts = {
+            ip: max(1, math.ceil(self.desired_expiry(ip) - now)) for ip in self._owners
+        }
+        desired = {(ip, self.port) for ip in upserts}
+        flush_script = self.flush_script() if flush else ''
+        await self.run(self.setup_script() + flush_script + self.batch_script(upserts, []))
+
+        self._applied = {ip: now + timeout for ip, timeout in upserts.items()}
+        self._dirty.clear()
+        return {
+            'elements': len(upserts),
+            'stale': len(current - desired),
+            'missing': len(desired - current),
+            'flushed': flush,
+        }
+
+    async def list_elements(self) -> Set[Tuple[str, int]]:
+        """Элементы (ip, порт) обоих множеств; пустое множество, если таблицы еще нет"""
+        elements = set()
+        for name in (self.set_name(4), self.set_name(6)):
+            try:
+                output = await self.run_command('-j', 'list', 'set', 'inet', self.table, name)
+            except RuntimeError:
+                continue
+            for item in json.loads(output).get('nftables', ()):
+                for elem in item.get('set', {}).get('elem', ()):
+                    # Элемент с таймаутом: {"elem": {"val": {"concat": [...]}, "timeout": ...}}
+                    value = elem.get('elem', {}).get('val', elem) if isinstance(elem, dict) else elem
+                    ip, port = value['concat']
+                    elements.add((ip, port))
+        return elements
+
+    def setup_script(self) -> str:
+        """Таблица, множества и цепочка; повторный запуск не дублирует правила"""
+        table = f"inet {self.table}"
+        return (
+            f"add table {table}\n"
+            f"add set {table} {self.set_name(4)} {{ type ipv4_addr . inet_service; flags timeout; }}\n"
+            f"add set {table} {self.set_name(6)} {{ type ipv6_addr . inet_service; flags timeout; }}\n"
+            f"add chain {table} input {{ type filter hook input priority -10; policy accept; }}\n"
+            f"flush chain {table} input\n"
+            f"add rule {table} input ip saddr . tcp dport @{self.set_name(4)} drop\n"
+            f"add rule {table} input ip6 saddr . tcp dport @{self.set_name(6)} drop\n"
+        )
+
+    def flush_script(self) -> str:
+        table = f"inet {self.table}"
+        return f"flush set {table} {self.set_name(4)}\nflush set {table} {self.set_name(6)}\n"
+
+    def batch_script(self, upserts: Dict[str, int], removals: List[str]) -> str:
+        """Скрипт изменений; выполняется целиком или не выполняется совсем.
+
+        delete несуществующего элемента отменил бы всю транзакцию, а add
+        существующего не меняет его таймаут. Поэтому перед удалением и
+        продлением элемент сначала добавляется (для существующего - no-op),
+        затем удаляется, и только потом добавляется с новым таймаутом.
+        """
+        lines = []
+        for version in (4, 6):
+            target = f"inet {self.table} {self.set_name(version)}"
+            adds = [
+                f"{ip} . {self.port} timeout {timeout}s"
+                for ip, timeout in upserts.items() if self.ip_version(ip) == version
+            ]
+            touched = [
+                f"{ip} . {self.port}"
+                for ip in list(upserts) + removals if self.ip_version(ip) == version
+            ]
+            if touched:
+                lines.append(f"add element {target} {{ {', '.join(touched)} }}")
+                lines.append(f"delete element {target} {{ {', '.join(touched)} }}")
+            if adds:
+                lines.append(f"add element {target} {{ {', '.join(adds)} }}")
+        return ''.join(line + '\n' for line in lines)
+
+    async def run(self, script: str):
+        """Выполнение скрипта одной транзакцией; в dry_run - только вывод"""
+        self.last_script = script
+        if self.dry_run:
+            sys.stdout.write(script)
+            return
+        await self.run_command('-f', '-', stdin=script)
+
+    async def run_command(self, *args: str, stdin: Optional[str] = None) -> str:
+        process = await asyncio.create_subprocess_exec(
+            self.nft, *args,
+            stdin=asyncio.subprocess.PIPE if stdin is not None else asyncio.subprocess.DEVNULL,
+            stdout=asyncio.subprocess.PIPE,
+            stderr=asyncio.subprocess.PIPE
+        )
+        stdout, stderr = await process.communicate(stdin.encode() if stdin is not None else None)
+        if process.returncode != 0:
+            raise RuntimeError(f"nft {' '.join(args)} failed: {stderr.decode().strip()}")
+        return stdout.decode()
+
+    def set_name(self, version: int) -> str:
+        return f"blocked{version}"
+
+    @staticmethod
+    def ip_version(ip: str) -> Optional[int]:
+        try:
+            return ipaddress.ip_address(ip).version
+        except ValueError:
+            return None
@@ -1,19 +1,63 @@
 # Интеграция с Telegram ботом
 
-from aiogram import Bot, Dispatcher, types
+from aiogram import Bot, Dispatcher, F, types
 from aiogram.fsm.storage.memory import MemoryStorage
 
+import common_path  # noqa: F401 - корень репозитория в sys.path: пакет common
+from firewall import NftablesFirewall
+from common.metrics import QUEUE_DEPTH
+from common.notify_outbox import NotificationOutbox
+
+# Цена дополнительного устройства, рублей
+DEVICE_PRICE = 299
+
+
 class VPNBot:
-    def __init__(self, token):
+    def __init__(self, token, db_path=None, firewall_dry_run=False, payment_token=''):
         self.bot = Bot(token=token)
         self.dp = Dispatcher(storage=MemoryStorage())
-        self.limiter = DeviceLimiter()
+        # Токен платежного провайдера Telegram Payments для счетов buy_device
+        self.payment_token = payment_token
+        # Лишние IP блокируются в множествах nftables, лимитер применяет изменения раз за тик
+        self.firewall = NftablesFirewall(dry_run=firewall_dry_run)
+        QUEUE_DEPTH.labels('firewall').set_function(lambda: self.firewall.pending)
+        self.limiter = DeviceLimiter(db_path=db_path, firewall=self.firewall)
         self.db = Database()  # Ваша БД
+        # Повторные превышения не спамят пользователя и не тормозят мониторинг
+        self.outbox = NotificationOutbox(self.send_notification)
+        QUEUE_DEPTH.labels('outbox').set_function(lambda: self.outbox.depth)
+        self.setup_handlers()
+    
+    def setup_handlers(self):
+        @self.dp.callback_query(F.data.startswith("buy_device:"))
+        async def buy_device(callback):
+            # Кнопка из уведомления о превышении: счет на одно устройство
+            user_id = callback.data.split(":", 1)[1]
+            await callback.message.answer_invoice(
+                title="Дополнительное устройство",
+                description="Еще одно одновременное подключение к VPN",
+                payload=f"device:{user_id}",
+                provider_token=self.payment_token,
+                currency="RUB",
+                prices=[types.LabeledPrice(label="Устройство", amount=DEVICE_PRICE * 100)]
+            )
+            await callback.answer()
+        
+        @self.dp.pre_checkout_query()
+        async def confirm_checkout(query):
+            await query.answer(ok=True)
+        
+        @self.dp.message(F.successful_payment)
+        async def payment_completed(message):
+            payment = message.successful_payment
+            kind, _, user_id = payment.invoice_payload.partition(":")
+            if kind != "device":
+                return
+            limit = await self.complete_device_purchase(user_id, 1, payment.total_amount / 100)
+            await message.answer(f"✅ Устройство добавлено. Ваш лимит: {limit} устройств(а)")
         
     async def handle_limit_exceeded(self, user_id, devices, limit):
         """Обработка превышения лимита"""
-        telegram_id = await self.db.get_telegram_id(user_id)
-        
         # Блокируем лишние подключения
         await self.block_excess_connections(user_id, devices, limit)
         
@@ -33,12 +77,24 @@ class VPNBot:
             "необходимо приобрести расширение."
         )
         
-        await self.bot.send_message(
-            telegram_id, 
-            message,
-            reply_markup=keyboard,
-            parse_mode="HTML"
-        )
+        self.outbox.enqueue(user_id, "limit_exceeded", {
+            'text': message,
+            'reply_markup': keyboard,
+            'parse_mode': "HTML"
+        })
+    
+    async def complete_device_purchase(self, user_id, device_slots, amount):
+        """Оплата buy_device подтверждена: покупка в БД, новый лимит действует сразу"""
+        await self.db.add_purchase(user_id, device_slots, amount)
+        # Заблокированные IP не подключатся и не появятся в статистике - снимаем блокировки
+        for device_ip in self.firewall.blocked_ips(user_id):
+            self.firewall.unblock(user_id, device_ip)
+        return await self.limiter.refresh_limit(user_id)
+    
+    async def send_notification(self, user_id, payload: dict):
+        """Отправка из очереди; TelegramRetryAfter учитывается очередью"""
+        telegram_id = await self.db.get_telegram_id(user_id)
+        await self.bot.send_message(telegram_id, **payload)
     
     async def block_excess_connections(self, user_id, devices, limit):
         """Блокировка лишних подключений"""
@@ -46,6 +102,12 @@ class VPNBot:
         allowed_devices = devices_list[:limit]
         blocked_devices = devices_list[limit:]
         
+        for device_ip in allowed_devices:
+            self.firewall.unblock(user_id, device_ip)
         for device_ip in blocked_devices:
             # Добавляем IP в черный список для этого пользователя
-            await self.add_to_firewall(user_id, device_ip)
\ No newline at end of file
+            await self.add_to_firewall(user_id, device_ip)
+    
+    async def add_to_firewall(self, user_id, device_ip):
+        """IP попадет в множество nftables при ближайшей синхронизации (одна транзакция за тик)"""
+        self.firewall.block(user_id, device_ip)
@@ -0,0 +1,52 @@
+# Итоговые лимиты устройств в памяти: лимит тарифа + купленные слоты
+
+import asyncio
+from typing import Dict, Iterable, Optional, Tuple
+
+from state_loader import load_limits, load_user_limit
+
+
+class LimitService:
+    """user uuid -> лимит устройств без запросов к БД на горячем пути.
+
+    Все лимиты загружаются одним запросом при старте; хранятся только
+    отличающиеся от лимита по умолчанию, так что пользователи базового
+    тарифа памяти не занимают. После покупки запись пользователя
+    перечитывается из БД (invalidate), проверка сразу видит новый лимит.
+    """
+
+    def __init__(self, db_path: Optional[str] = None, default: int = 1):
+        self.db_path = db_path
+        self.default = default
+        self._limits: Dict[str, int] = {}
+
+    async def load(self) -> int:
+        """Загрузка всех лимитов; возвращает число пользователей с нестандартным лимитом"""
+        if self.db_path:
+            limits = await asyncio.to_thread(load_limits, self.db_path)
+            self._limits = {}
+            self.update(limits.items())
+        return len(self._limits)
+
+    def get(self, user_id: str) -> int:
+        return self._limits.get(user_id, self.default)
+
+    def set(self, user_id: str, limit: int):
+        if limit == self.default:
+            self._limits.pop(user_id, None)
+        else:
+            self._limits[user_id] = limit
+
+    def update(self, limits: Iterable[Tuple[str, int]]):
+        for user_id, limit in limits:
+            self.set(user_id, limit)
+
+    async def invalidate(self, user_id: str) -> int:
+        """Покупка завершена - перечитываем лимит пользователя из БД"""
+        if self.db_path:
+            limit = await asyncio.to_thread(load_user_limit, self.db_path, user_id)
+            self.set(user_id, self.default if limit is None else limit)
+        return self.get(user_id)
+
+    def __len__(self) -> int:
+        return len(self._limits)
@@ -0,0 +1,155 @@
+# Нагрузочный прогон XRayDeviceController: синтетические подключения, заглушки xRay и Telegram
+#
+#   python loadtest.py --users 1000,10000,100000 --ticks 20 --online 0.3
+#   python loadtest.py --users 10000 --churn 0.05 --devices 1,5 --limit 2
+#
+# Каждый масштаб прогоняется в отдельном процессе, чтобы пик памяти не смешивался
+
+import argparse
+import asyncio
+import importlib.util
+import multiprocessing
+import os
+import resource
+import time
+from concurrent.futures import ProcessPoolExecutor
+from typing import Dict, List, Optional
+
+import common_path  # noqa: F401 - корень репозитория в sys.path: пакет common
+from common.fake_apis import FakeTelegramAPI, FakeXRayAPI
+from common.loadgen import SyntheticPopulation
+from common.metrics import CONNECTIONS, REJECTED
+
+BOT_TOKEN = 'loadtest'
+
+
+def load_controller_module():
+    """XRayDeviceController лежит в __init__.py каталога с пробелами - загружаем по пути"""
+    path = os.path.join(os.path.dirname(os.path.abspath(__file__)), '__init__.py')
+    spec = importlib.util.spec_from_file_location('device_controller', path)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+def percentile(values: List[float], q: float) -> float:
+    """Перцентиль по ближайшему рангу"""
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(q / 100 * len(ordered)))]
+
+
+def parse_os_mix(value: Optional[str]) -> Optional[Dict[str, float]]:
+    if not value:
+        return None
+    return {name: float(share) for name, share in (item.split('=') for item in value.split(','))}
+
+
+async def run_scenario(users: int, ticks: int, online: float, churn: float, limit: int,
+                       devices_per_user: tuple, os_mix: Optional[Dict[str, float]]) -> dict:
+    controller_module = load_controller_module()
+
+    class LoadTestController(controller_module.XRayDeviceController):
+        """Подключения тика берутся из синтетической популяции"""
+
+        async def parse_xray_logs(self) -> Dict[str, List[dict]]:
+            return population.online_connections()
+
+        async def get_telegram_id(self, user_id: str) -> str:
+            return user_id
+
+    population = SyntheticPopulation(users, devices_per_user, os_mix, churn=churn,
+                                     online_share=online)
+    xray_api = FakeXRayAPI()
+    telegram_api = FakeTelegramAPI()
+    await xray_api.start()
+    await telegram_api.start()
+
+    controller = LoadTestController(
+        'config.json', BOT_TOKEN,
+        xray_api_url=xray_api.url,
+        telegram_api_url=telegram_api.url
+    )
+    controller.limits.update((user_id, limit) for user_id in population.user_ids)
+    await controller.restore_state()
+
+    tick_seconds = []
+    for _ in range(ticks):
+        population.step()
+        start = time.perf_counter()
+        await controller.tick()
+        tick_seconds.append(time.perf_counter() - start)
+    connections_total = CONNECTIONS.labels().value
+
+    # Даем очереди уведомлений отработать то, что уже можно отправить
+    await asyncio.sleep(1)
+    result = {
+        'users': users,
+        'devices': population.device_count,
+        'connections': connections_total,
+        # Время тика включает сборку синтетического снимка подключений
+        'connections_per_second': connections_total / sum(tick_seconds),
+        'p50': percentile(tick_seconds, 50),
+        'p95': percentile(tick_seconds, 95),
+        'p99': percentile(tick_seconds, 99),
+        'max': max(tick_seconds),
+        'rss_mb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024,
+        'rejected': REJECTED.labels().value,
+        'blocked_ips': xray_api.blocked_ips,
+        'xray_batches': xray_api.batches,
+        'messages': telegram_api.sent,
+        'outbox_depth': controller.outbox.depth,
+    }
+
+    await controller.close()
+    await xray_api.close()
+    await telegram_api.close()
+    return result
+
+
+def run_in_process(kwargs: dict) -> dict:
+    return asyncio.run(run_scenario(**kwargs))
+
+
+def report(result: dict):
+    print(
+        f"{result['users']:>8,} польз. {result['devices']:>8,} устр.  "
+        f"{result['connections_per_second']:>9,.0f} подкл/с  "
+        f"тик p50 {result['p50'] * 1000:7.1f} p95 {result['p95'] * 1000:7.1f} "
+        f"p99 {result['p99'] * 1000:7.1f} мс  RSS {result['rss_mb']:6.0f} МБ  "
+        f"отклонено {result['rejected']:,}  IP в блоке {result['blocked_ips']:,}  "
+        f"сообщений {result['messages']:,} (в очереди {result['outbox_depth']:,})"
+    )
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--users', default='1000,10000,100000')
+    parser.add_argument('--ticks', type=int, default=20)
+    parser.add_argument('--online', type=float, default=0.3, help='доля пользователей онлайн за тик')
+    parser.add_argument('--churn', type=float, default=0.01)
+    parser.add_argument('--limit', type=int, default=2, help='лимит устройств каждого пользователя')
+    parser.add_argument('--devices', default='1,3', help='устройств на пользователя: min,max')
+    parser.add_argument('--os-mix', default=None, help='например ios=0.3,android=0.5,windows=0.2')
+    args = parser.parse_args()
+
+    devices_per_user = tuple(int(n) for n in args.devices.split(','))
+    print(f"тиков {args.ticks}, онлайн {args.online:.0%}, churn {args.churn}, лимит {args.limit}")
+
+    for users in map(int, args.users.split(',')):
+        # spawn: свежий процесс на каждый масштаб, RSS не наследуется
+        with ProcessPoolExecutor(1, mp_context=multiprocessing.get_context('spawn')) as pool:
+            report(pool.submit(run_in_process, {
+                'users': users,
+                'ticks': args.ticks,
+                'online': args.online,
+                'churn': args.churn,
+                'limit': args.limit,
+                'devices_per_user': devices_per_user,
+                'os_mix': parse_os_mix(args.os_mix),
+            }).result())
+
+
+if __name__ == '__main__':
+    main()
@@ -1,52 +1,134 @@
 #  Мониторинг через xRay API и статистику
 import json
+import sys
+import time
 import asyncio
 from datetime import datetime
 from collections import defaultdict
 
+from limits import LimitService
+from common.metrics import CONNECTIONS, ERRORS, REJECTED, USERS_AT_LIMIT, MetricsServer, observe_tick, stage_timings
+from state_loader import load_blocked_ips
+from stats_client import StatsClient
+
 class DeviceLimiter:
-    def __init__(self, xray_api_port=10085):
+    def __init__(self, xray_api_port=10085, metrics_port=None, db_path=None, firewall=None):
         self.api_port = xray_api_port
-        self.user_devices = defaultdict(set)  # user_id -> set of IPs
-        self.device_limits = {}  # user_id -> limit
+        self.db_path = db_path
+        self.user_devices = {}  # user_id -> frozenset интернированных IP
+        self.device_limits = LimitService(db_path)  # user_id -> limit, из users и purchases
+        self.checked_limits = {}  # user_id -> лимит на момент последней проверки
+        # Постоянный grpc.aio канал вместо нового канала на каждый опрос
+        self.stats_client = StatsClient(f'localhost:{xray_api_port}')
+        self.users_at_limit = set()  # пользователи без свободных слотов
+        # NftablesFirewall: блокировки тика уходят в ядро одной транзакцией
+        self.firewall = firewall
+        self.metrics_server = MetricsServer(port=metrics_port) if metrics_port is not None else None
+        USERS_AT_LIMIT.set_function(lambda: len(self.users_at_limit))
         
     async def monitor_connections(self):
         """Мониторинг активных подключений"""
+        await self.device_limits.load()
+        if self.firewall is not None:
+            # Множества nftables приводятся к состоянию в памяти; без состояния
+            # из БД (холодный старт) блокировки прошлого запуска не сбрасываются
+            restored = await self.restore_blocks()
+            print(f"Firewall reconciled: {await self.firewall.reconcile(flush=restored)}")
+        if self.metrics_server is not None:
+            await self.metrics_server.start()
+        
         while True:
             try:
-                # Получаем статистику через xRay API
-                stats = await self.get_xray_stats()
-                
-                for user_id, connections in stats.items():
-                    unique_ips = set()
-                    
-                    for conn in connections:
-                        # Собираем уникальные IP адреса
-                        unique_ips.add(conn['ip'])
-                    
-                    # Проверяем лимит
-                    limit = self.device_limits.get(user_id, 1)
-                    
-                    if len(unique_ips) > limit:
-                        # Превышен лимит устройств
-                        await self.handle_limit_exceeded(user_id, unique_ips, limit)
-                    
-                    self.user_devices[user_id] = unique_ips
-                
+                await self.tick()
             except Exception as e:
+                ERRORS.labels('monitor').inc()
                 print(f"Monitoring error: {e}")
             
             await asyncio.sleep(5)  # Проверяем каждые 5 секунд
     
+    async def restore_blocks(self) -> bool:
+        """Блокировки прошлого запуска из devices.is_blocked; False - состояние не прочитано"""
+        if not self.db_path:
+            return False
+        blocked = await asyncio.to_thread(load_blocked_ips, self.db_path)
+        if blocked is None:
+            return False
+        for user_id, ips in blocked.items():
+            for ip in ips:
+                self.firewall.block(user_id, ip)
+        return True
+    
+    async def tick(self):
+        """Один опрос xRay; время тика и стадий уходит в метрики"""
+        start = time.perf_counter()
+        stages = stage_timings()
+        
+        # Получаем статистику через xRay API
+        stats = await self.get_xray_stats()
+        t0 = time.perf_counter()
+        stages['read'] += t0 - start
+        
+        for user_id, connections in stats.items():
+            CONNECTIONS.inc(len(connections))
+            # Собираем уникальные IP адреса (одна копия строки на IP)
+            unique_ips = frozenset(sys.intern(conn['ip']) for conn in connections)
+            limit = self.device_limits.get(user_id)
+            
+            # Ни IP, ни лимит не менялись с прошлой проверки - пропускаем
+            if (self.checked_limits.get(user_id) == limit
+                    and self.user_devices.get(user_id) == unique_ips):
+                continue
+            
+            # Проверяем лимит
+            if len(unique_ips) > limit:
+                # Превышен лимит устройств: блокировка и уведомление
+                t1 = time.perf_counter()
+                await self.handle_limit_exceeded(user_id, unique_ips, limit)
+                stages['enforce'] += time.perf_counter() - t1
+                REJECTED.inc(len(unique_ips) - limit)
+            
+            if len(unique_ips) >= limit:
+                self.users_at_limit.add(user_id)
+            else:
+                self.users_at_limit.discard(user_id)
+            
+            self.user_devices[user_id] = unique_ips
+            self.checked_limits[user_id] = limit
+        
+        stages['decide'] += time.perf_counter() - t0 - stages['enforce']
+        
+        if self.firewall is not None:
+            t1 = time.perf_counter()
+            await self.firewall.sync()
+            stages['enforce'] += time.perf_counter() - t1
+        observe_tick(time.perf_counter() - start, stages)
+    
+    async def refresh_limit(self, user_id):
+        """Покупка слотов записана в БД - пользователь перепроверяется на ближайшем опросе"""
+        limit = await self.device_limits.invalidate(user_id)
+        self.checked_limits.pop(user_id, None)
+        self.users_at_limit.discard(user_id)
+        return limit
+    
     async def get_xray_stats(self):
         """Получение статистики через gRPC API xRay"""
-        # Используем xray-api для получения статистики
-        import grpc
-        from xray_api import StatsServiceStub
+        # Один QueryStats со сбросом: трафик каждого пользователя с прошлого опроса
+        traffic = await self.stats_client.poll_user_traffic()
         
-        channel = grpc.insecure_channel(f'localhost:{self.api_port}')
-        stub = StatsServiceStub(channel)
+        # IP запрашиваем только у подключенных пользователей, у которых был трафик
+        online_users = await self.stats_client.online_users()
+        active = [
+            user_id for user_id, (uplink, downlink) in traffic.items()
+            if (uplink or downlink) and (online_users is None or user_id in online_users)
+        ]
+        online = await self.stats_client.online_ips(active)
         
-        # Получаем список активных пользователей
-        response = stub.QueryStats(...)
-        return self.parse_stats(response)
\ No newline at end of file
+        return {
+            user_id: [{'ip': ip} for ip in ips]
+            for user_id, ips in online.items()
+        }
+    
+    async def close(self):
+        if self.metrics_server is not None:
+            await self.metrics_server.close()
+        await self.stats_client.close()
\ No newline at end of file
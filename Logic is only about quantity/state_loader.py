@@ -0,0 +1,190 @@
+# Восстановление состояния устройств и лимитов при старте (теплый рестарт)
+
+import gc
+import os
+import sqlite3
+import sys
+import time
+from typing import Dict, List, Optional
+
+from common.device_registry import DeviceRecord, DeviceRegistry
+from common.fingerprint import stored_fingerprint
+
+FETCH_SIZE = 10000
+
+# Ключ пользователя в мониторинге - uuid клиента xRay
+DEVICES_SQL = """
+SELECT u.uuid, d.fingerprint, d.ip_address,
+       CAST(strftime('%s', d.first_seen) AS INTEGER),
+       CAST(strftime('%s', d.last_seen) AS INTEGER),
+       d.is_blocked
+FROM devices d
+JOIN users u ON u.id = d.user_id
+"""
+
+# Базовый лимит тарифа плюс все купленные слоты
+LIMITS_SQL = """
+SELECT u.uuid, u.device_limit + COALESCE(SUM(p.device_slots), 0)
+FROM users u
+LEFT JOIN purchases p ON p.user_id = u.id
+GROUP BY u.id
+"""
+
+# То же для одного пользователя - перечитывается после покупки слотов
+USER_LIMIT_SQL = """
+SELECT u.device_limit + COALESCE(SUM(p.device_slots), 0)
+FROM users u
+LEFT JOIN purchases p ON p.user_id = u.id
+WHERE u.uuid = ?
+GROUP BY u.id
+"""
+
+
+PLANS_SQL = "SELECT uuid, plan FROM users WHERE plan IS NOT NULL"
+
+# Заблокированные IP прошлого запуска - для множеств nftables при старте
+BLOCKED_SQL = """
+SELECT u.uuid, d.ip_address
+FROM devices d
+JOIN users u ON u.id = d.user_id
+WHERE d.is_blocked AND d.ip_address IS NOT NULL
+"""
+
+
+def snapshot_is_fresh(snapshot_path: str, db_path: str) -> bool:
+    """Снимок годится, только если он записан после последней записи в БД"""
+    try:
+        snapshot_mtime = os.path.getmtime(snapshot_path)
+    except OSError:
+        return False
+
+    for path in (db_path, f"{db_path}-wal"):
+        try:
+            if os.path.getmtime(path) > snapshot_mtime:
+                return False
+        except OSError:
+            pass
+    return True
+
+
+def load_devices(db_path: str, registry: DeviceRegistry) -> int:
+    """Потоковое чтение устройств из devices"""
+    add = registry.add
+    loaded = skipped = 0
+
+    conn = sqlite3.connect(db_path)
+    try:
+        cursor = conn.execute(DEVICES_SQL)
+        while True:
+            rows = cursor.fetchmany(FETCH_SIZE)
+            if not rows:
+                break
+            for user_id, fp, ip, first_seen, last_seen, blocked in rows:
+                fp = stored_fingerprint(fp)
+                if fp is None:
+                    skipped += 1
+                    continue
+                record = DeviceRecord(
+                    fp,
+                    sys.intern(ip) if ip else ip,
+                    0,
+                    first_seen or 0,
+                    last_seen or first_seen or 0
+                )
+                record.blocked = bool(blocked)
+                add(user_id, record)
+                loaded += 1
+    except sqlite3.OperationalError as e:
+        # Таблиц еще нет - первый запуск
+        print(f"State restore skipped: {e}")
+    finally:
+        conn.close()
+
+    if skipped:
+        print(f"State restore: {skipped} devices with unreadable fingerprints skipped")
+    return loaded
+
+
+def load_limits(db_path: str) -> Dict[str, int]:
+    """Итоговые лимиты устройств: user uuid -> лимит"""
+    conn = sqlite3.connect(db_path)
+    try:
+        return {uuid: limit for uuid, limit in conn.execute(LIMITS_SQL) if uuid}
+    except sqlite3.OperationalError as e:
+        print(f"Limits restore skipped: {e}")
+        return {}
+    finally:
+        conn.close()
+
+
+def load_user_limit(db_path: str, user_id: str) -> Optional[int]:
+    """Итоговый лимит одного пользователя; None - пользователя нет в БД"""
+    conn = sqlite3.connect(db_path)
+    try:
+        row = conn.execute(USER_LIMIT_SQL, (user_id,)).fetchone()
+        return row[0] if row else None
+    except sqlite3.OperationalError as e:
+        print(f"Limit reload skipped: {e}")
+        return None
+    finally:
+        conn.close()
+
+
+def load_plans(db_path: str) -> Dict[str, str]:
+    """Тарифы пользователей: user uuid -> тариф (таймаут простоя устройств)"""
+    conn = sqlite3.connect(db_path)
+    try:
+        return {uuid: plan for uuid, plan in conn.execute(PLANS_SQL) if uuid}
+    except sqlite3.OperationalError as e:
+        print(f"Plans restore skipped: {e}")
+        return {}
+    finally:
+        conn.close()
+
+
+def load_blocked_ips(db_path: str) -> Optional[Dict[str, List[str]]]:
+    """Заблокированные IP: user uuid -> IP; None - состояние в БД прочитать нельзя"""
+    conn = sqlite3.connect(db_path)
+    try:
+        blocked: Dict[str, List[str]] = {}
+        for uuid, ip in conn.execute(BLOCKED_SQL):
+            if uuid:
+                blocked.setdefault(uuid, []).append(ip)
+        return blocked
+    except sqlite3.OperationalError as e:
+        print(f"Blocked IPs restore skipped: {e}")
+        return None
+    finally:
+        conn.close()
+
+
+def restore_state(db_path: str, registry: DeviceRegistry,
+                  snapshot_path: Optional[str] = None) -> dict:
+    """Заполнение registry из снимка или из БД; возвращает статистику загрузки"""
+    start = time.perf_counter()
+    source = 'db'
+    devices = 0
+
+    # Миллионы новых объектов запускают сборщик циклов снова и снова - отключаем на время загрузки
+    gc_was_enabled = gc.isenabled()
+    gc.disable()
+    try:
+        if snapshot_path and snapshot_is_fresh(snapshot_path, db_path):
+            try:
+                devices = registry.load_snapshot(snapshot_path)
+                source = 'snapshot'
+            except (OSError, EOFError, ValueError, TypeError) as e:
+                print(f"Snapshot ignored: {e}")
+                registry.clear()
+
+        if source == 'db':
+            devices = load_devices(db_path, registry)
+    finally:
+        if gc_was_enabled:
+            gc.enable()
+
+    return {
+        'source': source,
+        'devices': devices,
+        'seconds': time.perf_counter() - start
+    }
@@ -0,0 +1,338 @@
+# Асинхронный клиент StatsService xRay (grpc.aio) с постоянным каналом
+
+import asyncio
+from typing import Dict, Iterable, List, Optional, Set, Tuple
+
+import grpc
+
+SERVICE = 'xray.app.stats.command.StatsService'
+
+# Ответ QueryStats на 50k пользователей не помещается в лимит gRPC по умолчанию (4 МиБ)
+MAX_MESSAGE_SIZE = 64 * 1024 * 1024
+
+CHANNEL_OPTIONS = [
+    ('grpc.max_receive_message_length', MAX_MESSAGE_SIZE),
+    ('grpc.keepalive_time_ms', 30000),
+    ('grpc.keepalive_timeout_ms', 10000),
+    ('grpc.keepalive_permit_without_calls', 1),
+    # После перезапуска xRay переподключаемся за секунды, а не за минуты экспоненциальной паузы
+    ('grpc.initial_reconnect_backoff_ms', 500),
+    ('grpc.max_reconnect_backoff_ms', 5000),
+    # Свой пул подканалов: пересозданный канал подключается заново, а не ждет паузы
+    # общего с прежним каналом подканала
+    ('grpc.use_local_subchannel_pool', 1),
+]
+
+# Ответы больше этого разбираются в потоке, чтобы не держать event loop
+DECODE_IN_THREAD_BYTES = 64 * 1024
+
+# Ошибки, после которых канал пересоздается
+RECONNECT_CODES = (grpc.StatusCode.UNAVAILABLE, grpc.StatusCode.DEADLINE_EXCEEDED)
+
+
+# --- Кодек protobuf для сообщений app/stats/command/command.proto ---
+# Сообщений всего несколько, поэтому кодируем вручную, без сгенерированных _pb2
+
+def _varint(value: int) -> bytes:
+    value &= (1 << 64) - 1
+    out = bytearray()
+    while value > 0x7f:
+        out.append((value & 0x7f) | 0x80)
+        value >>= 7
+    out.append(value)
+    return bytes(out)
+
+
+def _string_field(number: int, value: str) -> bytes:
+    data = value.encode()
+    return _varint(number << 3 | 2) + _varint(len(data)) + data
+
+
+def _bool_field(number: int, value: bool) -> bytes:
+    return _varint(number << 3) + b'\x01' if value else b''
+
+
+def _int_field(number: int, value: int) -> bytes:
+    return _varint(number << 3) + _varint(value) if value else b''
+
+
+def _fields(data: bytes):
+    """Разбор сообщения: (номер поля, значение) - int для varint, bytes для строк"""
+    pos, end = 0, len(data)
+    while pos < end:
+        key, shift = 0, 0
+        while True:
+            byte = data[pos]
+            pos += 1
+            key |= (byte & 0x7f) << shift
+            shift += 7
+            if byte < 0x80:
+                break
+        number, wire_type = key >> 3, key & 7
+
+        if wire_type == 0:
+            value, shift = 0, 0
+            while True:
+                byte = data[pos]
+                pos += 1
+                value |= (byte & 0x7f) << shift
+                shift += 7
+                if byte < 0x80:
+                    break
+            if value >= 1 << 63:
+                value -= 1 << 64
+            yield number, value
+        elif wire_type == 2:
+            length, shift = 0, 0
+            while True:
+                byte = data[pos]
+                pos += 1
+                length |= (byte & 0x7f) << shift
+                shift += 7
+                if byte < 0x80:
+                    break
+            yield number, data[pos:pos + length]
+            pos += length
+        elif wire_type == 1:
+            pos += 8
+        elif wire_type == 5:
+            pos += 4
+        else:
+            raise ValueError(f"Unsupported wire type: {wire_type}")
+
+
+def encode_query_request(patterns: List[str], reset: bool = False) -> bytes:
+    """QueryStatsRequest {pattern=1, reset=2, patterns=3, regexp=4}"""
+    body = b''.join(_string_field(3, pattern) for pattern in patterns)
+    return body + _bool_field(2, reset)
+
+
+def decode_query_request(data: bytes) -> Tuple[List[str], bool]:
+    patterns, reset = [], False
+    for number, value in _fields(data):
+        if number in (1, 3):
+            patterns.append(value.decode())
+        elif number == 2:
+            reset = bool(value)
+    return patterns, reset
+
+
+def encode_stats(stats: Iterable[Tuple[str, int]]) -> bytes:
+    """QueryStatsResponse {repeated Stat stat=1}, Stat {name=1, value=2}"""
+    out = []
+    for name, value in stats:
+        stat = _string_field(1, name) + _int_field(2, value)
+        out.append(_varint(1 << 3 | 2) + _varint(len(stat)) + stat)
+    return b''.join(out)
+
+
+def decode_stats(data: bytes) -> List[Tuple[str, int]]:
+    stats = []
+    for number, stat in _fields(data):
+        if number != 1:
+            continue
+        name, value = '', 0
+        for field, field_value in _fields(stat):
+            if field == 1:
+                name = field_value.decode()
+            elif field == 2:
+                value = field_value
+        stats.append((name, value))
+    return stats
+
+
+def encode_get_request(name: str, reset: bool = False) -> bytes:
+    """GetStatsRequest {name=1, reset=2}"""
+    return _string_field(1, name) + _bool_field(2, reset)
+
+
+def decode_get_request(data: bytes) -> Tuple[str, bool]:
+    name, reset = '', False
+    for number, value in _fields(data):
+        if number == 1:
+            name = value.decode()
+        elif number == 2:
+            reset = bool(value)
+    return name, reset
+
+
+def encode_ip_list(name: str, ips: Dict[str, int]) -> bytes:
+    """GetStatsOnlineIpListResponse {name=1, map<string, int64> ips=2}"""
+    out = [_string_field(1, name)]
+    for ip, last_seen in ips.items():
+        entry = _string_field(1, ip) + _int_field(2, last_seen)
+        out.append(_varint(2 << 3 | 2) + _varint(len(entry)) + entry)
+    return b''.join(out)
+
+
+def decode_ip_list(data: bytes) -> Dict[str, int]:
+    ips = {}
+    for number, entry in _fields(data):
+        if number != 2:
+            continue
+        ip, last_seen = '', 0
+        for field, value in _fields(entry):
+            if field == 1:
+                ip = value.decode()
+            elif field == 2:
+                last_seen = value
+        ips[ip] = last_seen
+    return ips
+
+
+def encode_names(names: Iterable[str]) -> bytes:
+    """GetAllOnlineUsersResponse {repeated string users=1}"""
+    return b''.join(_string_field(1, name) for name in names)
+
+
+def decode_names(data: bytes) -> List[str]:
+    return [value.decode() for number, value in _fields(data) if number == 1]
+
+
+def _identity(data: bytes) -> bytes:
+    return data
+
+
+class StatsClient:
+    """Один grpc.aio канал на все опросы StatsService.
+
+    poll_user_traffic() возвращает приращения трафика по пользователям
+    с прошлого опроса. По умолчанию их считает клиент по запомненным
+    значениям: счетчики xRay общие, и reset=True (обнуление при чтении)
+    отнимает трафик у других потребителей статистики.
+    """
+
+    def __init__(self, address: str = 'localhost:10085', timeout: float = 5.0,
+                 reset: bool = False, batch_size: int = 500, concurrency: int = 64):
+        self.address = address
+        self.timeout = timeout
+        self.reset = reset
+        self.batch_size = batch_size
+        self.concurrency = concurrency
+
+        self._channel: Optional[grpc.aio.Channel] = None
+        self._lock = asyncio.Lock()
+        self._counters: Dict[str, int] = {}  # имя счетчика -> последнее значение (reset=False)
+        self.stats = {'polls': 0, 'reconnects': 0, 'errors': 0}
+
+    async def _get_channel(self) -> grpc.aio.Channel:
+        if self._channel is None:
+            async with self._lock:
+                if self._channel is None:
+                    self._channel = grpc.aio.insecure_channel(self.address, options=CHANNEL_OPTIONS)
+        return self._channel
+
+    async def _reconnect(self, broken: grpc.aio.Channel):
+        async with self._lock:
+            # Параллельные вызовы на том же канале пересоздают его только один раз
+            if self._channel is not broken:
+                return
+            self._channel = None
+        await broken.close()
+        self.stats['reconnects'] += 1
+
+    async def _call(self, method: str, request: bytes) -> bytes:
+        """Унарный вызов; при обрыве канал пересоздается и вызов повторяется один раз"""
+        for attempt in range(2):
+            channel = await self._get_channel()
+            call = channel.unary_unary(
+                f'/{SERVICE}/{method}',
+                request_serializer=_identity,
+                response_deserializer=_identity
+            )
+            try:
+                return await call(request, timeout=self.timeout)
+            except grpc.aio.AioRpcError as e:
+                if e.code() not in RECONNECT_CODES or attempt:
+                    self.stats['errors'] += 1
+                    raise
+                await self._reconnect(channel)
+
+    async def query_stats(self, patterns: List[str], reset: bool = False) -> Dict[str, int]:
+        """QueryStats пачками по batch_size шаблонов (совпадение по подстроке)"""
+        batches = [
+            patterns[i:i + self.batch_size]
+            for i in range(0, len(patterns), self.batch_size)
+        ]
+        responses = await asyncio.gather(*(
+            self._call('QueryStats', encode_query_request(batch, reset))
+            for batch in batches
+        ))
+
+        result = {}
+        for response in responses:
+            if len(response) > DECODE_IN_THREAD_BYTES:
+                result.update(await asyncio.to_thread(decode_stats, response))
+            else:
+                result.update(decode_stats(response))
+        return result
+
+    async def poll_user_traffic(self, users: Optional[List[str]] = None) -> Dict[str, List[int]]:
+        """Приращения трафика: user -> [uplink, downlink]"""
+        patterns = [f'user>>>{user}>>>' for user in users] if users else ['user>>>']
+        counters = await self.query_stats(patterns, reset=self.reset)
+        self.stats['polls'] += 1
+
+        deltas: Dict[str, List[int]] = {}
+        previous = self._counters
+        for name, value in counters.items():
+            # user>>>{email}>>>traffic>>>uplink
+            parts = name.split('>>>')
+            if len(parts) != 4 or parts[2] != 'traffic':
+                continue
+
+            delta = value
+            if not self.reset:
+                last = previous.get(name)
+                previous[name] = value
+                # Меньше прошлого значения - xRay перезапускался
+                if last is not None and value >= last:
+                    delta = value - last
+
+            traffic = deltas.get(parts[1])
+            if traffic is None:
+                traffic = deltas[parts[1]] = [0, 0]
+            traffic[0 if parts[3] == 'uplink' else 1] += delta
+
+        return deltas
+
+    async def online_users(self) -> Optional[Set[str]]:
+        """Пользователи с активными IP (GetAllOnlineUsers); None, если xRay его не поддерживает"""
+        try:
+            response = await self._call('GetAllOnlineUsers', b'')
+        except grpc.aio.AioRpcError as e:
+            if e.code() == grpc.StatusCode.UNIMPLEMENTED:
+                return None
+            raise
+
+        users = set()
+        for name in decode_names(response):
+            # user>>>{email}>>>online
+            parts = name.split('>>>')
+            users.add(parts[1] if len(parts) == 3 else name)
+        return users
+
+    async def online_ips(self, users: Iterable[str]) -> Dict[str, List[str]]:
+        """Активные IP пользователей (GetStatsOnlineIpList, нужен statsUserOnline)"""
+        semaphore = asyncio.Semaphore(self.concurrency)
+
+        async def fetch(user: str):
+            async with semaphore:
+                try:
+                    response = await self._call(
+                        'GetStatsOnlineIpList', encode_get_request(f'user>>>{user}>>>online')
+                    )
+                except grpc.aio.AioRpcError as e:
+                    # У пользователя нет онлайн-счетчика - он не подключен
+                    if e.code() == grpc.StatusCode.UNKNOWN:
+                        return user, []
+                    raise
+                return user, list(decode_ip_list(response))
+
+        return dict(await asyncio.gather(*(fetch(user) for user in users)))
+
+    async def close(self):
+        async with self._lock:
+            channel, self._channel = self._channel, None
+        if channel is not None:
+            await channel.close()
@@ -0,0 +1,2 @@
+# Модули, общие для обоих вариантов: реестр устройств, отпечатки, метрики,
+# правила маршрутизации, outbox уведомлений, кластер, HTTP-клиент, нагрузочные стенды
@@ -0,0 +1,293 @@
+# Общие лимиты устройств для нескольких узлов xRay
+
+import asyncio
+import sqlite3
+from abc import ABC, abstractmethod
+import time
+from typing import Dict, Iterable, List, Optional, Set, Tuple
+
+try:
+    import redis.asyncio as aioredis
+except ImportError:  # кластер на Redis - необязательная зависимость
+    aioredis = None
+
+# (user_id, устройство, код ОС, first_seen)
+PresenceRow = Tuple[str, bytes, int, int]
+# (узел, устройство, код ОС, first_seen)
+RemoteRow = Tuple[str, bytes, int, int]
+
+# Общий пустой словарь для пользователей без устройств на других узлах (не изменять)
+_NO_DEVICES: Dict[bytes, Tuple[int, int]] = {}
+
+
+class PresenceStore(ABC):
+    """Общее хранилище присутствия устройств: кто, на каком узле, с какого времени.
+
+    Записи живут до expires_at; узел продлевает свои записи heartbeat'ом,
+    поэтому упавший узел перестает занимать слоты сам собой.
+    """
+
+    @abstractmethod
+    async def publish(self, node_id: str, upserts: List[PresenceRow],
+                      removals: List[Tuple[str, bytes]], expires_at: float):
+        """Записи узла: новые и продленные до expires_at, снятые устройства"""
+
+    @abstractmethod
+    async def fetch(self, user_ids: List[str], now: float) -> Dict[str, List[RemoteRow]]:
+        """Действующие на now записи пользователей со всех узлов"""
+
+    async def close(self):
+        pass
+
+
+class SQLitePresenceStore(PresenceStore):
+    """Общий файл SQLite (узлы на одной машине, тесты)"""
+
+    SCHEMA = """
+    CREATE TABLE IF NOT EXISTS device_presence (
+        user_id VARCHAR(36) NOT NULL,
+        node_id VARCHAR(64) NOT NULL,
+        device BLOB NOT NULL,
+        os_code INTEGER NOT NULL DEFAULT 0,
+        first_seen INTEGER NOT NULL,
+        expires_at REAL NOT NULL,
+        PRIMARY KEY (user_id, node_id, device)
+    );
+    CREATE INDEX IF NOT EXISTS idx_presence_expires ON device_presence(expires_at);
+    """
+
+    UPSERT_SQL = """
+    INSERT INTO device_presence (user_id, node_id, device, os_code, first_seen, expires_at)
+    VALUES (?, ?, ?, ?, ?, ?)
+    ON CONFLICT(user_id, node_id, device) DO UPDATE SET expires_at = excluded.expires_at
+    """
+
+    FETCH_BATCH = 500
+
+    def __init__(self, path: str):
+        self.path = path
+        self._conn: Optional[sqlite3.Connection] = None
+
+    def _connect(self) -> sqlite3.Connection:
+        if self._conn is None:
+            self._conn = sqlite3.connect(self.path, timeout=5, check_same_thread=False)
+            self._conn.execute('PRAGMA journal_mode=WAL')
+            self._conn.executescript(self.SCHEMA)
+        return self._conn
+
+    def _publish(self, node_id, upserts, removals, expires_at):
+        conn = self._connect()
+        with conn:
+            conn.executemany(self.UPSERT_SQL, [
+                (user_id, node_id, device, os_code, first_seen, expires_at)
+                for user_id, device, os_code, first_seen in upserts
+            ])
+            conn.executemany(
+                "DELETE FROM device_presence WHERE user_id = ? AND node_id = ? AND device = ?",
+                [(user_id, node_id, device) for user_id, device in removals]
+            )
+            # Записи упавших узлов
+            conn.execute("DELETE FROM device_presence WHERE expires_at < ?", (time.time(),))
+
+    def _fetch(self, user_ids, now):
+        conn = self._connect()
+        result: Dict[str, List[RemoteRow]] = {user_id: [] for user_id in user_ids}
+        for i in range(0, len(user_ids), self.FETCH_BATCH):
+            batch = user_ids[i:i + self.FETCH_BATCH]
+            rows = conn.execute(
+                "SELECT user_id, node_id, device, os_code, first_seen FROM device_presence "
+                f"WHERE expires_at >= ? AND user_id IN ({','.join('?' * len(batch))})",
+                (now, *batch)
+            )
+            for user_id, node_id, device, os_code, first_seen in rows:
+                result[user_id].append((node_id, bytes(device), os_code, first_seen))
+        return result
+
+    async def publish(self, node_id, upserts, removals, expires_at):
+        await asyncio.to_thread(self._publish, node_id, upserts, removals, expires_at)
+
+    async def fetch(self, user_ids, now):
+        return await asyncio.to_thread(self._fetch, user_ids, now)
+
+    async def close(self):
+        if self._conn is not None:
+            self._conn.close()
+            self._conn = None
+
+
+class RedisPresenceStore(PresenceStore):
+    """Redis (или совместимый сервер): хэш presence:{user} с полями node|device"""
+
+    def __init__(self, url: str = 'redis://localhost:6379/0', prefix: str = 'presence:'):
+        if aioredis is None:
+            raise RuntimeError("Redis presence store requires the 'redis' package")
+        self.redis = aioredis.from_url(url)
+        self.prefix = prefix
+
+    async def publish(self, node_id, upserts, removals, expires_at):
+        ttl = max(1, int(expires_at - time.time()) * 2)
+        node = node_id.encode()
+        pipe = self.redis.pipeline(transaction=False)
+        for user_id, device, os_code, first_seen in upserts:
+            key = self.prefix + user_id
+            pipe.hset(key, node + b'|' + device.hex().encode(), f"{os_code}:{first_seen}:{expires_at}")
+            pipe.expire(key, ttl)
+        for user_id, device in removals:
+            pipe.hdel(self.prefix + user_id, node + b'|' + device.hex().encode())
+        await pipe.execute()
+
+    async def fetch(self, user_ids, now):
+        pipe = self.redis.pipeline(transaction=False)
+        for user_id in user_ids:
+            pipe.hgetall(self.prefix + user_id)
+        replies = await pipe.execute()
+
+        result: Dict[str, List[RemoteRow]] = {}
+        for user_id, fields in zip(user_ids, replies):
+            rows = result[user_id] = []
+            for field, value in fields.items():
+                node, _, device = field.decode().partition('|')
+                os_code, first_seen, expires_at = value.decode().split(':')
+                if float(expires_at) >= now:
+                    rows.append((node, bytes.fromhex(device), int(os_code), int(first_seen)))
+        return result
+
+    async def close(self):
+        await self.redis.close()
+
+
+def open_presence_store(url: str) -> PresenceStore:
+    """sqlite:///path/presence.db или redis://host:port/db"""
+    if url.startswith('sqlite:///'):
+        return SQLitePresenceStore(url[len('sqlite:///'):])
+    if url.startswith(('redis://', 'rediss://', 'unix://')):
+        return RedisPresenceStore(url)
+    raise ValueError(f"Unsupported presence store: {url}")
+
+
+class ClusterPresence:
+    """Локальная сторона кластерного режима.
+
+    Изменения устройств узла копятся и уходят в хранилище пачкой за тик
+    (плюс heartbeat всех своих записей раз в ttl/3). Устройства других
+    узлов читаются пачкой по пользователям с истекшей арендой и до ее
+    конца отдаются из кэша - проверка подключения в сеть не ходит.
+    """
+
+    def __init__(self, store: PresenceStore, node_id: str, lease: float = 5.0, ttl: float = 60.0):
+        self.store = store
+        self.node_id = node_id
+        self.lease = lease
+        self.ttl = ttl
+
+        self._local: Dict[Tuple[str, bytes], Tuple[int, int]] = {}  # свои устройства -> (ОС, first_seen)
+        self._added: Set[Tuple[str, bytes]] = set()
+        self._removed: Set[Tuple[str, bytes]] = set()
+        self._last_heartbeat = 0.0
+
+        # user_id -> (истечение аренды, устройства других узлов, версия)
+        self._remote: Dict[str, Tuple[float, Dict[bytes, Tuple[int, int]], int]] = {}
+        # Версии из общего счетчика: запись, удаленная и полученная заново, не повторит старую
+        self._version = 0
+        self._next_prune = 0.0
+        self.stats = {'published': 0, 'fetched_users': 0, 'fetches': 0}
+
+    def add(self, user_id: str, device: bytes, os_code: int = 0, first_seen: int = 0):
+        key = (user_id, device)
+        if key not in self._local:
+            self._local[key] = (os_code, first_seen)
+            self._added.add(key)
+            self._removed.discard(key)
+
+    def remove(self, user_id: str, device: bytes):
+        key = (user_id, device)
+        if self._local.pop(key, None) is not None:
+            self._added.discard(key)
+            self._removed.add(key)
+
+    async def flush(self, now: Optional[float] = None):
+        """Публикация изменений узла (и heartbeat, если пора)"""
+        now = now if now is not None else time.time()
+        if now - self._last_heartbeat >= self.ttl / 3:
+            keys: Iterable[Tuple[str, bytes]] = list(self._local)
+            self._last_heartbeat = now
+        else:
+            keys = self._added
+        if not keys and not self._removed:
+            return
+
+        upserts = [(user_id, device, *self._local[(user_id, device)]) for user_id, device in keys]
+        removals = list(self._removed)
+        self._added, self._removed = set(), set()
+        try:
+            await self.store.publish(self.node_id, upserts, removals, now + self.ttl)
+        except Exception:
+            # Не потерять дельту: повторим на следующем тике
+            self._added.update(key for key in keys if key in self._local)
+            self._removed.update(removals)
+            raise
+        self.stats['published'] += len(upserts) + len(removals)
+
+    async def prefetch(self, user_ids: Iterable[str], now: Optional[float] = None):
+        """Одним запросом обновить кэш пользователей, у которых истекла аренда"""
+        now = now if now is not None else time.time()
+        self.prune(now)
+        remote = self._remote
+        stale = [user_id for user_id in user_ids
+                 if user_id not in remote or remote[user_id][0] <= now]
+        if not stale:
+            return
+
+        fetched = await self.store.fetch(stale, now)
+        self.stats['fetches'] += 1
+        self.stats['fetched_users'] += len(stale)
+
+        expires = now + self.lease
+        for user_id in stale:
+            devices = {
+                device: (first_seen, os_code)
+                for node_id, device, os_code, first_seen in fetched.get(user_id, ())
+                if node_id != self.node_id
+            }
+            previous = remote.get(user_id)
+            if previous is None:
+                version = self._next_version() if devices else 0
+            elif previous[1] != devices:
+                version = self._next_version()
+            else:
+                version = previous[2]
+            remote[user_id] = (expires, devices or _NO_DEVICES, version)
+
+    def prune(self, now: float):
+        """Удаление записей с истекшей арендой (раз в lease): кэш не растет со всеми пользователями"""
+        if now < self._next_prune:
+            return
+        self._next_prune = now + self.lease
+        remote = self._remote
+        for user_id in [user_id for user_id, entry in remote.items() if entry[0] <= now]:
+            del remote[user_id]
+
+    def _next_version(self) -> int:
+        self._version += 1
+        return self._version
+
+    def remote_devices(self, user_id: str) -> Dict[bytes, Tuple[int, int]]:
+        """Устройства пользователя на других узлах: устройство -> (first_seen, код ОС)"""
+        entry = self._remote.get(user_id)
+        return entry[1] if entry is not None else {}
+
+    def version(self, user_id: str) -> int:
+        """Меняется, когда меняется набор устройств пользователя на других узлах"""
+        entry = self._remote.get(user_id)
+        return entry[2] if entry is not None else 0
+
+    async def close(self):
+        self._last_heartbeat = 0.0
+        # Свои записи снимаем сразу, не дожидаясь истечения TTL
+        self._removed.update(self._local)
+        self._local.clear()
+        self._added.clear()
+        try:
+            await self.flush()
+        finally:
+            await self.store.close()
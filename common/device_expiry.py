@@ -0,0 +1,86 @@
+# Освобождение слотов неактивных устройств: min-heap по last_seen
+
+import heapq
+import time
+from typing import Dict, List, Optional, Tuple
+
+from .device_registry import DeviceRecord, DeviceRegistry
+
+DEFAULT_IDLE_TIMEOUT = 6 * 3600
+
+
+class IdleExpiry:
+    """Очередь истечения простоя устройств из DeviceRegistry.
+
+    В куче лежит (срок, user_id, fingerprint). Обновление last_seen кучу не
+    трогает: при извлечении срок пересчитывается по записи, и если
+    устройство было активно, элемент возвращается в кучу с новым сроком.
+    Так касание стоит O(1), а истечение - O(log n).
+    """
+
+    def __init__(self, registry: DeviceRegistry, default_timeout: float = DEFAULT_IDLE_TIMEOUT,
+                 plan_timeouts: Optional[Dict[str, float]] = None):
+        self.registry = registry
+        self.default_timeout = default_timeout
+        self.plan_timeouts = dict(plan_timeouts or {})
+        self._plans: Dict[str, str] = {}  # user_id -> тариф
+        self._heap: List[Tuple[float, str, bytes]] = []
+        self._compact_at = 1024
+
+    def set_plan(self, user_id: str, plan: Optional[str]):
+        """Тариф пользователя определяет его таймаут простоя"""
+        if plan is None:
+            self._plans.pop(user_id, None)
+        else:
+            self._plans[user_id] = plan
+
+    def timeout(self, user_id: str) -> float:
+        plan = self._plans.get(user_id)
+        if plan is None:
+            return self.default_timeout
+        return self.plan_timeouts.get(plan, self.default_timeout)
+
+    def track(self, user_id: str, record: DeviceRecord):
+        """Новое устройство в реестре"""
+        heapq.heappush(
+            self._heap, (record.last_seen + self.timeout(user_id), user_id, record.fingerprint)
+        )
+
+    def track_all(self):
+        """Все устройства реестра (после восстановления состояния)"""
+        self._heap = [
+            (record.last_seen + self.timeout(user_id), user_id, record.fingerprint)
+            for user_id in self.registry.users()
+            for record in self.registry.devices(user_id)
+        ]
+        heapq.heapify(self._heap)
+        self._compact_at = 2 * len(self._heap) + 1024
+
+    def expire(self, now: Optional[float] = None) -> List[Tuple[str, DeviceRecord]]:
+        """Удаление из реестра устройств, простаивающих дольше таймаута тарифа"""
+        now = now if now is not None else time.time()
+        heap = self._heap
+        expired = []
+
+        while heap and heap[0][0] <= now:
+            _, user_id, fp = heapq.heappop(heap)
+            record = self.registry.get(user_id, fp)
+            if record is None:
+                continue  # устройство уже удалено другим путем
+
+            deadline = record.last_seen + self.timeout(user_id)
+            if deadline > now:
+                heapq.heappush(heap, (deadline, user_id, fp))
+                continue
+
+            self.registry.remove(user_id, fp)
+            expired.append((user_id, record))
+
+        # Записи об удаленных другим путем устройствах копятся до своего срока - чистим при разрастании
+        if len(heap) > self._compact_at:
+            self.track_all()
+
+        return expired
+
+    def __len__(self) -> int:
+        return len(self._heap)
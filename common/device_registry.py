@@ -0,0 +1,175 @@
+# Компактное хранилище состояния устройств для 100k+ пользователей
+
+import marshal
+import os
+import sys
+import time
+from datetime import datetime
+from typing import Callable, Dict, Iterator, List, Optional, Tuple
+
+_TIME_BITS = 32
+_TIME_MASK = (1 << _TIME_BITS) - 1
+
+SNAPSHOT_VERSION = 1
+
+
+def _intern(value: Optional[str]) -> Optional[str]:
+    return sys.intern(value) if value else value
+
+
+class DeviceRecord:
+    """Запись об устройстве без __dict__.
+
+    Оба времени (unix-секунды) упакованы в одно целое, IP интернирован,
+    тип ОС хранится кодом (см. OS_CODES в варианте с ОС).
+    """
+
+    __slots__ = ('fingerprint', 'ip', 'os_code', 'blocked', '_times')
+
+    def __init__(self, fingerprint: bytes, ip: str, os_code: int, first_seen: int, last_seen: int):
+        self.fingerprint = fingerprint
+        self.ip = ip
+        self.os_code = os_code
+        self.blocked = False
+        self._times = (first_seen << _TIME_BITS) | last_seen
+
+    @property
+    def first_seen(self) -> int:
+        return self._times >> _TIME_BITS
+
+    @property
+    def last_seen(self) -> int:
+        return self._times & _TIME_MASK
+
+    def touch(self, now: int):
+        self._times = (self._times & ~_TIME_MASK) | now
+
+    @property
+    def first_seen_dt(self) -> datetime:
+        return datetime.fromtimestamp(self.first_seen)
+
+    @property
+    def last_seen_dt(self) -> datetime:
+        return datetime.fromtimestamp(self.last_seen)
+
+    def __repr__(self):
+        return (f"DeviceRecord(ip={self.ip!r}, os_code={self.os_code}, "
+                f"first_seen={self.first_seen}, last_seen={self.last_seen}, blocked={self.blocked})")
+
+
+class DeviceRegistry:
+    """user_id -> список DeviceRecord.
+
+    У пользователя единицы устройств, поэтому список с линейным поиском
+    занимает в разы меньше памяти, чем dict на каждого пользователя.
+    """
+
+    def __init__(self):
+        self._users: Dict[str, List[DeviceRecord]] = {}
+
+    def get(self, user_id: str, fingerprint: bytes) -> Optional[DeviceRecord]:
+        for record in self._users.get(user_id, ()):
+            if record.fingerprint == fingerprint:
+                return record
+        return None
+
+    def upsert(self, user_id: str, fingerprint: bytes, ip: str, os_code: int = 0,
+               now: Optional[int] = None) -> Tuple[DeviceRecord, bool]:
+        """Добавление или обновление устройства; второй элемент - создано ли новое"""
+        now = int(now if now is not None else time.time())
+
+        record = self.get(user_id, fingerprint)
+        if record is not None:
+            record.touch(now)
+            if record.ip != ip:
+                record.ip = _intern(ip)
+            return record, False
+
+        record = DeviceRecord(fingerprint, _intern(ip), os_code, now, now)
+        self.add(user_id, record)
+        return record, True
+
+    def add(self, user_id: str, record: DeviceRecord):
+        """Вставка готовой записи (например, при загрузке из БД)"""
+        devices = self._users.get(user_id)
+        if devices is None:
+            self._users[sys.intern(user_id)] = [record]
+        else:
+            devices.append(record)
+
+    def remove(self, user_id: str, fingerprint: bytes) -> Optional[DeviceRecord]:
+        devices = self._users.get(user_id)
+        if not devices:
+            return None
+        for i, record in enumerate(devices):
+            if record.fingerprint == fingerprint:
+                del devices[i]
+                if not devices:
+                    del self._users[user_id]
+                return record
+        return None
+
+    def retain(self, user_id: str, fingerprints) -> List[DeviceRecord]:
+        """Удаление устройств пользователя, которых нет в fingerprints"""
+        devices = self._users.get(user_id)
+        if not devices:
+            return []
+        removed = [record for record in devices if record.fingerprint not in fingerprints]
+        if removed:
+            devices[:] = [record for record in devices if record.fingerprint in fingerprints]
+            if not devices:
+                del self._users[user_id]
+        return removed
+
+    def count(self, user_id: str) -> int:
+        return len(self._users.get(user_id, ()))
+
+    def devices(self, user_id: str) -> List[DeviceRecord]:
+        return list(self._users.get(user_id, ()))
+
+    def by_os(self, user_id: str, os_code: int) -> List[DeviceRecord]:
+        return [record for record in self._users.get(user_id, ()) if record.os_code == os_code]
+
+    def users(self) -> Iterator[str]:
+        return iter(self._users)
+
+    def save_snapshot(self, path: str):
+        """Бинарный снимок состояния для быстрого старта (marshal)"""
+        rows = [
+            (user_id, r.fingerprint, r.ip, r.os_code, r._times, r.blocked)
+            for user_id, devices in self._users.items()
+            for r in devices
+        ]
+        tmp_path = f"{path}.tmp"
+        with open(tmp_path, 'wb') as f:
+            f.write(marshal.dumps((SNAPSHOT_VERSION, time.time(), rows)))
+        os.replace(tmp_path, path)
+
+    def load_snapshot(self, path: str, user_filter: Optional[Callable[[str], bool]] = None) -> int:
+        """Загрузка снимка (только пользователи, прошедшие user_filter); возвращает число устройств"""
+        # marshal.load(f) читает файл мелкими порциями - на порядок медленнее loads
+        with open(path, 'rb') as f:
+            version, _, rows = marshal.loads(f.read())
+        if version != SNAPSHOT_VERSION:
+            raise ValueError(f"Unsupported snapshot version: {version}")
+
+        loaded = 0
+        for user_id, fp, ip, os_code, times, blocked in rows:
+            if user_filter is not None and not user_filter(user_id):
+                continue
+            record = DeviceRecord(fp, _intern(ip), os_code, 0, 0)
+            record._times = times
+            record.blocked = blocked
+            self.add(user_id, record)
+            loaded += 1
+        return loaded
+
+    def clear(self):
+        self._users.clear()
+
+    def __contains__(self, user_id: str) -> bool:
+        return user_id in self._users
+
+    def __len__(self) -> int:
+        """Общее число устройств"""
+        return sum(len(devices) for devices in self._users.values())
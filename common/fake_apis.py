@@ -0,0 +1,116 @@
+# Локальные заглушки HTTP API xRay (routing) и Telegram Bot API для нагрузочных тестов
+
+import asyncio
+import time
+from typing import Dict, Optional
+
+from aiohttp import web
+
+
+class FakeHTTPService:
+    """Сервер aiohttp на 127.0.0.1 со случайным портом; адрес - в url после start()"""
+
+    def __init__(self, latency: float = 0.0):
+        self.latency = latency  # искусственная задержка ответа, секунды
+        self.url: Optional[str] = None
+        self.requests = 0
+        self._runner: Optional[web.AppRunner] = None
+
+    def routes(self) -> list:
+        raise NotImplementedError
+
+    async def start(self, host: str = '127.0.0.1', port: int = 0) -> str:
+        app = web.Application(client_max_size=64 * 1024 * 1024)
+        app.add_routes(self.routes())
+        self._runner = web.AppRunner(app, access_log=None)
+        await self._runner.setup()
+        site = web.TCPSite(self._runner, host, port)
+        await site.start()
+        port = self._runner.addresses[0][1]
+        self.url = f'http://{host}:{port}'
+        return self.url
+
+    async def close(self):
+        if self._runner is not None:
+            await self._runner.cleanup()
+            self._runner = None
+
+    async def _delay(self):
+        self.requests += 1
+        if self.latency:
+            await asyncio.sleep(self.latency)
+
+
+class FakeXRayAPI(FakeHTTPService):
+    """Правила routing xRay: одиночные и пакетные, хранятся по ruleTag"""
+
+    def __init__(self, latency: float = 0.0):
+        super().__init__(latency)
+        self.rules: Dict[str, dict] = {}
+        self.batches = 0
+
+    def routes(self) -> list:
+        return [
+            web.post('/v1/routing/rules', self.add_rule),
+            web.post('/v1/routing/rules/batch', self.apply_batch),
+        ]
+
+    async def add_rule(self, request: web.Request) -> web.Response:
+        await self._delay()
+        rule = await request.json()
+        self.rules[rule.get('ruleTag', str(len(self.rules)))] = rule
+        return web.json_response({'ok': True})
+
+    async def apply_batch(self, request: web.Request) -> web.Response:
+        await self._delay()
+        batch = await request.json()
+        self.batches += 1
+        for rule in batch.get('rules', ()):
+            self.rules[rule['ruleTag']] = rule
+        for tag in batch.get('removeRuleTags', ()):
+            self.rules.pop(tag, None)
+        return web.json_response({'ok': True, 'rules': len(self.rules)})
+
+    @property
+    def blocked_ips(self) -> int:
+        return sum(len(rule.get('source', ())) for rule in self.rules.values())
+
+
+class FakeTelegramAPI(FakeHTTPService):
+    """sendMessage Bot API; flood_every > 0 - каждый N-й запрос получает 429 с retry_after"""
+
+    def __init__(self, latency: float = 0.0, flood_every: int = 0, retry_after: int = 1):
+        super().__init__(latency)
+        self.flood_every = flood_every
+        self.retry_after = retry_after
+        self.messages: Dict[str, int] = {}  # chat_id -> число сообщений
+        self.flooded = 0
+        self._message_id = 0
+
+    def routes(self) -> list:
+        return [web.post('/bot{token}/sendMessage', self.send_message)]
+
+    async def send_message(self, request: web.Request) -> web.Response:
+        await self._delay()
+        if self.flood_every and self.requests % self.flood_every == 0:
+            self.flooded += 1
+            return web.json_response({
+                'ok': False,
+                'error_code': 429,
+                'description': f'Too Many Requests: retry after {self.retry_after}',
+                'parameters': {'retry_after': self.retry_after},
+            }, status=429)
+
+        payload = await request.json()
+        chat_id = str(payload.get('chat_id'))
+        self.messages[chat_id] = self.messages.get(chat_id, 0) + 1
+        self._message_id += 1
+        return web.json_response({
+            'ok': True,
+            'result': {'message_id': self._message_id, 'date': int(time.time()),
+                       'chat': {'id': payload.get('chat_id')}, 'text': payload.get('text', '')},
+        })
+
+    @property
+    def sent(self) -> int:
+        return sum(self.messages.values())
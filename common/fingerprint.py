@@ -0,0 +1,50 @@
+# Компактные отпечатки устройств: кортеж полей + blake2b с ключом
+
+import hashlib
+import os
+from functools import lru_cache
+from typing import Any, Optional, Tuple
+
+DIGEST_SIZE = 16  # 128 бит хватает для различения устройств, в БД это BLOB(16)
+
+# Ключ хеша должен быть постоянным, иначе после рестарта отпечатки не совпадут с БД
+FINGERPRINT_KEY = os.environ.get('DEVICE_FINGERPRINT_KEY', 'logic-vpn-device').encode()[:64]
+
+
+def canonical(value: Any) -> Any:
+    """Приведение значения поля к хешируемому виду (списки -> кортежи)"""
+    if isinstance(value, (list, tuple)):
+        return tuple(canonical(item) for item in value)
+    if isinstance(value, dict):
+        return tuple(sorted((key, canonical(item)) for key, item in value.items()))
+    return value
+
+
+@lru_cache(maxsize=65536)
+def fingerprint(fields: Tuple) -> bytes:
+    """16-байтный отпечаток для кортежа полей фиксированного порядка"""
+    return hashlib.blake2b(
+        repr(fields).encode(),
+        digest_size=DIGEST_SIZE,
+        key=FINGERPRINT_KEY
+    ).digest()
+
+
+def fingerprint_hex(fp: bytes) -> str:
+    """Hex-представление только для отображения и логов"""
+    return fp.hex()
+
+
+def stored_fingerprint(value: Any) -> Optional[bytes]:
+    """Отпечаток из БД: BLOB или hex-строка VARCHAR(64) баз до компактных отпечатков.
+
+    None - значение не разобрать (NULL, мусор), такую строку загрузчик пропускает.
+    """
+    if isinstance(value, (bytes, bytearray, memoryview)):
+        return bytes(value)
+    if isinstance(value, str):
+        try:
+            return bytes.fromhex(value)
+        except ValueError:
+            return None
+    return None
@@ -0,0 +1,64 @@
+# Общий HTTP клиент для xRay API и Telegram с пулом соединений
+
+import asyncio
+from typing import Optional
+
+import aiohttp
+
+
+class HTTPClient:
+    """Долгоживущая aiohttp сессия: keep-alive, лимиты на хост, таймауты"""
+
+    def __init__(self, limit: int = 100, limit_per_host: int = 20,
+                 keepalive_timeout: float = 60.0, total_timeout: float = 10.0,
+                 connect_timeout: float = 3.0):
+        self.limit = limit
+        self.limit_per_host = limit_per_host
+        self.keepalive_timeout = keepalive_timeout
+        self.timeout = aiohttp.ClientTimeout(total=total_timeout, connect=connect_timeout)
+        self._session: Optional[aiohttp.ClientSession] = None
+        self._lock = asyncio.Lock()
+
+    async def session(self) -> aiohttp.ClientSession:
+        """Сессия создается один раз и переиспользуется всеми вызовами"""
+        if self._session is None or self._session.closed:
+            async with self._lock:
+                if self._session is None or self._session.closed:
+                    connector = aiohttp.TCPConnector(
+                        limit=self.limit,
+                        limit_per_host=self.limit_per_host,
+                        keepalive_timeout=self.keepalive_timeout,
+                        ttl_dns_cache=300
+                    )
+                    self._session = aiohttp.ClientSession(
+                        connector=connector,
+                        timeout=self.timeout
+                    )
+        return self._session
+
+    async def post_json(self, url: str, payload: dict, check_status: bool = True) -> dict:
+        """POST с JSON телом, ответ разбирается как JSON.
+
+        Статус 4xx/5xx - aiohttp.ClientResponseError, чтобы вызывающий код не принял
+        ответ с ошибкой за успешное применение. check_status=False - для API, которые
+        сообщают об ошибке в теле (Bot API: ok=false и retry_after при 429).
+        """
+        session = await self.session()
+        async with session.post(url, json=payload) as resp:
+            if check_status:
+                resp.raise_for_status()
+            return await resp.json(content_type=None)
+
+    async def close(self):
+        if self._session is not None and not self._session.closed:
+            await self._session.close()
+            # Даем SSL соединениям корректно закрыться
+            await asyncio.sleep(0.25)
+        self._session = None
+
+    async def __aenter__(self):
+        await self.session()
+        return self
+
+    async def __aexit__(self, *exc):
+        await self.close()
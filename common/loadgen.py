@@ -0,0 +1,188 @@
+# Синтетическая нагрузка: пользователи, их устройства и строки access.log xRay
+#
+#   population = SyntheticPopulation(10000, devices_per_user=(1, 4), churn=0.01)
+#   lines = population.log_lines(20000)        # события для логовой модели (ОС-вариант)
+#   online = population.online_connections()   # текущие подключения (вариант по количеству)
+
+import json
+import random
+import time
+from datetime import datetime
+from typing import Dict, List, Optional, Tuple
+
+# ClientHello и TCP SYN типичных клиентов; согласованы с os_signatures.json
+OS_PROFILES = {
+    'ios': {
+        'ciphers': ['TLS_AES_128_GCM_SHA256', 'TLS_AES_256_GCM_SHA384', 'TLS_CHACHA20_POLY1305_SHA256'],
+        'extensions': ['0x0017', '0x0000', '0x0023', '0x002b', '0x000d'],
+        'curves': ['x25519', 'secp256r1', 'secp384r1'],
+        'version': 'TLS 1.3',
+        'ttl': [64],
+        'window_size': [65535, 131072],
+        'tcp_options': ['mss', 'sackOK', 'timestamps', 'nop', 'wscale'],
+        'sni': ['gateway.icloud.com', 'api.apple-cloudkit.com', 'www.google.com'],
+    },
+    'android': {
+        'ciphers': ['TLS_AES_128_GCM_SHA256', 'TLS_AES_256_GCM_SHA384',
+                    'TLS_ECDHE_ECDSA_WITH_AES_128_GCM_SHA256'],
+        'extensions': ['0x0000', '0x0017', '0x0010', '0x002b', '0x0033'],
+        'curves': ['x25519', 'secp256r1'],
+        'version': 'TLS 1.3',
+        'ttl': [64],
+        'window_size': [65535, 131072, 262144],
+        'tcp_options': ['mss', 'sackOK', 'timestamps', 'nop', 'wscale'],
+        'sni': ['android.googleapis.com', 'play.googleapis.com', 'www.google.com'],
+    },
+    'windows': {
+        'ciphers': ['TLS_ECDHE_RSA_WITH_AES_128_GCM_SHA256', 'TLS_ECDHE_RSA_WITH_AES_256_GCM_SHA384',
+                    'TLS_DHE_RSA_WITH_AES_128_GCM_SHA256'],
+        'extensions': ['0x0000', '0x0023', '0x0017', '0x0033', '0x000a'],
+        'curves': ['secp256r1', 'secp384r1'],
+        'version': 'TLS 1.2',
+        'ttl': [128],
+        'window_size': [65535, 8192],
+        'tcp_options': ['mss', 'nop', 'wscale', 'sackOK', 'timestamps'],
+        'sni': ['login.microsoftonline.com', 'www.bing.com', 'www.google.com'],
+    },
+    'macos': {
+        'ciphers': ['TLS_AES_128_GCM_SHA256', 'TLS_AES_256_GCM_SHA384', 'TLS_CHACHA20_POLY1305_SHA256'],
+        'extensions': ['0x0017', '0x0000', '0x0023', '0x0010', '0x002b'],
+        'curves': ['x25519', 'secp256r1', 'secp384r1', 'secp521r1'],
+        'version': 'TLS 1.3',
+        'ttl': [64],
+        'window_size': [65535, 131072],
+        'tcp_options': ['mss', 'nop', 'wscale', 'nop', 'nop', 'timestamps', 'sackOK'],
+        'sni': ['swscan.apple.com', 'www.icloud.com', 'www.google.com'],
+    },
+    'linux': {
+        'ciphers': ['TLS_AES_256_GCM_SHA384', 'TLS_CHACHA20_POLY1305_SHA256', 'TLS_AES_128_GCM_SHA256'],
+        'extensions': ['0x0000', '0x000b', '0x000a', '0x0023', '0x0016'],
+        'curves': ['x25519', 'secp256r1', 'x448'],
+        'version': 'TLS 1.3',
+        'ttl': [64],
+        'window_size': [64240, 29200],
+        'tcp_options': ['mss', 'sackOK', 'timestamps', 'nop', 'wscale'],
+        'sni': ['archive.ubuntu.com', 'github.com', 'www.google.com'],
+    },
+}
+
+DEFAULT_OS_MIX = {'android': 0.45, 'ios': 0.3, 'windows': 0.15, 'macos': 0.07, 'linux': 0.03}
+
+
+class SyntheticDevice:
+    """Устройство: ОС, адрес и заранее собранные блоки tls/tcp для строк лога"""
+
+    __slots__ = ('os_name', 'ip', 'port', 'sni', 'tls', 'tcp', 'tls_blob', 'tcp_blob')
+
+    def __init__(self, os_name: str, ip: str, rnd: random.Random):
+        profile = OS_PROFILES[os_name]
+        self.os_name = os_name
+        self.ip = ip
+        self.port = rnd.randint(1024, 65535)
+        self.sni = rnd.choice(profile['sni'])
+
+        # Браузеры перемешивают расширения ClientHello, а окно TCP зависит от модели и сети -
+        # этого хватает, чтобы устройства одной ОС давали разные отпечатки
+        extensions = list(profile['extensions'])
+        rnd.shuffle(extensions)
+        self.tls = {
+            'version': profile['version'],
+            'ciphers': profile['ciphers'],
+            'extensions': extensions,
+            'curves': profile['curves'],
+        }
+        self.tcp = {
+            'ttl': rnd.choice(profile['ttl']),
+            'window_size': rnd.choice(profile['window_size']),
+            'tcp_options': profile['tcp_options'],
+        }
+        self.tls_blob = json.dumps(self.tls, separators=(',', ':'))
+        self.tcp_blob = json.dumps(self.tcp, separators=(',', ':'))
+
+    def connection(self) -> dict:
+        """Подключение в виде, который получает XRayDeviceController"""
+        return {
+            'ip': self.ip,
+            'port': self.port,
+            'cipher': self.tls['ciphers'],
+            'sni': self.sni,
+            'alpn': ['h2', 'http/1.1'],
+            'tls': self.tls,
+            'tcp': self.tcp,
+        }
+
+
+class SyntheticPopulation:
+    """Пользователи с устройствами; churn - доля устройств, сменяющихся за шаг.
+
+    Сменившееся устройство получает новый адрес и новые блоки tls/tcp, то есть
+    для лимитера это новое устройство - отсюда повторные проверки и отклонения.
+    """
+
+    def __init__(self, users: int, devices_per_user: Tuple[int, int] = (1, 3),
+                 os_mix: Optional[Dict[str, float]] = None, churn: float = 0.01,
+                 online_share: float = 0.3, seed: Optional[int] = 1):
+        self.rnd = random.Random(seed)
+        mix = os_mix or DEFAULT_OS_MIX
+        self.os_names = list(mix)
+        self.os_weights = [mix[name] for name in self.os_names]
+        self.churn = churn
+        self.online_share = online_share
+        self._ip_counter = 0
+
+        self.user_ids = [f'user-{i:06d}@vpn' for i in range(users)]
+        self.devices: Dict[str, List[SyntheticDevice]] = {
+            user_id: [self._new_device() for _ in range(self.rnd.randint(*devices_per_user))]
+            for user_id in self.user_ids
+        }
+        # Плоский список (user_id, индекс устройства) для быстрого случайного выбора
+        self._slots = [(user_id, i) for user_id, devices in self.devices.items()
+                       for i in range(len(devices))]
+
+    def _next_ip(self) -> str:
+        self._ip_counter += 1
+        n = self._ip_counter
+        return f'10.{n >> 16 & 255}.{n >> 8 & 255}.{n & 255}'
+
+    def _new_device(self) -> SyntheticDevice:
+        os_name = self.rnd.choices(self.os_names, self.os_weights)[0]
+        return SyntheticDevice(os_name, self._next_ip(), self.rnd)
+
+    @property
+    def device_count(self) -> int:
+        return len(self._slots)
+
+    def step(self) -> int:
+        """Один шаг churn: часть устройств заменяется новыми; возвращает число замен"""
+        replaced = int(len(self._slots) * self.churn)
+        for user_id, i in self.rnd.sample(self._slots, replaced):
+            self.devices[user_id][i] = self._new_device()
+        return replaced
+
+    def log_lines(self, count: int, now: Optional[float] = None) -> List[str]:
+        """Строки access.log: подключения случайных устройств в формате parse_connection_log"""
+        stamp = datetime.fromtimestamp(now if now is not None else time.time())
+        second = stamp.strftime('%Y/%m/%d %H:%M:%S')
+        micro = stamp.microsecond
+        rnd = self.rnd
+        slots = self._slots
+        devices = self.devices
+        lines = []
+
+        for i in range(count):
+            user_id, index = slots[rnd.randrange(len(slots))]
+            device = devices[user_id][index]
+            lines.append(
+                f"{second}.{(micro + i) % 1000000:06d} from {device.ip}:{device.port} accepted "
+                f"tcp:{device.sni}:443 [vless-reality >> direct] email: {user_id} "
+                f"tls:{device.tls_blob} tcp:{device.tcp_blob}"
+            )
+        return lines
+
+    def online_connections(self) -> Dict[str, List[dict]]:
+        """Текущие подключения: у online_share пользователей онлайн все устройства"""
+        online = self.rnd.sample(self.user_ids, int(len(self.user_ids) * self.online_share))
+        return {
+            user_id: [device.connection() for device in self.devices[user_id]]
+            for user_id in online
+        }
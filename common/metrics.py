@@ -0,0 +1,291 @@
+# Метрики в формате Prometheus: дешевые счетчики на горячем пути и локальный /metrics
+
+import asyncio
+import math
+from bisect import bisect_left
+from typing import Callable, Dict, List, Optional, Sequence, Tuple
+
+# Границы гистограмм длительностей, секунды: от 100 мкс до 10 с
+DEFAULT_BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025,
+                   0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+# Стадии тика мониторинга
+STAGES = ('read', 'parse', 'detect', 'fingerprint', 'decide', 'enforce', 'notify')
+
+
+def _format_value(value: float) -> str:
+    if value == math.inf:
+        return '+Inf'
+    if isinstance(value, int) or value.is_integer():
+        return str(int(value))
+    return repr(value)
+
+
+def _escape(value: str) -> str:
+    return value.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _labels_text(names: Sequence[str], values: Sequence[str], extra: str = '') -> str:
+    pairs = [f'{name}="{_escape(str(value))}"' for name, value in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return '{' + ','.join(pairs) + '}' if pairs else ''
+
+
+class _CounterValue:
+    __slots__ = ('value',)
+
+    def __init__(self):
+        self.value = 0
+
+    def inc(self, amount: float = 1):
+        self.value += amount
+
+
+class _GaugeValue:
+    __slots__ = ('value', 'function')
+
+    def __init__(self):
+        self.value = 0
+        self.function: Optional[Callable[[], float]] = None
+
+    def set(self, value: float):
+        self.value = value
+
+    def inc(self, amount: float = 1):
+        self.value += amount
+
+    def dec(self, amount: float = 1):
+        self.value -= amount
+
+    def set_function(self, function: Callable[[], float]):
+        """Значение вычисляется при чтении /metrics, на горячем пути ничего не делается"""
+        self.function = function
+
+    def get(self) -> float:
+        if self.function is not None:
+            return self.function()
+        return self.value
+
+
+class _HistogramValue:
+    __slots__ = ('bounds', 'counts', 'sum')
+
+    def __init__(self, bounds: Tuple[float, ...]):
+        self.bounds = bounds
+        self.counts = [0] * (len(bounds) + 1)  # последний - +Inf
+        self.sum = 0.0
+
+    def observe(self, value: float):
+        # le в Prometheus граница включительная - это ровно bisect_left
+        self.counts[bisect_left(self.bounds, value)] += 1
+        self.sum += value
+
+
+class Metric:
+    """Метрика с необязательными метками; дочерние значения создаются по первому обращению.
+
+    Без меток методы значения (inc/set/observe) доступны прямо на метрике.
+    Для меток на горячем пути дочернее значение лучше получить один раз:
+    `parse_seconds = STAGE_SECONDS.labels('parse')`.
+    """
+
+    kind = 'untyped'
+
+    def __init__(self, name: str, documentation: str, labelnames: Sequence[str] = (),
+                 registry: Optional['Registry'] = None):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._children: Dict[Tuple[str, ...], object] = {}
+        if not self.labelnames:
+            self._bind(self.labels())
+        (registry if registry is not None else REGISTRY).register(self)
+
+    def _new_value(self):
+        raise NotImplementedError
+
+    def _bind(self, value):
+        pass
+
+    def labels(self, *values: str):
+        child = self._children.get(values)
+        if child is None:
+            if len(values) != len(self.labelnames):
+                raise ValueError(f"{self.name}: expected labels {self.labelnames}, got {values}")
+            child = self._children[values] = self._new_value()
+        return child
+
+    def render(self, out: List[str]):
+        out.append(f'# HELP {self.name} {_escape(self.documentation)}')
+        out.append(f'# TYPE {self.name} {self.kind}')
+        for values, child in list(self._children.items()):
+            self._render_child(out, values, child)
+
+    def _render_child(self, out: List[str], values: Tuple[str, ...], child):
+        raise NotImplementedError
+
+
+class Counter(Metric):
+    kind = 'counter'
+
+    def _new_value(self):
+        return _CounterValue()
+
+    def _bind(self, value: _CounterValue):
+        self.inc = value.inc
+
+    def _render_child(self, out, values, child):
+        out.append(f'{self.name}{_labels_text(self.labelnames, values)} {_format_value(child.value)}')
+
+
+class Gauge(Metric):
+    kind = 'gauge'
+
+    def _new_value(self):
+        return _GaugeValue()
+
+    def _bind(self, value: _GaugeValue):
+        self.set = value.set
+        self.inc = value.inc
+        self.dec = value.dec
+        self.set_function = value.set_function
+
+    def _render_child(self, out, values, child):
+        try:
+            value = child.get()
+        except Exception as e:
+            print(f"Metric {self.name} error: {e}")
+            return
+        out.append(f'{self.name}{_labels_text(self.labelnames, values)} {_format_value(value)}')
+
+
+class Histogram(Metric):
+    kind = 'histogram'
+
+    def __init__(self, name: str, documentation: str, labelnames: Sequence[str] = (),
+                 buckets: Sequence[float] = DEFAULT_BUCKETS, registry: Optional['Registry'] = None):
+        self.buckets = tuple(sorted(buckets))
+        super().__init__(name, documentation, labelnames, registry)
+
+    def _new_value(self):
+        return _HistogramValue(self.buckets)
+
+    def _bind(self, value: _HistogramValue):
+        self.observe = value.observe
+
+    def _render_child(self, out, values, child):
+        cumulative = 0
+        for bound, count in zip(self.buckets + (math.inf,), list(child.counts)):
+            cumulative += count
+            le = 'le="' + _format_value(bound) + '"'
+            out.append(f'{self.name}_bucket{_labels_text(self.labelnames, values, le)} {cumulative}')
+        labels = _labels_text(self.labelnames, values)
+        out.append(f'{self.name}_sum{labels} {_format_value(child.sum)}')
+        out.append(f'{self.name}_count{labels} {cumulative}')
+
+
+class Registry:
+    def __init__(self):
+        self._metrics: Dict[str, Metric] = {}
+
+    def register(self, metric: Metric):
+        if metric.name in self._metrics:
+            raise ValueError(f"Metric {metric.name} is already registered")
+        self._metrics[metric.name] = metric
+
+    def render(self) -> str:
+        out: List[str] = []
+        for metric in self._metrics.values():
+            metric.render(out)
+        return '\n'.join(out) + '\n'
+
+
+REGISTRY = Registry()
+
+TICK_SECONDS = Histogram('vpn_limiter_tick_seconds', 'Длительность тика мониторинга')
+STAGE_SECONDS = Histogram('vpn_limiter_stage_seconds', 'Время стадии за тик', ('stage',))
+LOG_LINES = Counter('vpn_limiter_log_lines_total', 'Прочитанные строки access.log')
+LOG_DISCARDED = Counter('vpn_limiter_log_lines_discarded_total',
+                        'Строки лога, отброшенные при приеме', ('reason',))
+CONNECTIONS = Counter('vpn_limiter_connections_total', 'Разобранные подключения')
+REJECTED = Counter('vpn_limiter_rejected_total', 'Подключения сверх лимита')
+ERRORS = Counter('vpn_limiter_errors_total', 'Ошибки фоновых циклов', ('loop',))
+QUEUE_DEPTH = Gauge('vpn_limiter_queue_depth', 'Глубина внутренних очередей', ('queue',))
+PIPELINE_BLOCKED = Counter('vpn_limiter_pipeline_blocked_seconds_total',
+                           'Время ожидания места в очереди стадии', ('stage',))
+CACHE_HIT_RATIO = Gauge('vpn_limiter_cache_hit_ratio', 'Доля попаданий в кэш', ('cache',))
+USERS_AT_LIMIT = Gauge('vpn_limiter_users_at_limit', 'Пользователи, занявшие все слоты устройств')
+
+
+def stage_timings() -> Dict[str, float]:
+    """Пустые накопители времени стадий на один тик"""
+    return dict.fromkeys(STAGES, 0.0)
+
+
+def observe_tick(seconds: float, stages: Dict[str, float]):
+    """Запись тика: общее время и время каждой стадии (один раз за тик, не на событие)"""
+    TICK_SECONDS.observe(seconds)
+    for stage, stage_seconds in stages.items():
+        STAGE_SECONDS.labels(stage).observe(stage_seconds)
+
+
+def hit_ratio(hits: int, misses: int) -> float:
+    total = hits + misses
+    return hits / total if total else 0.0
+
+
+class MetricsServer:
+    """Минимальный HTTP-сервер: GET /metrics отдает REGISTRY в текстовом формате"""
+
+    CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+    def __init__(self, host: str = '127.0.0.1', port: int = 9108,
+                 registry: Optional[Registry] = None, timeout: float = 5.0):
+        self.host = host
+        self.port = port
+        self.registry = registry if registry is not None else REGISTRY
+        self.timeout = timeout
+        self._server: Optional[asyncio.AbstractServer] = None
+
+    async def start(self):
+        self._server = await asyncio.start_server(self._handle, self.host, self.port)
+        # port=0 - порт выбирает ОС
+        self.port = self._server.sockets[0].getsockname()[1]
+
+    async def close(self):
+        if self._server is not None:
+            self._server.close()
+            await self._server.wait_closed()
+            self._server = None
+
+    async def _handle(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        try:
+            request = await asyncio.wait_for(reader.readline(), self.timeout)
+            # Заголовки запроса не нужны - дочитываем до пустой строки
+            while True:
+                line = await asyncio.wait_for(reader.readline(), self.timeout)
+                if line in (b'\r\n', b'\n', b''):
+                    break
+
+            parts = request.split()
+            method = parts[0] if parts else b''
+            path = parts[1].split(b'?', 1)[0] if len(parts) > 1 else b''
+            if method in (b'GET', b'HEAD') and path == b'/metrics':
+                status, body = '200 OK', self.registry.render().encode()
+            else:
+                status, body = '404 Not Found', b'Not Found\n'
+
+            writer.write(
+                f'HTTP/1.1 {status}\r\n'
+                f'Content-Type: {self.CONTENT_TYPE}\r\n'
+                f'Content-Length: {len(body)}\r\n'
+                'Connection: close\r\n\r\n'.encode()
+            )
+            if method != b'HEAD':
+                writer.write(body)
+            await writer.drain()
+        except (asyncio.TimeoutError, ConnectionError):
+            pass
+        finally:
+            writer.close()
@@ -0,0 +1,186 @@
+# Очередь исходящих уведомлений Telegram с ограничением частоты
+
+import asyncio
+import heapq
+import itertools
+import time
+from typing import Any, Awaitable, Callable, Dict, List, Optional, Set, Tuple
+
+# Лимиты Bot API: ~30 сообщений в секунду всего и ~1 в секунду в один чат
+GLOBAL_RATE = 30
+PER_CHAT_INTERVAL = 1.0
+# Одинаковое уведомление пользователю - не чаще раза в 10 минут
+DEFAULT_COOLDOWN = 600.0
+
+
+class RetryAfter(Exception):
+    """Ответ 429 от Bot API при отправке через сырой HTTP"""
+
+    def __init__(self, retry_after: float):
+        super().__init__(f"Flood control, retry after {retry_after}s")
+        self.retry_after = retry_after
+
+
+class NotificationOutbox:
+    """Мониторинг только кладет уведомление в очередь, отправка идет в фоне.
+
+    Одинаковые уведомления (user_id, reason) схлопываются, пока первое не ушло,
+    и не повторяются чаще cooldown секунд.
+    """
+
+    def __init__(self, send: Callable[[Any, dict], Awaitable], cooldown: float = DEFAULT_COOLDOWN,
+                 global_rate: float = GLOBAL_RATE, per_chat_interval: float = PER_CHAT_INTERVAL,
+                 max_retries: int = 5, backoff: float = 1.0, concurrency: int = 8,
+                 maxsize: int = 10000):
+        self.send = send
+        self.cooldown = cooldown
+        self.global_interval = 1.0 / global_rate
+        self.per_chat_interval = per_chat_interval
+        self.max_retries = max_retries
+        self.backoff = backoff
+        self.maxsize = maxsize
+
+        # Куча (ready_at, seq, user_id, reason, payload, attempt)
+        self._queue: List[Tuple[float, int, Any, str, dict, int]] = []
+        self._seq = itertools.count()
+        self._pending: Set[Tuple[Any, str]] = set()
+        self._last_sent: Dict[Tuple[Any, str], float] = {}
+        self._chat_ready: Dict[Any, float] = {}  # когда в чат можно писать снова
+        self._next_global = 0.0
+        self._next_prune = 0.0
+
+        self._wakeup = asyncio.Event()
+        self._slots = asyncio.Semaphore(concurrency)
+        self._worker: Optional[asyncio.Task] = None
+        self._inflight: Set[asyncio.Task] = set()
+
+        self.stats = {'sent': 0, 'deduped': 0, 'cooldown': 0, 'retried': 0,
+                      'failed': 0, 'dropped': 0}
+
+    @property
+    def depth(self) -> int:
+        return len(self._queue)
+
+    def enqueue(self, user_id: Any, reason: str, payload: dict) -> bool:
+        """Постановка уведомления в очередь без ожидания сети"""
+        key = (user_id, reason)
+        now = time.monotonic()
+        if now >= self._next_prune:
+            self._prune(now)
+
+        if key in self._pending:
+            self.stats['deduped'] += 1
+            return False
+        if now - self._last_sent.get(key, -self.cooldown) < self.cooldown:
+            self.stats['cooldown'] += 1
+            return False
+        if len(self._queue) >= self.maxsize:
+            self.stats['dropped'] += 1
+            return False
+
+        self._pending.add(key)
+        self._push(now, user_id, reason, payload, 0)
+        self._ensure_worker()
+        return True
+
+    async def close(self):
+        """Остановка фоновой отправки"""
+        if self._worker is not None:
+            self._worker.cancel()
+            try:
+                await self._worker
+            except asyncio.CancelledError:
+                pass
+            self._worker = None
+        for task in list(self._inflight):
+            task.cancel()
+        if self._inflight:
+            await asyncio.gather(*self._inflight, return_exceptions=True)
+
+    def _prune(self, now: float):
+        """Забываем истекшие кулдауны и лимиты чатов"""
+        self._last_sent = {
+            key: sent_at for key, sent_at in self._last_sent.items()
+            if now - sent_at < self.cooldown
+        }
+        self._chat_ready = {
+            chat: ready_at for chat, ready_at in self._chat_ready.items()
+            if ready_at > now
+        }
+        self._next_prune = now + min(self.cooldown, 60.0)
+
+    def _push(self, ready_at: float, user_id: Any, reason: str, payload: dict, attempt: int):
+        heapq.heappush(self._queue, (ready_at, next(self._seq), user_id, reason, payload, attempt))
+        self._wakeup.set()
+
+    def _ensure_worker(self):
+        if self._worker is None or self._worker.done():
+            self._worker = asyncio.get_running_loop().create_task(self._run())
+
+    async def _run(self):
+        while True:
+            if not self._queue:
+                self._wakeup.clear()
+                await self._wakeup.wait()
+                continue
+
+            now = time.monotonic()
+            ready_at = self._queue[0][0]
+            if ready_at > now:
+                # Ждем ближайшее сообщение или появление нового
+                self._wakeup.clear()
+                try:
+                    await asyncio.wait_for(self._wakeup.wait(), ready_at - now)
+                except asyncio.TimeoutError:
+                    pass
+                continue
+
+            item = heapq.heappop(self._queue)
+            user_id = item[2]
+
+            # Лимит на чат: переносим сообщение, не задерживая остальных
+            chat_ready = self._chat_ready.get(user_id, 0.0)
+            if chat_ready > now:
+                self._push(chat_ready, *item[2:])
+                continue
+
+            # Общий лимит бота
+            if self._next_global > now:
+                await asyncio.sleep(self._next_global - now)
+                now = time.monotonic()
+            self._next_global = now + self.global_interval
+            self._chat_ready[user_id] = now + self.per_chat_interval
+
+            await self._slots.acquire()
+            task = asyncio.get_running_loop().create_task(self._deliver(*item[2:]))
+            self._inflight.add(task)
+            task.add_done_callback(self._inflight.discard)
+
+    async def _deliver(self, user_id: Any, reason: str, payload: dict, attempt: int):
+        key = (user_id, reason)
+        try:
+            await self.send(user_id, payload)
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            retry_after = getattr(e, 'retry_after', None)
+            if attempt >= self.max_retries:
+                print(f"Notification error: {e}")
+                self.stats['failed'] += 1
+                self._pending.discard(key)
+                return
+
+            if retry_after is not None:
+                delay = float(retry_after)
+                # Flood control касается всего бота - притормаживаем всю очередь
+                self._next_global = max(self._next_global, time.monotonic() + delay)
+            else:
+                delay = self.backoff * (2 ** attempt)
+            self.stats['retried'] += 1
+            self._push(time.monotonic() + delay, user_id, reason, payload, attempt + 1)
+        else:
+            self.stats['sent'] += 1
+            self._last_sent[key] = time.monotonic()
+            self._pending.discard(key)
+        finally:
+            self._slots.release()
@@ -0,0 +1,127 @@
+# Управление правилами блокировки в routing xRay
+
+import heapq
+import time
+from typing import Awaitable, Callable, Dict, FrozenSet, List, Optional, Set, Tuple
+
+RULE_TAG_PREFIX = 'block-'
+
+
+class RoutingRuleManager:
+    """Множество заблокированных IP по пользователям с TTL.
+
+    Правила копятся в памяти, а xRay получает один пакет изменений за тик:
+    по одному правилу на пользователя (все его IP в поле source).
+    """
+
+    def __init__(self, apply_batch: Callable[[dict], Awaitable], ttl: float = 3600.0,
+                 outbound_tag: str = 'blocked'):
+        self.apply_batch = apply_batch
+        self.ttl = ttl
+        self.outbound_tag = outbound_tag
+
+        self._blocked: Dict[str, Dict[str, float]] = {}  # user_id -> ip -> expires_at
+        self._applied: Dict[str, FrozenSet[str]] = {}  # что уже есть в xRay
+        self._dirty: Set[str] = set()
+        self._expiry: List[Tuple[float, str, str]] = []  # min-heap (expires_at, user_id, ip)
+
+    def block(self, user_id: str, ip: str, ttl: Optional[float] = None) -> bool:
+        """Блокировка IP; True если IP не был заблокирован"""
+        expires_at = time.time() + (ttl if ttl is not None else self.ttl)
+        user_blocked = self._blocked.setdefault(user_id, {})
+        is_new = ip not in user_blocked
+
+        # Повторная блокировка только продлевает TTL, в xRay ничего не отправляем
+        user_blocked[ip] = expires_at
+        if is_new:
+            heapq.heappush(self._expiry, (expires_at, user_id, ip))
+            self._dirty.add(user_id)
+        return is_new
+
+    def unblock(self, user_id: str, ip: str) -> bool:
+        user_blocked = self._blocked.get(user_id)
+        if not user_blocked or ip not in user_blocked:
+            return False
+
+        del user_blocked[ip]
+        if not user_blocked:
+            del self._blocked[user_id]
+        self._dirty.add(user_id)
+        return True
+
+    def is_blocked(self, user_id: str, ip: str) -> bool:
+        return ip in self._blocked.get(user_id, ())
+
+    def blocked_ips(self, user_id: str) -> FrozenSet[str]:
+        return frozenset(self._blocked.get(user_id, ()))
+
+    @property
+    def pending(self) -> int:
+        """Пользователи с изменениями, еще не отправленными в xRay"""
+        return len(self._dirty)
+
+    def expire(self, now: Optional[float] = None) -> int:
+        """Снятие блокировок с истекшим TTL"""
+        now = now if now is not None else time.time()
+        expired = 0
+
+        while self._expiry and self._expiry[0][0] <= now:
+            expires_at, user_id, ip = heapq.heappop(self._expiry)
+            current = self._blocked.get(user_id, {}).get(ip)
+            if current is None:
+                continue
+            if current > expires_at:
+                # TTL продлен повторной блокировкой - переносим запись
+                heapq.heappush(self._expiry, (current, user_id, ip))
+                continue
+            self.unblock(user_id, ip)
+            expired += 1
+
+        return expired
+
+    async def sync(self) -> int:
+        """Отправка в xRay одного пакета с разницей; возвращает число пользователей"""
+        self.expire()
+        if not self._dirty:
+            return 0
+
+        rules = []
+        remove_tags = []
+        changed = {}
+
+        for user_id in self._dirty:
+            desired = frozenset(self._blocked.get(user_id, ()))
+            if desired == self._applied.get(user_id, frozenset()):
+                continue
+
+            changed[user_id] = desired
+            if desired:
+                rules.append(self.build_rule(user_id, desired))
+            else:
+                remove_tags.append(self.rule_tag(user_id))
+
+        if changed:
+            await self.apply_batch({'rules': rules, 'removeRuleTags': remove_tags})
+
+        # Грязные пользователи сбрасываются только после успешного применения
+        for user_id, desired in changed.items():
+            if desired:
+                self._applied[user_id] = desired
+            else:
+                self._applied.pop(user_id, None)
+        self._dirty.clear()
+
+        return len(changed)
+
+    def build_rule(self, user_id: str, ips: FrozenSet[str]) -> dict:
+        return {
+            "type": "field",
+            "ruleTag": self.rule_tag(user_id),
+            "source": sorted(ips),
+            "user": [user_id],
+            "outboundTag": self.outbound_tag
+        }
+
+    @staticmethod
+    def rule_tag(user_id: str) -> str:
+        return f"{RULE_TAG_PREFIX}{user_id}"
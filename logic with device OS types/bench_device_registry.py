@@ -0,0 +1,89 @@
+# Бенчмарк памяти: прежние dict/dataclass против DeviceRegistry
+#
+#   python bench_device_registry.py --sizes 100000,1000000
+#   python bench_device_registry.py --sizes 1000000 --skip-legacy
+
+import argparse
+import gc
+import hashlib
+import time
+import tracemalloc
+from datetime import datetime
+
+import common_path  # noqa: F401 - корень репозитория в sys.path: пакет common
+from common.device_registry import DeviceRegistry
+from common.fingerprint import fingerprint
+from tls_fingerprint import OS_BY_CODE, OS_CODES, DeviceOS, DeviceSignature
+
+DEVICES_PER_USER = 3
+OS_TYPES = [DeviceOS.IOS, DeviceOS.ANDROID, DeviceOS.WINDOWS, DeviceOS.MACOS]
+
+
+def fill_legacy(devices: int) -> dict:
+    """Прежняя структура DeviceManager.user_devices"""
+    user_devices = {}
+    for i in range(devices):
+        user_id = f"user-{i // DEVICES_PER_USER:08d}"
+        os_type = OS_TYPES[i % len(OS_TYPES)]
+        user_devices.setdefault(user_id, {})[os_type] = DeviceSignature(
+            os_type=os_type,
+            ip_address=f"10.{i // 65536 % 256}.{i // 256 % 256}.{i % 256}",
+            fingerprint=hashlib.sha256(str(i).encode()).hexdigest(),
+            tls_signature="TLS_AES_128_GCM_SHA256,TLS_AES_256_GCM_SHA384",
+            tcp_signature="64:65535",
+            first_seen=datetime.now(),
+            last_seen=datetime.now()
+        )
+    return user_devices
+
+
+def fill_registry(devices: int) -> DeviceRegistry:
+    registry = DeviceRegistry()
+    now = int(time.time())
+    for i in range(devices):
+        registry.upsert(
+            f"user-{i // DEVICES_PER_USER:08d}",
+            fingerprint((i,)),
+            f"10.{i // 65536 % 256}.{i // 256 % 256}.{i % 256}",
+            OS_CODES[OS_TYPES[i % len(OS_TYPES)]],
+            now
+        )
+    return registry
+
+
+def measure(name: str, fill, devices: int):
+    fingerprint.cache_clear()
+    gc.collect()
+    tracemalloc.start()
+    start = time.perf_counter()
+    state = fill(devices)
+    elapsed = time.perf_counter() - start
+    fingerprint.cache_clear()  # кэш отпечатков не относится к состоянию
+    gc.collect()
+    current, _ = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    print(f"{name:<10} {devices:>9,} устройств  {current / 2**20:9.1f} МиБ  "
+          f"{current / devices:7.0f} Б/устройство  заполнение {elapsed:6.2f} c")
+    del state
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--sizes', default='100000,1000000')
+    parser.add_argument('--skip-legacy', action='store_true')
+    args = parser.parse_args()
+
+    for devices in map(int, args.sizes.split(',')):
+        if not args.skip_legacy:
+            measure('legacy', fill_legacy, devices)
+        measure('registry', fill_registry, devices)
+
+    # Проверка API на маленьком примере
+    registry = fill_registry(10)
+    record = registry.devices("user-00000000")[0]
+    assert OS_BY_CODE[record.os_code] in OS_TYPES
+    assert registry.count("user-00000000") == DEVICES_PER_USER
+
+
+if __name__ == '__main__':
+    main()
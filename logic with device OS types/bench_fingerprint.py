@@ -0,0 +1,89 @@
+# Микробенчмарк отпечатков: json.dumps + SHA-256 против кортежа + blake2b
+#
+#   python bench_fingerprint.py --connections 200000 --devices 5000
+
+import argparse
+import hashlib
+import json
+import random
+import time
+
+import common_path  # noqa: F401 - корень репозитория в sys.path: пакет common
+from common.fingerprint import canonical, fingerprint
+
+CIPHERS = ['TLS_AES_128_GCM_SHA256', 'TLS_AES_256_GCM_SHA384', 'TLS_CHACHA20_POLY1305_SHA256',
+           'TLS_ECDHE_RSA_WITH_AES_128_GCM_SHA256']
+EXTENSIONS = ['0x0000', '0x0017', '0x0023', '0x0010', '0x0033']
+
+
+def generate_connections(count: int, devices: int) -> list:
+    """Поток подключений: одни и те же устройства повторяются каждый тик"""
+    rnd = random.Random(7)
+    pool = []
+    for i in range(devices):
+        pool.append({
+            'ip': f"10.{i // 65536 % 256}.{i // 256 % 256}.{i % 256}",
+            'tls': {
+                'ciphers': rnd.sample(CIPHERS, 3),
+                'extensions': rnd.sample(EXTENSIONS, 3),
+            },
+            'tcp': {'ttl': rnd.choice([64, 128]), 'window_size': rnd.choice([65535, 8192])},
+            'sni': 'www.google.com',
+        })
+    return [pool[rnd.randrange(devices)] for _ in range(count)]
+
+
+def legacy_fingerprint(conn: dict) -> str:
+    """Прежний путь DeviceManager.create_device_fingerprint"""
+    fingerprint_data = {
+        'os': 'android',
+        'tls_ciphers': conn.get('tls', {}).get('ciphers', []),
+        'tls_extensions': conn.get('tls', {}).get('extensions', []),
+        'tcp_ttl': conn.get('tcp', {}).get('ttl'),
+        'tcp_window': conn.get('tcp', {}).get('window_size'),
+        'sni': conn.get('sni'),
+    }
+    fingerprint_str = json.dumps(fingerprint_data, sort_keys=True)
+    return hashlib.sha256(fingerprint_str.encode()).hexdigest()
+
+
+def compact_fingerprint(conn: dict) -> bytes:
+    tls = conn.get('tls', {})
+    tcp = conn.get('tcp', {})
+    return fingerprint((
+        'android',
+        canonical(tls.get('ciphers', [])),
+        canonical(tls.get('extensions', [])),
+        tcp.get('ttl'),
+        tcp.get('window_size'),
+        conn.get('sni'),
+        None,
+    ))
+
+
+def measure(name: str, func, connections: list):
+    start = time.perf_counter()
+    for conn in connections:
+        func(conn)
+    elapsed = time.perf_counter() - start
+    print(f"{name:<20} {elapsed:7.3f} c  {len(connections) / elapsed:>12,.0f} отпечатков/с")
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--connections', type=int, default=200000)
+    parser.add_argument('--devices', type=int, default=5000)
+    args = parser.parse_args()
+
+    connections = generate_connections(args.connections, args.devices)
+
+    measure('json+sha256', legacy_fingerprint, connections)
+    fingerprint.cache_clear()
+    measure('tuple+blake2b', compact_fingerprint, connections)
+    print(f"кэш: {fingerprint.cache_info()}")
+    print(f"размер: {len(legacy_fingerprint(connections[0]))} символов hex "
+          f"-> {len(compact_fingerprint(connections[0]))} байт")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,93 @@
+# Бенчмарк парсера access.log: строк в секунду
+#
+#   python bench_log_parser.py --lines 200000 --min-rate 300000
+#
+# С --min-rate скрипт завершается с кодом 1, если быстрый путь стал медленнее порога
+
+import argparse
+import json
+import random
+import re
+import sys
+import time
+from datetime import datetime
+
+from log_parser import AccessLogParser
+
+TLS_BLOBS = [
+    {'ciphers': ['TLS_AES_128_GCM_SHA256', 'TLS_CHACHA20_POLY1305_SHA256'],
+     'extensions': ['0x0000', '0x0017', '0x0023'], 'curves': ['x25519', 'secp256r1']},
+    {'ciphers': ['TLS_ECDHE_RSA_WITH_AES_128_GCM_SHA256'],
+     'extensions': ['0x0000', '0x0023', '0x0017', '0x0033'], 'curves': ['secp256r1']},
+]
+TCP_BLOBS = [
+    {'ttl': 64, 'window_size': 65535},
+    {'ttl': 128, 'window_size': 8192},
+]
+
+
+def generate_lines(count: int, users: int = 5000, with_blobs: bool = True) -> list:
+    rnd = random.Random(42)
+    tls = [json.dumps(b, separators=(',', ':')) for b in TLS_BLOBS]
+    tcp = [json.dumps(b, separators=(',', ':')) for b in TCP_BLOBS]
+    lines = []
+
+    for i in range(count):
+        ts = f"2024/05/01 12:{(i // 60000) % 60:02d}:{(i // 1000) % 60:02d}.{i % 1000:03d}123"
+        ip = f"10.{rnd.randint(0, 255)}.{rnd.randint(0, 255)}.{rnd.randint(1, 254)}"
+        line = (
+            f"{ts} from {ip}:{rnd.randint(1024, 65535)} accepted tcp:www.google.com:443 "
+            f"[vless-reality >> direct] email: user{rnd.randrange(users)}"
+        )
+        if with_blobs:
+            kind = rnd.randrange(2)
+            line += f" tls:{tls[kind]} tcp:{tcp[kind]}"
+        lines.append(line)
+
+    return lines
+
+
+def legacy_parse(log_line: str):
+    """Прежний подход: re.search + json.loads + datetime.now() на каждую строку"""
+    pattern = r'(\d+\.\d+\.\d+\.\d+):(\d+).*email: ([\w-]+).*tls:(\{.*?\}).*tcp:(\{.*?\})'
+    match = re.search(pattern, log_line)
+    if match:
+        return {
+            'ip': match.group(1),
+            'port': match.group(2),
+            'user_id': match.group(3),
+            'tls': json.loads(match.group(4)),
+            'tcp': json.loads(match.group(5)),
+            'timestamp': datetime.now()
+        }
+    return None
+
+
+def measure(name: str, func, lines: list) -> float:
+    start = time.perf_counter()
+    parsed = func(lines)
+    elapsed = time.perf_counter() - start
+    rate = len(lines) / elapsed
+    print(f"{name:<12} {len(parsed):>9} строк  {elapsed:7.3f} c  {rate:>12,.0f} строк/с")
+    return rate
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--lines', type=int, default=200000)
+    parser.add_argument('--min-rate', type=float, default=0)
+    args = parser.parse_args()
+
+    lines = generate_lines(args.lines)
+
+    measure('legacy', lambda chunk: [c for c in map(legacy_parse, chunk) if c], lines)
+    rate = measure('batch', AccessLogParser().parse_lines, lines)
+    measure('no-blobs', AccessLogParser().parse_lines, generate_lines(args.lines, with_blobs=False))
+
+    if args.min_rate and rate < args.min_rate:
+        print(f"Регрессия: {rate:,.0f} < {args.min_rate:,.0f} строк/с")
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
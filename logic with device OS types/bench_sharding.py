@@ -0,0 +1,95 @@
+# Пропускная способность: один процесс против N шардов-процессов
+#
+#   python bench_sharding.py --lines 200000 --shards 1,2,4,8
+#
+# Решения (число отклоненных подключений) в обоих режимах должны совпадать
+
+import argparse
+import asyncio
+import os
+import random
+import tempfile
+import time
+
+import common_path  # noqa: F401 - корень репозитория в sys.path: пакет common
+from bench_log_parser import generate_lines
+from limit_engine import LimitEngine
+from log_parser import AccessLogParser
+from sharding import ShardPool
+from system_os import DeviceManager
+
+BATCH = 20000
+
+
+def vary_devices(lines: list) -> list:
+    """Разные устройства одной ОС у пользователя - чтобы были отклонения"""
+    rnd = random.Random(3)
+    return [
+        line.replace('"window_size":65535', f'"window_size":{65535 - rnd.randrange(3)}')
+        for line in lines
+    ]
+
+
+async def run_single(db_path: str, lines: list) -> tuple:
+    device_manager = DeviceManager(db_path)
+    await device_manager.restore()
+    engine = LimitEngine(device_manager)
+    parser = AccessLogParser()
+    rejected = 0
+
+    start = time.perf_counter()
+    for i in range(0, len(lines), BATCH):
+        connections = {}
+        for conn in parser.parse_lines(lines[i:i + BATCH]):
+            connections.setdefault(conn['user_id'], []).append(conn)
+        for user_id, conn_list in engine.apply_events(connections).items():
+            _, user_rejected = await engine.evaluate(user_id, conn_list)
+            rejected += len(user_rejected)
+    elapsed = time.perf_counter() - start
+
+    device_manager.store.close()
+    return rejected, elapsed
+
+
+async def run_sharded(db_path: str, lines: list, shards: int) -> tuple:
+    pool = ShardPool(shards, db_path)
+    await pool.restore()
+    rejected = 0
+
+    start = time.perf_counter()
+    for i in range(0, len(lines), BATCH):
+        decisions = await pool.process_lines(lines[i:i + BATCH])
+        rejected += len(decisions['rejected'])
+    elapsed = time.perf_counter() - start
+
+    await pool.close()
+    return rejected, elapsed
+
+
+def report(name: str, lines: int, elapsed: float, rejected: int):
+    print(f"{name:<10} {lines:>9,} строк  {elapsed:7.2f} c  {lines / elapsed:>10,.0f} строк/с  "
+          f"отклонено {rejected:,}")
+
+
+async def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--lines', type=int, default=200000)
+    parser.add_argument('--users', type=int, default=20000)
+    parser.add_argument('--shards', default='2,4')
+    args = parser.parse_args()
+
+    lines = vary_devices(generate_lines(args.lines, users=args.users))
+    print(f"ядер: {os.cpu_count()}")
+
+    with tempfile.TemporaryDirectory() as tmp:
+        expected, elapsed = await run_single(os.path.join(tmp, 'single.db'), lines)
+        report('1 процесс', len(lines), elapsed, expected)
+
+        for shards in map(int, args.shards.split(',')):
+            rejected, elapsed = await run_sharded(os.path.join(tmp, f'shards{shards}.db'), lines, shards)
+            report(f'{shards} шардов', len(lines), elapsed, rejected)
+            assert rejected == expected, "решения шардов разошлись с однопроцессным режимом"
+
+
+if __name__ == '__main__':
+    asyncio.run(main())
@@ -0,0 +1,73 @@
+# Время теплого старта: загрузка устройств из SQLite и из бинарного снимка
+#
+#   python bench_warm_start.py --devices 1000000
+
+import argparse
+import os
+import sqlite3
+import tempfile
+import time
+
+import common_path  # noqa: F401 - корень репозитория в sys.path: пакет common
+from common.device_registry import DeviceRegistry
+from device_store import SCHEMA, sql_timestamp
+from state_loader import restore_state
+
+OS_TYPES = ['ios', 'android', 'windows', 'macos', 'linux']
+
+
+def build_db(db_path: str, devices: int):
+    conn = sqlite3.connect(db_path)
+    conn.execute('PRAGMA journal_mode=WAL')
+    conn.executescript(SCHEMA)
+    now = sql_timestamp(time.time())
+    rows = (
+        (f"user-{i // len(OS_TYPES):08d}", OS_TYPES[i % len(OS_TYPES)], i.to_bytes(16, 'big'),
+         f"10.{i // 65536 % 256}.{i // 256 % 256}.{i % 256}", '', '', now, now, 1)
+        for i in range(devices)
+    )
+    with conn:
+        conn.executemany(
+            "INSERT INTO user_devices (user_id, os_type, device_fingerprint, ip_address, "
+            "tls_signature, tcp_signature, first_seen, last_seen, is_active) "
+            "VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)",
+            rows
+        )
+    conn.execute('PRAGMA wal_checkpoint(TRUNCATE)')
+    conn.close()
+
+
+def report(stats: dict):
+    rate = stats['devices'] / stats['seconds'] if stats['seconds'] else 0
+    print(f"{stats['source']:<9} {stats['devices']:>9,} устройств  {stats['seconds']:7.2f} c  "
+          f"{rate:>12,.0f} устройств/с")
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--devices', type=int, default=1000000)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        db_path = os.path.join(tmp, 'devices.db')
+        snapshot_path = f"{db_path}.snapshot"
+
+        start = time.perf_counter()
+        build_db(db_path, args.devices)
+        print(f"подготовка БД: {time.perf_counter() - start:.2f} c")
+
+        registry = DeviceRegistry()
+        report(restore_state(db_path, registry, snapshot_path))
+
+        start = time.perf_counter()
+        registry.save_snapshot(snapshot_path)
+        print(f"запись снимка: {time.perf_counter() - start:.2f} c, "
+              f"{os.path.getsize(snapshot_path) / 2**20:.1f} МиБ")
+
+        registry = DeviceRegistry()
+        report(restore_state(db_path, registry, snapshot_path))
+        assert len(registry) == args.devices
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,10 @@
+# Общие для обоих вариантов модули - пакет common в корне репозитория.
+# Импортируется один раз в точке входа (скрипт, бот); модули вариантов
+# пишут `from common.metrics import ...` и путь не трогают.
+
+import os
+import sys
+
+ROOT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+if ROOT_DIR not in sys.path:
+    sys.path.append(ROOT_DIR)
@@ -0,0 +1,71 @@
+# Инкрементальный учет подключений: лимиты проверяются только у изменившихся пользователей
+
+from typing import Dict, Hashable, List, Optional
+
+
+def connection_key(conn: dict) -> Hashable:
+    """Ключ устройства в подключении: IP + сигнатура TLS/TCP из парсера"""
+    return (conn['ip'], conn.get('signature'))
+
+
+class ConnectionState:
+    """Известные (уже проверенные и допущенные) устройства по пользователям.
+
+    Событие с известным ключом только обновляет last_seen устройства.
+    Событие с новым ключом помечает пользователя грязным - на ближайшем
+    тике по нему заново выполняются определение ОС и проверка лимита.
+    Отклоненные подключения не запоминаются и проверяются при каждом появлении.
+    """
+
+    def __init__(self):
+        self._known: Dict[str, Dict[Hashable, bytes]] = {}  # user_id -> ключ -> отпечаток
+        self._dirty: Dict[str, List[dict]] = {}  # user_id -> новые события с прошлого тика
+        self.stats = {'events': 0, 'known': 0, 'dirty': 0}
+
+    def apply(self, user_id: str, conn: dict) -> Optional[bytes]:
+        """Учет события; для известного устройства возвращает его отпечаток"""
+        self.stats['events'] += 1
+        known = self._known.get(user_id)
+        if known is not None:
+            fp = known.get(connection_key(conn))
+            if fp is not None:
+                self.stats['known'] += 1
+                return fp
+
+        pending = self._dirty.get(user_id)
+        if pending is None:
+            self._dirty[user_id] = [conn]
+        else:
+            pending.append(conn)
+        self.stats['dirty'] += 1
+        return None
+
+    def remember(self, user_id: str, conn: dict, fingerprint: bytes):
+        """Подключение допущено - следующие с тем же ключом проверять не нужно"""
+        known = self._known.get(user_id)
+        if known is None:
+            known = self._known[user_id] = {}
+        known[connection_key(conn)] = fingerprint
+
+    def forget(self, user_id: str, fingerprint: bytes):
+        """Устройство удалено - его ключи снова требуют проверки"""
+        known = self._known.get(user_id)
+        if not known:
+            return
+        for key in [key for key, fp in known.items() if fp == fingerprint]:
+            del known[key]
+        if not known:
+            del self._known[user_id]
+
+    def invalidate(self, user_id: str):
+        """Изменились лимиты пользователя - переоценить все его подключения"""
+        self._known.pop(user_id, None)
+
+    def drain_dirty(self) -> Dict[str, List[dict]]:
+        """Новые события по грязным пользователям; состояние очищается"""
+        dirty, self._dirty = self._dirty, {}
+        return dirty
+
+    def __len__(self) -> int:
+        """Число пользователей с известными устройствами"""
+        return len(self._known)
@@ -3,15 +3,15 @@ CREATE TABLE user_devices (
     id INTEGER PRIMARY KEY AUTOINCREMENT,
     user_id VARCHAR(36) NOT NULL,
     os_type VARCHAR(20) NOT NULL,
-    device_fingerprint VARCHAR(64) UNIQUE,
+    device_fingerprint BLOB UNIQUE,  -- 16 байт blake2b (fingerprint.py)
     ip_address VARCHAR(45),
     tls_signature TEXT,
     tcp_signature TEXT,
     first_seen TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
     last_seen TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
     is_active BOOLEAN DEFAULT TRUE,
-    is_blocked BOOLEAN DEFAULT FALSE,
-    UNIQUE(user_id, os_type)  -- Один пользователь = одно устройство на ОС
+    is_blocked BOOLEAN DEFAULT FALSE
+    -- Устройств одной ОС не больше user_os_limits.device_limit (по умолчанию 1)
 );
 
 # -- Таблица лимитов по ОС
@@ -24,6 +24,12 @@ CREATE TABLE user_os_limits (
     UNIQUE(user_id, os_type)
 );
 
+# -- Тарифы пользователей (таймаут простоя устройств, device_expiry.py)
+CREATE TABLE user_plans (
+    user_id VARCHAR(36) PRIMARY KEY,
+    plan VARCHAR(20) NOT NULL DEFAULT 'basic'
+);
+
 # -- Индексы для быстрого поиска
 CREATE INDEX idx_user_devices ON user_devices(user_id, os_type);
 CREATE INDEX idx_active_devices ON user_devices(user_id, is_active);
\ No newline at end of file
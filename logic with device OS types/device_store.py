@@ -0,0 +1,229 @@
+# Отложенная запись устройств в SQLite (write-behind) в отдельном потоке
+
+import sqlite3
+import threading
+import time
+from typing import Dict, Optional, Set, Tuple
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS user_devices (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    user_id VARCHAR(36) NOT NULL,
+    os_type VARCHAR(20) NOT NULL,
+    device_fingerprint BLOB UNIQUE,
+    ip_address VARCHAR(45),
+    tls_signature TEXT,
+    tcp_signature TEXT,
+    first_seen TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+    last_seen TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+    is_active BOOLEAN DEFAULT TRUE,
+    is_blocked BOOLEAN DEFAULT FALSE
+);
+CREATE INDEX IF NOT EXISTS idx_user_devices ON user_devices(user_id, os_type);
+CREATE INDEX IF NOT EXISTS idx_active_devices ON user_devices(user_id, is_active);
+"""
+
+UPSERT_SQL = """
+INSERT INTO user_devices (user_id, os_type, device_fingerprint, ip_address,
+                          tls_signature, tcp_signature, first_seen, last_seen, is_active)
+VALUES (?, ?, ?, ?, ?, ?, ?, ?, 1)
+ON CONFLICT(device_fingerprint) DO UPDATE SET
+    ip_address = excluded.ip_address,
+    last_seen = excluded.last_seen,
+    is_active = 1
+"""
+
+# Базы до покупных слотов: UNIQUE(user_id, os_type) разрешал одно устройство на ОС.
+# Ограничение не снять через ALTER TABLE - таблица пересобирается с теми же строками
+OS_UNIQUE_MIGRATION = """
+ALTER TABLE user_devices RENAME TO user_devices_old;
+DROP INDEX IF EXISTS idx_user_devices;
+DROP INDEX IF EXISTS idx_active_devices;
+""" + SCHEMA + """
+INSERT INTO user_devices SELECT * FROM user_devices_old;
+DROP TABLE user_devices_old;
+"""
+
+TOUCH_SQL = "UPDATE user_devices SET last_seen = ?, ip_address = ? WHERE device_fingerprint = ?"
+
+# Слот освобожден по простою; строка остается для истории
+DEACTIVATE_SQL = "UPDATE user_devices SET is_active = 0 WHERE device_fingerprint = ?"
+
+
+def sql_timestamp(ts: float) -> str:
+    """Время в формате CURRENT_TIMESTAMP (UTC)"""
+    return time.strftime('%Y-%m-%d %H:%M:%S', time.gmtime(ts))
+
+
+def migrate_schema(conn: sqlite3.Connection):
+    """Снятие UNIQUE(user_id, os_type): на одну ОС бывает несколько купленных слотов"""
+    row = conn.execute(
+        "SELECT sql FROM sqlite_master WHERE type = 'table' AND name = 'user_devices'"
+    ).fetchone()
+    if row and 'UNIQUE(user_id, os_type)' in ' '.join(row[0].split()):
+        conn.executescript(f"BEGIN;{OS_UNIQUE_MIGRATION}COMMIT;")
+
+
+class DeviceStore:
+    """Буфер изменений в памяти + поток, сбрасывающий его пачками.
+
+    upsert/touch не ждут диска: изменения копятся и записываются одной
+    транзакцией через executemany по таймеру или при заполнении буфера.
+    """
+
+    def __init__(self, db_path: str, flush_interval: float = 1.0, max_buffer: int = 5000):
+        self.db_path = db_path
+        self.flush_interval = flush_interval
+        self.max_buffer = max_buffer
+
+        self._lock = threading.Lock()
+        self._upserts: Dict[bytes, Tuple] = {}  # fingerprint -> строка для UPSERT_SQL
+        self._touches: Dict[bytes, Tuple] = {}  # fingerprint -> (last_seen, ip)
+        self._deactivations: Set[bytes] = set()
+        self._wakeup = threading.Event()
+        self._stopping = False
+
+        self.stats = {'flushes': 0, 'rows': 0, 'errors': 0}
+
+        self._thread = threading.Thread(target=self._run, name='device-store', daemon=True)
+
+    def start(self):
+        """Запуск потока записи (после восстановления состояния из БД)"""
+        if not self._thread.is_alive():
+            self._thread.start()
+
+    def upsert(self, user_id: str, device) -> None:
+        """Новое устройство (DeviceSignature)"""
+        row = (
+            user_id,
+            device.os_type.value,
+            device.fingerprint,
+            device.ip_address,
+            device.tls_signature,
+            device.tcp_signature,
+            sql_timestamp(device.first_seen.timestamp()),
+            sql_timestamp(device.last_seen.timestamp()),
+        )
+        with self._lock:
+            self._upserts[device.fingerprint] = row
+            self._touches.pop(device.fingerprint, None)
+            self._deactivations.discard(device.fingerprint)
+            size = len(self._upserts) + len(self._touches)
+        if size >= self.max_buffer:
+            self._wakeup.set()
+
+    def touch(self, fingerprint: bytes, last_seen: float, ip: Optional[str]) -> None:
+        """Обновление last_seen; повторные касания одного устройства схлопываются"""
+        with self._lock:
+            if fingerprint in self._upserts:
+                row = self._upserts[fingerprint]
+                self._upserts[fingerprint] = row[:3] + (ip,) + row[4:7] + (sql_timestamp(last_seen),)
+                return
+            self._touches[fingerprint] = (sql_timestamp(last_seen), ip)
+            size = len(self._upserts) + len(self._touches)
+        if size >= self.max_buffer:
+            self._wakeup.set()
+
+    def deactivate(self, fingerprint: bytes) -> None:
+        """Устройство истекло по простою: is_active = 0"""
+        with self._lock:
+            self._touches.pop(fingerprint, None)
+            self._upserts.pop(fingerprint, None)
+            self._deactivations.add(fingerprint)
+    
+    @property
+    def pending(self) -> int:
+        with self._lock:
+            return len(self._upserts) + len(self._touches) + len(self._deactivations)
+
+    def flush(self):
+        """Попросить поток записать буфер, не дожидаясь таймера"""
+        self._wakeup.set()
+
+    def close(self, timeout: Optional[float] = None):
+        """Остановка потока с записью всего накопленного"""
+        self._stopping = True
+        self._wakeup.set()
+        if self._thread.is_alive():
+            self._thread.join(timeout)
+
+    def _run(self):
+        conn = sqlite3.connect(self.db_path)
+        conn.execute('PRAGMA journal_mode=WAL')
+        conn.execute('PRAGMA synchronous=NORMAL')
+        conn.executescript(SCHEMA)
+        migrate_schema(conn)
+
+        try:
+            while True:
+                self._wakeup.wait(self.flush_interval)
+                self._wakeup.clear()
+                self._flush(conn)
+                if self._stopping:
+                    self._flush(conn)
+                    break
+        finally:
+            conn.close()
+
+    def _flush(self, conn: sqlite3.Connection):
+        with self._lock:
+            upserts, self._upserts = self._upserts, {}
+            touches, self._touches = self._touches, {}
+            deactivations, self._deactivations = self._deactivations, set()
+
+        if not upserts and not touches and not deactivations:
+            return
+
+        touch_rows = [(last_seen, ip, fp) for fp, (last_seen, ip) in touches.items()]
+        deactivate_rows = [(fp,) for fp in deactivations]
+        try:
+            with conn:
+                # Сначала освобождаем слоты, затем вставляем новые устройства
+                conn.executemany(DEACTIVATE_SQL, deactivate_rows)
+                conn.executemany(UPSERT_SQL, upserts.values())
+                conn.executemany(TOUCH_SQL, touch_rows)
+        except sqlite3.IntegrityError:
+            # Пачка откатилась - пишем по одной строке, чтобы не потерять остальные
+            self._flush_rows(conn, deactivate_rows, upserts.values(), touch_rows)
+        except sqlite3.Error as e:
+            # Например, database is locked - вернем пачку в буфер до следующего сброса
+            print(f"Device store error: {e}")
+            self.stats['errors'] += 1
+            self._requeue(upserts, touches, deactivations)
+            return
+
+        self.stats['flushes'] += 1
+        self.stats['rows'] += len(upserts) + len(touch_rows) + len(deactivate_rows)
+
+    def _requeue(self, upserts: Dict[bytes, Tuple], touches: Dict[bytes, Tuple],
+                 deactivations: Set[bytes]):
+        with self._lock:
+            newer_upserts, newer_touches = self._upserts, self._touches
+            # Устройство, снова появившееся после истечения, деактивировать уже не нужно
+            self._deactivations |= deactivations - newer_upserts.keys()
+            for fp in self._deactivations:
+                upserts.pop(fp, None)
+                touches.pop(fp, None)
+            # Более свежие изменения из буфера важнее возвращаемых
+            upserts.update(newer_upserts)
+            touches.update(newer_touches)
+
+            self._touches = {}
+            for fp, (last_seen, ip) in touches.items():
+                row = upserts.get(fp)
+                if row is None:
+                    self._touches[fp] = (last_seen, ip)
+                elif fp not in newer_upserts:
+                    # Касание новее возвращенной строки - вливаем его в UPSERT
+                    upserts[fp] = row[:3] + (ip,) + row[4:7] + (last_seen,)
+            self._upserts = upserts
+
+    def _flush_rows(self, conn: sqlite3.Connection, deactivate_rows, upserts, touch_rows):
+        for sql, rows in ((DEACTIVATE_SQL, deactivate_rows), (UPSERT_SQL, upserts), (TOUCH_SQL, touch_rows)):
+            for row in rows:
+                try:
+                    with conn:
+                        conn.execute(sql, row)
+                except sqlite3.Error as e:
+                    print(f"Device store error: {e}")
+                    self.stats['errors'] += 1
@@ -0,0 +1,71 @@
+# Неизменяемые представления устройств пользователя для обработчиков бота
+
+import itertools
+from datetime import datetime
+from typing import Dict, FrozenSet, Iterable, NamedTuple, Tuple
+
+from tls_fingerprint import OS_BY_CODE, DeviceOS
+
+
+class DeviceInfo(NamedTuple):
+    os_type: DeviceOS
+    ip: str
+    first_seen: int
+    last_seen: int
+
+    @property
+    def first_seen_dt(self) -> datetime:
+        return datetime.fromtimestamp(self.first_seen)
+
+    @property
+    def last_seen_dt(self) -> datetime:
+        return datetime.fromtimestamp(self.last_seen)
+
+
+class UserView(NamedTuple):
+    """Снимок на момент публикации; version растет при каждом изменении"""
+    version: int
+    devices: Tuple[DeviceInfo, ...]
+    limits: Tuple[Tuple[DeviceOS, int], ...]  # слоты по каждой ОС с учетом покупок
+    blocked_ips: FrozenSet[str]
+
+
+EMPTY_VIEW = UserView(0, (), (), frozenset())
+
+
+class ViewStore:
+    """user_id -> UserView.
+
+    Мониторинг публикует новый кортеж после изменения устройств, лимитов
+    или блокировок пользователя; бот только читает готовый снимок и не
+    трогает реестр, который в это время меняет цикл мониторинга.
+    Неизменившийся снимок не публикуется заново - версия остается прежней,
+    и ответы, закэшированные по (пользователь, версия), продолжают работать.
+    last_seen в снимке - время последней публикации, а не каждого пакета.
+    """
+
+    def __init__(self):
+        self._views: Dict[str, UserView] = {}
+        self._versions = itertools.count(1)
+
+    def publish(self, user_id: str, rows: Iterable[tuple], limits: Dict[DeviceOS, int],
+                blocked_ips: FrozenSet[str]) -> UserView:
+        """rows: (os_code, ip, first_seen, last_seen) по устройствам пользователя"""
+        devices = tuple(
+            DeviceInfo(OS_BY_CODE[os_code], ip, first_seen, last_seen)
+            for os_code, ip, first_seen, last_seen in rows
+        )
+        limits = tuple(sorted(limits.items(), key=lambda item: item[0].value))
+        current = self._views.get(user_id, EMPTY_VIEW)
+        if (current.devices, current.limits, current.blocked_ips) == (devices, limits, blocked_ips):
+            return current
+
+        view = UserView(next(self._versions), devices, limits, blocked_ips)
+        self._views[user_id] = view
+        return view
+
+    def get(self, user_id: str) -> UserView:
+        return self._views.get(user_id, EMPTY_VIEW)
+
+    def __len__(self) -> int:
+        return len(self._views)
@@ -1,87 +1,158 @@
 # Telegram бот с управлением по ОС
 
-from aiogram import Bot, Dispatcher, types
+from typing import Callable, Dict, Tuple
+
+from aiogram import Bot, Dispatcher, F, types
 from aiogram.filters import Command
 from aiogram.fsm.context import FSMContext
 
+import common_path  # noqa: F401 - корень репозитория в sys.path: пакет common
+from device_views import UserView
+from limits import DEFAULT_LIMIT
+from common.metrics import QUEUE_DEPTH
+from common.notify_outbox import NotificationOutbox
+from tls_fingerprint import DeviceOS
+
+# Цена дополнительного слота ОС, рублей
+SLOT_PRICE = 299
+
+
 class VPNBotWithOSLimit:
-    def __init__(self, token: str):
+    def __init__(self, token: str, payment_token: str = ''):
         self.bot = Bot(token=token)
+        # Токен платежного провайдера Telegram Payments для счетов buy_os_slot
+        self.payment_token = payment_token
         self.dp = Dispatcher()
         self.limiter = XRayOSLimiter("config.json", self.bot)
+        self.outbox = NotificationOutbox(self.send_notification)
+        QUEUE_DEPTH.labels('outbox').set_function(lambda: self.outbox.depth)
+        # Готовые ответы /status и /devices: (вид, user_id) -> (версия снимка, ответ)
+        self.replies: Dict[Tuple[str, str], Tuple[int, dict]] = {}
         self.setup_handlers()
         
     def setup_handlers(self):
         @self.dp.message(Command("status"))
         async def show_status(message: types.Message):
             user_id = await self.get_user_vpn_id(message.from_user.id)
-            devices = self.limiter.device_manager.user_devices.get(user_id, {})
-            
-            text = "📱 <b>Ваши подключенные устройства:</b>\n\n"
-            
-            os_emoji = {
-                DeviceOS.IOS: "🍎",
-                DeviceOS.ANDROID: "🤖",
-                DeviceOS.WINDOWS: "🪟",
-                DeviceOS.MACOS: "💻",
-                DeviceOS.LINUX: "🐧"
-            }
-            
-            if devices:
-                for os_type, device in devices.items():
-                    emoji = os_emoji.get(os_type, "❓")
-                    text += f"{emoji} <b>{os_type.value.upper()}</b>\n"
-                    text += f"   IP: {device.ip_address}\n"
-                    text += f"   Подключено: {device.first_seen.strftime('%d.%m %H:%M')}\n"
-                    text += f"   Активность: {device.last_seen.strftime('%d.%m %H:%M')}\n\n"
-            else:
-                text += "Нет активных устройств\n\n"
-            
-            text += "ℹ️ <i>Лимит: 1 устройство на каждую ОС</i>\n"
-            text += "💳 Купить дополнительные слоты: /buy_slots"
-            
-            await message.answer(text, parse_mode="HTML")
+            await message.answer(**self.cached_reply('status', user_id, self.render_status))
         
         @self.dp.message(Command("devices"))
         async def manage_devices(message: types.Message):
             user_id = await self.get_user_vpn_id(message.from_user.id)
-            devices = self.limiter.device_manager.user_devices.get(user_id, {})
-            
-            keyboard = types.InlineKeyboardMarkup(inline_keyboard=[])
-            
-            for os_type, device in devices.items():
-                keyboard.inline_keyboard.append([
-                    types.InlineKeyboardButton(
-                        text=f"🗑 Отключить {os_type.value}",
-                        callback_data=f"remove_device:{os_type.value}"
-                    )
-                ])
-            
+            await message.answer(**self.cached_reply('devices', user_id, self.render_devices))
+        
+        @self.dp.callback_query(F.data.startswith("buy_os_slot:"))
+        async def buy_os_slot(callback: types.CallbackQuery):
+            # Кнопка из уведомления о блокировке: счет на слот этой ОС
+            os_name = callback.data.split(":")[1]
+            await callback.message.answer_invoice(
+                title=f"Слот {os_name.upper()}",
+                description=f"Дополнительное устройство {os_name.upper()} на вашем тарифе",
+                payload=f"os_slot:{os_name}",
+                provider_token=self.payment_token,
+                currency="RUB",
+                prices=[types.LabeledPrice(label=f"Слот {os_name.upper()}", amount=SLOT_PRICE * 100)]
+            )
+            await callback.answer()
+        
+        @self.dp.pre_checkout_query()
+        async def confirm_checkout(query: types.PreCheckoutQuery):
+            await query.answer(ok=True)
+        
+        @self.dp.message(F.successful_payment)
+        async def payment_completed(message: types.Message):
+            kind, _, os_name = message.successful_payment.invoice_payload.partition(":")
+            if kind != "os_slot":
+                return
+            user_id = await self.get_user_vpn_id(message.from_user.id)
+            await self.complete_os_slot_purchase(user_id, os_name)
+            await message.answer(
+                f"✅ Слот {os_name.upper()} добавлен. "
+                f"Устройств {os_name.upper()}: до {self.os_limit(user_id, os_name)}"
+            )
+    
+    def cached_reply(self, kind: str, user_id: str, render: Callable[[UserView], dict]) -> dict:
+        """Ответ по снимку устройств; пока версия снимка та же, повторно не строится"""
+        view = self.limiter.views.get(user_id)
+        key = (kind, user_id)
+        cached = self.replies.get(key)
+        if cached is not None and cached[0] == view.version:
+            return cached[1]
+        reply = render(view)
+        self.replies[key] = (view.version, reply)
+        return reply
+    
+    def render_status(self, view: UserView) -> dict:
+        text = "📱 <b>Ваши подключенные устройства:</b>\n\n"
+        
+        os_emoji = {
+            DeviceOS.IOS: "🍎",
+            DeviceOS.ANDROID: "🤖",
+            DeviceOS.WINDOWS: "🪟",
+            DeviceOS.MACOS: "💻",
+            DeviceOS.LINUX: "🐧"
+        }
+        
+        if view.devices:
+            for device in view.devices:
+                emoji = os_emoji.get(device.os_type, "❓")
+                text += f"{emoji} <b>{device.os_type.value.upper()}</b>\n"
+                text += f"   IP: {device.ip}\n"
+                text += f"   Подключено: {device.first_seen_dt.strftime('%d.%m %H:%M')}\n"
+                text += f"   Активность: {device.last_seen_dt.strftime('%d.%m %H:%M')}\n\n"
+        else:
+            text += "Нет активных устройств\n\n"
+        
+        if view.blocked_ips:
+            text += f"⛔ Заблокировано: {', '.join(sorted(view.blocked_ips))}\n\n"
+        
+        if view.limits:
+            slots = ", ".join(f"{os_type.value.upper()} - {limit}" for os_type, limit in view.limits)
+            text += f"ℹ️ <i>Лимит устройств по ОС: {slots}</i>\n"
+        else:
+            # Снимка еще нет - у пользователя нет устройств и покупок
+            text += f"ℹ️ <i>Лимит: {DEFAULT_LIMIT} устройство на каждую ОС</i>\n"
+        text += "💳 Купить дополнительные слоты: /buy_slots"
+        
+        return {'text': text, 'parse_mode': "HTML"}
+    
+    def render_devices(self, view: UserView) -> dict:
+        keyboard = types.InlineKeyboardMarkup(inline_keyboard=[])
+        
+        for device in view.devices:
             keyboard.inline_keyboard.append([
                 types.InlineKeyboardButton(
-                    text="🔄 Обновить",
-                    callback_data="refresh_devices"
+                    text=f"🗑 Отключить {device.os_type.value}",
+                    callback_data=f"remove_device:{device.os_type.value}"
                 )
             ])
-            
-            await message.answer(
-                "🔧 Управление устройствами:",
-                reply_markup=keyboard
+        
+        keyboard.inline_keyboard.append([
+            types.InlineKeyboardButton(
+                text="🔄 Обновить",
+                callback_data="refresh_devices"
             )
+        ])
+        
+        return {'text': "🔧 Управление устройствами:", 'reply_markup': keyboard}
+    
+    def os_limit(self, user_id: str, os_name: str) -> int:
+        """Лимит пользователя по ОС из снимка (LimitService: тариф и покупки)"""
+        return dict(self.limiter.views.get(user_id).limits).get(DeviceOS(os_name), DEFAULT_LIMIT)
+    
+    async def complete_os_slot_purchase(self, user_id: str, os_name: str, slots: int = 1):
+        """Оплата buy_os_slot подтверждена: слот записан, новый лимит действует сразу"""
+        return await self.limiter.add_os_slots(user_id, DeviceOS(os_name), slots)
     
     async def notify_user_blocked(self, user_id: str, connection: dict, reason: str):
-        """Уведомление о блокировке"""
-        telegram_id = await self.get_telegram_id(user_id)
-        
-        os_type = self.limiter.device_manager.os_detector.detect_os_from_connection(connection)
-        
+        """Уведомление о блокировке (ставится в очередь, сеть не ждем)"""
         if "already_exists" in reason:
             os_name = reason.split(":")[1]
             text = (
                 f"⛔ <b>Подключение заблокировано!</b>\n\n"
-                f"Обнаружена попытка подключения второго устройства {os_name.upper()}\n"
+                f"Обнаружена попытка подключения лишнего устройства {os_name.upper()}\n"
                 f"IP: {connection['ip']}\n\n"
-                f"На вашем тарифе разрешено только 1 устройство каждого типа.\n\n"
+                f"На вашем тарифе разрешено устройств {os_name.upper()}: {self.os_limit(user_id, os_name)}.\n\n"
                 f"Варианты решения:\n"
                 f"1️⃣ Отключите текущее {os_name.upper()} устройство\n"
                 f"2️⃣ Купите дополнительный слот для {os_name.upper()}\n"
@@ -89,7 +160,7 @@ class VPNBotWithOSLimit:
             
             keyboard = types.InlineKeyboardMarkup(inline_keyboard=[
                 [types.InlineKeyboardButton(
-                    text=f"💳 Купить слот {os_name.upper()} (299₽)",
+                    text=f"💳 Купить слот {os_name.upper()} ({SLOT_PRICE}₽)",
                     callback_data=f"buy_os_slot:{os_name}"
                 )],
                 [types.InlineKeyboardButton(
@@ -98,9 +169,36 @@ class VPNBotWithOSLimit:
                 )]
             ])
             
-            await self.bot.send_message(
-                telegram_id,
-                text,
-                reply_markup=keyboard,
-                parse_mode="HTML"
-            )
\ No newline at end of file
+            # Одна причина (например already_exists:ios) - одно сообщение за кулдаун
+            self.outbox.enqueue(user_id, reason, {
+                'text': text,
+                'reply_markup': keyboard,
+                'parse_mode': "HTML"
+            })
+        
+        elif reason.startswith("displaced:"):
+            os_name = reason.split(":")[1]
+            text = (
+                f"🔄 <b>Устройство {os_name.upper()} отключено</b>\n\n"
+                f"Новое устройство {os_name.upper()} заняло слот устройства, "
+                f"которое дольше всех не было активно (IP: {connection['ip']}).\n\n"
+                f"Чтобы пользоваться обоими, купите дополнительный слот для {os_name.upper()}."
+            )
+            
+            keyboard = types.InlineKeyboardMarkup(inline_keyboard=[
+                [types.InlineKeyboardButton(
+                    text=f"💳 Купить слот {os_name.upper()} ({SLOT_PRICE}₽)",
+                    callback_data=f"buy_os_slot:{os_name}"
+                )]
+            ])
+            
+            self.outbox.enqueue(user_id, reason, {
+                'text': text,
+                'reply_markup': keyboard,
+                'parse_mode': "HTML"
+            })
+    
+    async def send_notification(self, user_id: str, payload: dict):
+        """Отправка из очереди; TelegramRetryAfter учитывается очередью"""
+        telegram_id = await self.get_telegram_id(user_id)
+        await self.bot.send_message(telegram_id, **payload)
\ No newline at end of file
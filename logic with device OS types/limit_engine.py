@@ -0,0 +1,153 @@
+# Решения по подключениям без сетевого ввода-вывода: ОС -> отпечаток -> лимит
+
+import time
+from datetime import datetime
+from typing import Dict, Iterable, List, Optional, Tuple
+
+from connection_state import ConnectionState
+from common.device_registry import DeviceRecord
+from common.fingerprint import fingerprint
+from tls_fingerprint import OS_BY_CODE
+
+
+def displaced_connection(record: DeviceRecord, conn: dict) -> dict:
+    """Подключение вытесненного устройства для блокировки и уведомления"""
+    return {
+        'ip': record.ip,
+        'port': 0,
+        'user_id': conn['user_id'],
+        'timestamp': conn['timestamp'],
+        'device': record.fingerprint,
+    }
+
+
+class LimitEngine:
+    """Проверка лимитов для набора пользователей.
+
+    Используется и в обычном режиме внутри XRayOSLimiter, и в дочерних
+    процессах шардов (см. sharding.py): блокировки и уведомления выполняет
+    вызывающий код по возвращенным решениям.
+    """
+
+    def __init__(self, device_manager):
+        self.device_manager = device_manager
+        # Уже допущенные устройства; лимиты пересчитываются только по новым
+        self.connection_state = ConnectionState()
+        # Время стадий с прошлого drain_timings(); копится без обращений к метрикам
+        self.timings = {'detect': 0.0, 'fingerprint': 0.0, 'decide': 0.0}
+
+    def apply_events(self, connections: Dict[str, List[dict]]) -> Dict[str, List[dict]]:
+        """Учет новых событий; возвращает подключения, требующие проверки лимита"""
+        start = time.perf_counter()
+        state = self.connection_state
+        touch = self.device_manager.touch_device
+
+        for user_id, conn_list in connections.items():
+            for conn in conn_list:
+                device_fingerprint = state.apply(user_id, conn)
+                if device_fingerprint is not None and not touch(user_id, device_fingerprint, conn['ip']):
+                    # Устройство пропало из реестра - проверим подключение заново
+                    state.forget(user_id, device_fingerprint)
+                    state.apply(user_id, conn)
+
+        self.timings['decide'] += time.perf_counter() - start
+        return state.drain_dirty()
+
+    def expire(self, now: Optional[float] = None) -> list:
+        """Истечение простаивающих устройств; их подключения снова требуют проверки"""
+        start = time.perf_counter()
+        expired = self.device_manager.expire_idle(now)
+        for user_id, record in expired:
+            self.connection_state.forget(user_id, record.fingerprint)
+        self.timings['decide'] += time.perf_counter() - start
+        return expired
+
+    def reconcile_cluster(self, user_ids: Iterable[str]) -> Dict[str, List[Tuple[dict, str]]]:
+        """Свои устройства, потерявшие слот из-за устройств на других узлах, с причиной"""
+        start = time.perf_counter()
+        device_manager = self.device_manager
+        rejected: Dict[str, List[Tuple[dict, str]]] = {}
+        now = datetime.now()
+
+        for user_id in user_ids:
+            for record in device_manager.reconcile_cluster(user_id):
+                self.connection_state.forget(user_id, record.fingerprint)
+                conn = {'ip': record.ip, 'port': 0, 'user_id': user_id, 'timestamp': now,
+                        'device': record.fingerprint}
+                rejected.setdefault(user_id, []).append(
+                    (conn, f"already_exists:{OS_BY_CODE[record.os_code].value}")
+                )
+
+        self.timings['decide'] += time.perf_counter() - start
+        return rejected
+
+    def displace(self) -> List[DeviceRecord]:
+        """Вытесненные устройства: их подключения снова требуют проверки"""
+        records = []
+        for user_id, record in self.device_manager.drain_displaced():
+            self.connection_state.forget(user_id, record.fingerprint)
+            records.append(record)
+        return records
+
+    def drain_timings(self) -> Dict[str, float]:
+        """Время стадий detect/fingerprint/decide с прошлого вызова"""
+        timings = self.timings
+        self.timings = dict.fromkeys(timings, 0.0)
+        return timings
+
+    def cache_stats(self) -> Dict[str, Tuple[int, int]]:
+        """Попадания и промахи кэшей движка: (hits, misses)"""
+        detector = self.device_manager.os_detector
+        fp_cache = fingerprint.cache_info()
+        state = self.connection_state.stats
+        return {
+            'os_detector': (detector.cache_hits, detector.cache_misses),
+            'fingerprint': (fp_cache.hits, fp_cache.misses),
+            'connection_state': (state['known'], state['dirty']),
+        }
+
+    async def evaluate(self, user_id: str,
+                       connections: List[dict]) -> Tuple[Dict[bytes, dict], List[Tuple[dict, str]]]:
+        """Допущенные подключения по отпечатку устройства и отклоненные с причиной"""
+        device_manager = self.device_manager
+        os_detector = device_manager.os_detector
+        admitted: Dict[bytes, dict] = {}
+        rejected: List[Tuple[dict, str]] = []
+        perf_counter = time.perf_counter
+        detect = fingerprinting = decide = 0.0
+
+        for conn in connections:
+            # ОС и отпечаток вычисляются один раз и передаются дальше по цепочке
+            t0 = perf_counter()
+            os_type = os_detector.detect_os_from_connection(conn)
+            t1 = perf_counter()
+            device_fingerprint = device_manager.create_device_fingerprint(conn, os_type)
+            t2 = perf_counter()
+
+            # Проверяем лимит устройства
+            allowed, reason = await device_manager.check_device_limit(
+                user_id, conn, os_type, device_fingerprint
+            )
+
+            if allowed:
+                self.connection_state.remember(user_id, conn, device_fingerprint)
+                admitted[device_fingerprint] = conn
+                # Политика newest_wins: новое устройство заняло слот давно неактивного
+                if device_manager.displaced:
+                    for record in self.displace():
+                        admitted.pop(record.fingerprint, None)
+                        rejected.append((displaced_connection(record, conn), f"displaced:{os_type.value}"))
+            else:
+                # Отпечаток отклоненного устройства: за одним IP (NAT) бывают и допущенные
+                conn['device'] = device_fingerprint
+                rejected.append((conn, reason))
+
+            detect += t1 - t0
+            fingerprinting += t2 - t1
+            decide += perf_counter() - t2
+
+        timings = self.timings
+        timings['detect'] += detect
+        timings['fingerprint'] += fingerprinting
+        timings['decide'] += decide
+        return admitted, rejected
@@ -0,0 +1,123 @@
+# Купленные лимиты слотов по ОС в памяти: user_os_limits без запросов к БД на горячем пути
+
+import asyncio
+import sqlite3
+from typing import Callable, Dict, Iterator, Optional
+
+from state_loader import USER_BASE_LIMIT_SQL, load_base_limits, load_os_limits
+from tls_fingerprint import DeviceOS
+
+# Слотов на каждую ОС без покупок, если в users нет лимита тарифа
+DEFAULT_LIMIT = 1
+
+OS_LIMITS_SCHEMA = """
+CREATE TABLE IF NOT EXISTS user_os_limits (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    user_id VARCHAR(36) NOT NULL,
+    os_type VARCHAR(20) NOT NULL,
+    device_limit INTEGER DEFAULT 1,
+    purchased_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+    UNIQUE(user_id, os_type)
+);
+"""
+
+# device_limit - итоговое число слотов ОС: покупка добавляет слоты к лимиту тарифа
+# (или к прошлым покупкам, если их больше - тариф могли повысить после покупки)
+PURCHASE_SQL = """
+INSERT INTO user_os_limits (user_id, os_type, device_limit) VALUES (?, ?, ?)
+ON CONFLICT(user_id, os_type) DO UPDATE SET
+    device_limit = MAX(device_limit, ?) + ?,
+    purchased_at = CURRENT_TIMESTAMP
+"""
+
+
+def record_slot_purchase(db_path: str, user_id: str, os_type: DeviceOS, slots: int = 1,
+                         default: int = DEFAULT_LIMIT):
+    """Запись купленных слотов ОС в user_os_limits"""
+    conn = sqlite3.connect(db_path)
+    try:
+        conn.executescript(OS_LIMITS_SCHEMA)
+        try:
+            row = conn.execute(USER_BASE_LIMIT_SQL, (user_id,)).fetchone()
+        except sqlite3.OperationalError:
+            row = None  # таблицы users нет - лимит тарифа по умолчанию
+        base = row[1] if row else default
+        with conn:
+            conn.execute(PURCHASE_SQL, (user_id, os_type.value, base + slots, base, slots))
+    finally:
+        conn.close()
+
+
+class LimitService:
+    """user_id -> {ОС: число слотов}; хранятся только пользователи с покупками.
+
+    Без записи в user_os_limits у пользователя лимит тарифа (users.device_limit,
+    иначе default) слотов на каждую ОС; покупки его не уменьшают.
+    После покупки слота записи пользователя перечитываются из БД
+    (invalidate), и проверка лимита сразу видит новое значение.
+    """
+
+    def __init__(self, db_path: str, user_filter: Optional[Callable[[str], bool]] = None,
+                 default: int = DEFAULT_LIMIT):
+        self.db_path = db_path
+        self.user_filter = user_filter
+        self.default = default
+        self._limits: Dict[str, Dict[DeviceOS, int]] = {}
+        self._base: Dict[str, int] = {}  # лимиты тарифа, отличные от default
+
+    async def load(self) -> int:
+        """Загрузка всех лимитов; возвращает число пользователей с покупками"""
+        self._limits = await asyncio.to_thread(load_os_limits, self.db_path, self.user_filter)
+        base = await asyncio.to_thread(load_base_limits, self.db_path, self.user_filter)
+        self._base = {}
+        for user_id, limit in base.items():
+            self.set_base(user_id, limit)
+        return len(self._limits)
+
+    def base(self, user_id: str) -> int:
+        """Лимит тарифа на каждую ОС"""
+        return self._base.get(user_id, self.default)
+
+    def set_base(self, user_id: str, limit: int):
+        if limit == self.default:
+            self._base.pop(user_id, None)
+        else:
+            self._base[user_id] = limit
+
+    def get(self, user_id: str, os_type: DeviceOS) -> int:
+        base = self._base.get(user_id, self.default)
+        limits = self._limits.get(user_id)
+        if limits is None:
+            return base
+        return max(limits.get(os_type, base), base)
+
+    def user_limits(self, user_id: str) -> Dict[DeviceOS, int]:
+        """Купленные лимиты пользователя (без ОС с лимитом по умолчанию)"""
+        return dict(self._limits.get(user_id, {}))
+
+    def effective_limits(self, user_id: str) -> Dict[DeviceOS, int]:
+        """Лимит на каждую ОС с учетом лимита по умолчанию"""
+        return {
+            os_type: self.get(user_id, os_type) for os_type in DeviceOS if os_type != DeviceOS.UNKNOWN
+        }
+
+    def users(self) -> Iterator[str]:
+        """Пользователи с покупками или лимитом тарифа не по умолчанию"""
+        return iter(self._limits.keys() | self._base.keys())
+
+    def set(self, user_id: str, os_type: DeviceOS, limit: int):
+        self._limits.setdefault(user_id, {})[os_type] = limit
+
+    async def invalidate(self, user_id: str) -> Dict[DeviceOS, int]:
+        """Покупка завершена - перечитываем лимиты пользователя из БД"""
+        limits = await asyncio.to_thread(load_os_limits, self.db_path, None, user_id)
+        if user_id in limits:
+            self._limits[user_id] = limits[user_id]
+        else:
+            self._limits.pop(user_id, None)
+        base = await asyncio.to_thread(load_base_limits, self.db_path, None, user_id)
+        self.set_base(user_id, base.get(user_id, self.default))
+        return self.user_limits(user_id)
+
+    def __len__(self) -> int:
+        return len(self._limits)
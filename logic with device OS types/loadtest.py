@@ -0,0 +1,253 @@
+# Нагрузочный прогон XRayOSLimiter: синтетический access.log, заглушки xRay и Telegram
+#
+#   python loadtest.py --users 1000,10000,100000 --ticks 20 --lines-per-tick 20000
+#   python loadtest.py --users 10000 --churn 0.05 --os-mix ios=0.5,android=0.5 --shards 4
+#   python loadtest.py --users 10000 --ingest unixgram   # строки через сокет, а не файл
+#   python loadtest.py --users 10000 --newest-wins       # вытеснение вместо отказа
+#
+# Каждый масштаб прогоняется в отдельном процессе, чтобы пик памяти не смешивался;
+# RSS - только процесс лимитера, процессы шардов (--shards) в него не входят
+
+import argparse
+import asyncio
+import multiprocessing
+import os
+import resource
+import socket
+import tempfile
+import time
+from concurrent.futures import ProcessPoolExecutor
+from typing import Dict, List, Optional
+
+import common_path  # noqa: F401 - корень репозитория в sys.path: пакет common
+from common.fake_apis import FakeTelegramAPI, FakeXRayAPI
+from common.loadgen import SyntheticPopulation
+from common.metrics import REJECTED
+from common.notify_outbox import NotificationOutbox, RetryAfter
+from xray_scan import XRayOSLimiter
+
+BOT_TOKEN = 'loadtest'
+
+
+class LoadTestOSLimiter(XRayOSLimiter):
+    """Лимитер, который уведомляет через заглушку Bot API, а не через aiogram-бота"""
+
+    def __init__(self, *args, telegram_api_url: str, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.telegram_api_url = telegram_api_url
+        self.outbox = NotificationOutbox(self.send_notification)
+
+    async def notify_user_blocked(self, user_id: str, connection: dict, reason: str):
+        self.outbox.enqueue(user_id, reason, {'text': f"Blocked {connection['ip']}: {reason}"})
+
+    async def send_notification(self, user_id: str, payload: dict):
+        result = await self.http.post_json(
+            f'{self.telegram_api_url}/bot{BOT_TOKEN}/sendMessage',
+            {'chat_id': user_id, **payload},
+            check_status=False  # ошибки Bot API - в теле ответа (ok, retry_after)
+        )
+        if not result.get('ok'):
+            retry_after = result.get('parameters', {}).get('retry_after')
+            if retry_after is not None:
+                raise RetryAfter(retry_after)
+            raise RuntimeError(result.get('description', 'Telegram API error'))
+
+    async def update_user_stats(self, user_id: str, os_devices: dict):
+        pass
+
+    async def close(self):
+        await self.outbox.close()
+        await super().close()
+
+
+class LogWriter:
+    """Сторона xRay: дописывает строки в файл, сокет или FIFO"""
+
+    DATAGRAM = 32 * 1024
+
+    def __init__(self, ingest: str, path: str):
+        self.ingest = ingest
+        self.path = path
+        self._file = None
+        self._sock = None
+
+    @property
+    def source(self) -> str:
+        """Что передать лимитеру в access_log"""
+        return self.path if self.ingest == 'file' else f'{self.ingest}://{self.path}'
+
+    def open(self):
+        if self.ingest == 'file':
+            self._file = open(self.path, 'ab')
+        elif self.ingest == 'fifo':
+            self._file = open(self.path, 'wb')
+        elif self.ingest == 'unix':
+            self._sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            self._sock.connect(self.path)
+        else:
+            self._sock = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+            self._sock.connect(self.path)
+
+    def write(self, lines: List[str]):
+        """Вызывается в потоке: запись в сокет может ждать, пока лимитер разберет буфер"""
+        data = ('\n'.join(lines) + '\n').encode()
+        if self._file is not None:
+            self._file.write(data)
+            self._file.flush()
+        elif self.ingest == 'unix':
+            self._sock.sendall(data)
+        else:
+            # Датаграмма - целые строки, не больше DATAGRAM байт
+            start = 0
+            while start < len(data):
+                end = data.rfind(b'\n', start, start + self.DATAGRAM) + 1
+                if end <= start:
+                    end = data.index(b'\n', start) + 1
+                self._sock.send(data[start:end])
+                start = end
+
+    def close(self):
+        if self._file is not None:
+            self._file.close()
+        if self._sock is not None:
+            self._sock.close()
+
+
+def percentile(values: List[float], q: float) -> float:
+    """Перцентиль по ближайшему рангу"""
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(q / 100 * len(ordered)))]
+
+
+def parse_os_mix(value: Optional[str]) -> Optional[Dict[str, float]]:
+    if not value:
+        return None
+    return {name: float(share) for name, share in (item.split('=') for item in value.split(','))}
+
+
+async def run_scenario(users: int, ticks: int, lines_per_tick: int, churn: float,
+                       devices_per_user: tuple, os_mix: Optional[Dict[str, float]],
+                       shards: int, ingest: str, newest_wins: bool) -> dict:
+    population = SyntheticPopulation(users, devices_per_user, os_mix, churn=churn)
+    xray_api = FakeXRayAPI()
+    telegram_api = FakeTelegramAPI()
+    await xray_api.start()
+    await telegram_api.start()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        writer = LogWriter(ingest, os.path.join(tmp, 'access.log'))
+        if ingest == 'file':
+            open(writer.path, 'w').close()
+        limiter = LoadTestOSLimiter(
+            'config.json', None,
+            db_path=os.path.join(tmp, 'devices.db'),
+            shards=shards,
+            access_log=writer.source,
+            log_checkpoint=os.path.join(tmp, 'access.log.offset'),
+            xray_api_url=xray_api.url,
+            telegram_api_url=telegram_api.url,
+            newest_wins=newest_wins
+        )
+        await limiter.restore_state()
+        await limiter.log_source.start()
+        # Первый тик открывает пустой лог - дальше читается только дописанное
+        await limiter.tick()
+        await asyncio.to_thread(writer.open)
+
+        tick_seconds = []
+        decision_seconds = []  # от записи пачки до решений по ней, как в цикле monitor_connections
+        lines_total = 0
+        for _ in range(ticks):
+            population.step()
+            lines = population.log_lines(lines_per_tick)
+            lines_total += len(lines)
+
+            written = time.perf_counter()
+            await asyncio.to_thread(writer.write, lines)
+            await limiter.log_source.wait(2)
+            start = time.perf_counter()
+            await limiter.tick()
+            tick_seconds.append(time.perf_counter() - start)
+            decision_seconds.append(time.perf_counter() - written)
+        writer.close()
+
+        # Даем очереди уведомлений отработать то, что уже можно отправить
+        await asyncio.sleep(1)
+        result = {
+            'users': users,
+            'devices': population.device_count,
+            'lines': lines_total,
+            'lines_per_second': lines_total / sum(tick_seconds),
+            'p50': percentile(tick_seconds, 50),
+            'p95': percentile(tick_seconds, 95),
+            'p99': percentile(tick_seconds, 99),
+            'max': max(tick_seconds),
+            'decision_p50': percentile(decision_seconds, 50),
+            'rss_mb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024,
+            'rejected': REJECTED.labels().value,
+            'blocked_ips': xray_api.blocked_ips,
+            'xray_batches': xray_api.batches,
+            'messages': telegram_api.sent,
+            'outbox_depth': limiter.outbox.depth,
+        }
+        await limiter.close()
+
+    await xray_api.close()
+    await telegram_api.close()
+    return result
+
+
+def run_in_process(kwargs: dict) -> dict:
+    return asyncio.run(run_scenario(**kwargs))
+
+
+def report(result: dict):
+    print(
+        f"{result['users']:>8,} польз. {result['devices']:>8,} устр.  "
+        f"{result['lines_per_second']:>9,.0f} строк/с  "
+        f"тик p50 {result['p50'] * 1000:7.1f} p95 {result['p95'] * 1000:7.1f} "
+        f"p99 {result['p99'] * 1000:7.1f} мс  до решения p50 {result['decision_p50'] * 1000:7.1f} мс  RSS {result['rss_mb']:6.0f} МБ  "
+        f"отклонено {result['rejected']:,}  IP в блоке {result['blocked_ips']:,}  "
+        f"сообщений {result['messages']:,} (в очереди {result['outbox_depth']:,})"
+    )
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--users', default='1000,10000,100000')
+    parser.add_argument('--ticks', type=int, default=20)
+    parser.add_argument('--lines-per-tick', type=int, default=20000)
+    parser.add_argument('--churn', type=float, default=0.01)
+    parser.add_argument('--devices', default='1,3', help='устройств на пользователя: min,max')
+    parser.add_argument('--os-mix', default=None, help='например ios=0.3,android=0.5,windows=0.2')
+    parser.add_argument('--shards', type=int, default=0)
+    parser.add_argument('--ingest', default='file', choices=('file', 'unix', 'unixgram', 'fifo'))
+    parser.add_argument('--newest-wins', action='store_true',
+                        help='новое устройство вытесняет давно неактивное той же ОС')
+    args = parser.parse_args()
+
+    devices_per_user = tuple(int(n) for n in args.devices.split(','))
+    print(f"тиков {args.ticks}, строк за тик {args.lines_per_tick:,}, churn {args.churn}, "
+          f"шардов {args.shards or 1}, прием {args.ingest}"
+          f"{', newest wins' if args.newest_wins else ''}")
+
+    for users in map(int, args.users.split(',')):
+        # spawn: свежий процесс на каждый масштаб, RSS не наследуется
+        with ProcessPoolExecutor(1, mp_context=multiprocessing.get_context('spawn')) as pool:
+            report(pool.submit(run_in_process, {
+                'users': users,
+                'ticks': args.ticks,
+                'lines_per_tick': args.lines_per_tick,
+                'churn': args.churn,
+                'devices_per_user': devices_per_user,
+                'os_mix': parse_os_mix(args.os_mix),
+                'shards': args.shards,
+                'ingest': args.ingest,
+                'newest_wins': args.newest_wins,
+            }).result())
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,134 @@
+# Инкрементальное чтение access.log xRay (аналог tail -F с чекпоинтом)
+
+import asyncio
+import json
+import os
+from typing import List, Optional
+
+
+class LogFollower:
+    """Читает только дописанные в лог байты, переживает ротацию и рестарт"""
+
+    def __init__(self, path: str, checkpoint_path: Optional[str] = None,
+                 max_bytes: int = 8 * 1024 * 1024, start_at_end: bool = True):
+        self.path = path
+        self.checkpoint_path = checkpoint_path
+        self.max_bytes = max_bytes  # Сколько байт максимум читаем за один тик
+        self.start_at_end = start_at_end
+
+        self._file = None
+        self._inode: Optional[int] = None
+        self._offset = 0  # Позиция в файле после последнего чтения
+        self._partial = b''  # Хвост строки без перевода строки
+
+        self._restore_checkpoint()
+
+    async def start(self):
+        """Файл открывается при первом чтении"""
+
+    async def read_new_lines(self) -> List[str]:
+        """Новые полные строки лога с прошлого вызова"""
+        return await asyncio.to_thread(self._read_new_lines)
+
+    async def wait(self, timeout: float):
+        """Файл опрашивается по таймеру - просто ждем следующего опроса"""
+        await asyncio.sleep(timeout)
+
+    async def save_checkpoint(self):
+        """Сохранение позиции чтения на диск"""
+        await asyncio.to_thread(self._save_checkpoint)
+
+    def close(self):
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+    @property
+    def committed_offset(self) -> int:
+        """Позиция начала первой необработанной строки"""
+        return self._offset - len(self._partial)
+
+    def _read_new_lines(self) -> List[str]:
+        data = b''
+
+        try:
+            st = os.stat(self.path)
+        except FileNotFoundError:
+            # Файл переименован ротацией, новый еще не создан - дочитываем старый
+            if self._file is not None:
+                data = self._drain()
+            return self._split_lines(data)
+
+        if self._file is None or st.st_ino != self._inode:
+            if self._file is not None:
+                # Ротация: дочитываем остаток старого файла и переходим на новый
+                data = self._drain()
+            self._open(st, offset=self._initial_offset(st))
+        elif st.st_size < self._offset:
+            # Файл обрезан (copytruncate) - читаем сначала
+            self._file.seek(0)
+            self._offset = 0
+            self._partial = b''
+
+        if st.st_size > self._offset:
+            data += self._file.read(min(st.st_size - self._offset, self.max_bytes))
+            self._offset = self._file.tell()
+
+        return self._split_lines(data)
+
+    def _initial_offset(self, st: os.stat_result) -> int:
+        """Позиция старта: из чекпоинта, начало нового файла или конец файла"""
+        if self._inode is None:
+            return st.st_size if self.start_at_end else 0
+        if self._inode == st.st_ino and self._offset <= st.st_size:
+            return self._offset
+        # Файл сменился после ротации (в том числе пока сервис был остановлен)
+        return 0
+
+    def _open(self, st: os.stat_result, offset: int):
+        self._file = open(self.path, 'rb')
+        self._file.seek(offset)
+        self._inode = st.st_ino
+        self._offset = offset
+        self._partial = b''
+
+    def _drain(self) -> bytes:
+        """Дочитывание и закрытие текущего файла"""
+        data = self._partial + self._file.read()
+        self.close()
+        self._offset = 0
+        self._partial = b''
+        if data:
+            # Последняя строка старого файла завершена, даже без \n
+            data += b'\n'
+        return data
+
+    def _split_lines(self, data: bytes) -> List[str]:
+        if not data:
+            return []
+
+        data = self._partial + data
+        lines = data.split(b'\n')
+        self._partial = lines.pop()
+
+        return [line.decode('utf-8', 'replace') for line in lines if line]
+
+    def _restore_checkpoint(self):
+        if not self.checkpoint_path:
+            return
+        try:
+            with open(self.checkpoint_path, 'r') as f:
+                checkpoint = json.load(f)
+            self._inode = checkpoint['inode']
+            self._offset = checkpoint['offset']
+        except (FileNotFoundError, ValueError, KeyError):
+            pass
+
+    def _save_checkpoint(self):
+        if not self.checkpoint_path or self._inode is None:
+            return
+
+        tmp_path = f"{self.checkpoint_path}.tmp"
+        with open(tmp_path, 'w') as f:
+            json.dump({'inode': self._inode, 'offset': self.committed_offset}, f)
+        os.replace(tmp_path, self.checkpoint_path)
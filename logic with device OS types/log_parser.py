@@ -0,0 +1,149 @@
+# Пакетный парсер access.log xRay
+
+import json
+import re
+from datetime import datetime
+from functools import lru_cache
+from typing import Iterable, List, Optional, Tuple
+
+# Запасной вариант для нестандартных строк: IP:port ... user:[id] ... tls:{...} ... tcp:{...}
+LEGACY_PATTERN = re.compile(
+    r'(\d+\.\d+\.\d+\.\d+):(\d+).*user:\[([\w@.-]+)\].*tls:(\{.*?\}).*tcp:(\{.*?\})'
+)
+
+TIMESTAMP_FORMAT = '%Y/%m/%d %H:%M:%S'
+
+
+@lru_cache(maxsize=65536)
+def _decode_blob(blob: str) -> dict:
+    """JSON блоков tls/tcp; у одного клиента они повторяются, поэтому кэшируем.
+
+    Возвращается общий объект - вызывающий код не должен его изменять.
+    """
+    try:
+        return json.loads(blob)
+    except ValueError:
+        return {}
+
+
+def _find_blob(line: str, marker: str) -> str:
+    """Исходный текст блока `{...}` после marker или пустая строка"""
+    start = line.find(marker)
+    if start < 0:
+        return ''
+    start += len(marker) - 1
+    end = line.find('}', start)
+    if end < 0:
+        return ''
+    return line[start:end + 1]
+
+
+def is_connection_line(line: str) -> bool:
+    """Строка о принятом подключении; DNS-лог, отладка и отклоненные подключения - шум"""
+    return (' accepted ' in line and ' email: ' in line) or 'user:[' in line
+
+
+class AccessLogParser:
+    """Разбор строк вида `<дата> from IP:port accepted ... email: user`"""
+
+    def __init__(self):
+        # Строки одной секунды идут подряд - разбираем дату один раз
+        self._last_second: Optional[str] = None
+        self._last_dt: Optional[datetime] = None
+        self.fallback_lines = 0
+
+    def parse_lines(self, lines: Iterable[str]) -> List[dict]:
+        """Разбор пачки строк, нераспознанные строки пропускаются"""
+        now = datetime.now()
+        parse = self._parse_fast
+        result = []
+
+        for line in lines:
+            conn = parse(line, now)
+            if conn is None and 'user:[' in line:
+                conn = self._parse_legacy(line, now)
+            if conn is not None:
+                result.append(conn)
+
+        return result
+
+    @staticmethod
+    def blob_cache_stats() -> Tuple[int, int]:
+        """Попадания и промахи кэша блоков tls/tcp (общий на процесс)"""
+        info = _decode_blob.cache_info()
+        return info.hits, info.misses
+
+    def parse_line(self, line: str) -> Optional[dict]:
+        now = datetime.now()
+        conn = self._parse_fast(line, now)
+        if conn is None and 'user:[' in line:
+            conn = self._parse_legacy(line, now)
+        return conn
+
+    def _parse_fast(self, line: str, now: datetime) -> Optional[dict]:
+        head, sep, rest = line.partition(' from ')
+        if not sep:
+            return None
+
+        source, _, rest = rest.partition(' ')
+        if not rest.startswith('accepted '):
+            return None
+
+        _, sep, email = rest.partition(' email: ')
+        if not sep:
+            return None
+        user_id = email.split(' ', 1)[0].rstrip()
+        if not user_id:
+            return None
+
+        # Источник бывает вида tcp:1.2.3.4:5678 или [2001:db8::1]:5678
+        if source.startswith(('tcp:', 'udp:')):
+            source = source[4:]
+        ip, _, port = source.rpartition(':')
+        if ip.startswith('['):
+            ip = ip[1:-1]
+
+        tls_blob = _find_blob(rest, 'tls:{')
+        tcp_blob = _find_blob(rest, 'tcp:{')
+        return {
+            'ip': ip,
+            'port': port,
+            'user_id': user_id,
+            'tls': _decode_blob(tls_blob) if tls_blob else {},
+            'tcp': _decode_blob(tcp_blob) if tcp_blob else {},
+            # Дешевый ключ сигнатуры: одинаковые блоки tls/tcp - одно и то же устройство
+            'signature': hash((tls_blob, tcp_blob)),
+            'timestamp': self._parse_timestamp(head, now)
+        }
+
+    def _parse_legacy(self, line: str, now: datetime) -> Optional[dict]:
+        match = LEGACY_PATTERN.search(line)
+        if not match:
+            return None
+
+        self.fallback_lines += 1
+        return {
+            'ip': match.group(1),
+            'port': match.group(2),
+            'user_id': match.group(3),
+            'tls': _decode_blob(match.group(4)),
+            'tcp': _decode_blob(match.group(5)),
+            'signature': hash((match.group(4), match.group(5))),
+            'timestamp': self._parse_timestamp(line[:match.start()], now)
+        }
+
+    def _parse_timestamp(self, head: str, now: datetime) -> datetime:
+        """Время из самой строки лога (2024/01/31 12:00:00.123456)"""
+        second = head[:19]
+        if second != self._last_second:
+            try:
+                self._last_dt = datetime.strptime(second, TIMESTAMP_FORMAT)
+            except ValueError:
+                return now
+            self._last_second = second
+
+        if head[19:20] == '.':
+            micro = head[20:26]
+            if micro.isdigit():
+                return self._last_dt.replace(microsecond=int(micro.ljust(6, '0')))
+        return self._last_dt
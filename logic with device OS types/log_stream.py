@@ -0,0 +1,213 @@
+# Прием access.log xRay через Unix-сокет или именованный канал вместо чтения файла с диска
+#
+#   unix:///run/xray/access.sock      - потоковый сокет (например, socat/vector перед ним)
+#   unixgram:///run/xray/access.sock  - датаграммы, одна или несколько строк в каждой
+#   fifo:///run/xray/access.pipe      - именованный канал, в который xRay пишет access.log
+#
+# xRay пишет в FIFO как в обычный файл; пока лимитер остановлен, запись в канал
+# блокируется после заполнения буфера ядра, поэтому FIFO стоит включать вместе
+# с супервизором, перезапускающим лимитер.
+
+import asyncio
+import os
+import socket
+import stat
+from collections import deque
+from typing import Deque, List, Optional
+
+from log_follower import LogFollower
+from log_parser import is_connection_line
+from common.metrics import LOG_DISCARDED, QUEUE_DEPTH
+
+MAX_LINE = 64 * 1024  # строка длиннее - мусор или обрыв, ее не буферизуем
+
+
+class _LineProtocol(asyncio.Protocol):
+    """Поток байт -> строки; незавершенный хвост ждет следующего куска"""
+
+    def __init__(self, stream: 'LogStream'):
+        self.stream = stream
+        self.transport = None
+        self._partial = b''
+        # Хвост слишком длинной строки еще идет - пропускаем байты до конца строки
+        self._skipping = False
+
+    def connection_made(self, transport):
+        self.transport = transport
+
+    def data_received(self, data: bytes):
+        if self._skipping:
+            newline = data.find(b'\n')
+            if newline < 0:
+                return
+            data = data[newline + 1:]
+            self._skipping = False
+        data = self._partial + data
+        lines = data.split(b'\n')
+        self._partial = lines.pop()
+        if len(self._partial) > MAX_LINE:
+            self.stream.discard('oversized')
+            self._partial = b''
+            self._skipping = True
+        feed = self.stream.feed
+        for line in lines:
+            if line:
+                feed(line.decode('utf-8', 'replace'))
+
+    def eof_received(self):
+        if self._partial:
+            self.stream.feed(self._partial.decode('utf-8', 'replace'))
+            self._partial = b''
+        return False
+
+    def connection_lost(self, exc):
+        self.stream.connection_lost(self)
+
+
+class _DatagramProtocol(asyncio.DatagramProtocol):
+    def __init__(self, stream: 'LogStream'):
+        self.stream = stream
+
+    def datagram_received(self, data: bytes, addr):
+        feed = self.stream.feed
+        for line in data.split(b'\n'):
+            if line:
+                feed(line.decode('utf-8', 'replace'))
+
+
+class LogStream:
+    """Строки лога приходят сами; между тиками копятся в ограниченном буфере.
+
+    Интерфейс как у LogFollower: read_new_lines/save_checkpoint/close, плюс
+    wait(), который возвращается, как только появились строки, - тик
+    начинается через миллисекунды после записи, а не по таймеру опроса.
+    При переполнении вытесняются самые старые строки: свежие подключения
+    важнее, а устройство из вытесненной строки скоро подключится снова.
+    """
+
+    def __init__(self, url: str, maxsize: int = 200000, prefilter: bool = True,
+                 coalesce: float = 0.02):
+        scheme, sep, path = url.partition('://')
+        if not sep or scheme not in ('unix', 'unixgram', 'fifo'):
+            raise ValueError(f"Unsupported log source: {url}")
+        self.scheme = scheme
+        self.path = path
+        self.maxsize = maxsize
+        self.prefilter = prefilter
+        self.coalesce = coalesce  # сколько подождать остальные строки пачки
+
+        self._lines: Deque[str] = deque()
+        self._ready = asyncio.Event()
+        self._server: Optional[asyncio.AbstractServer] = None
+        self._transport = None
+        self._fifo_keepalive: Optional[int] = None
+        self._protocols = set()
+
+        self.stats = {'received': 0, 'filtered': 0, 'dropped': 0, 'oversized': 0}
+        self._filtered = LOG_DISCARDED.labels('filtered')
+        self._dropped = LOG_DISCARDED.labels('overflow')
+        QUEUE_DEPTH.labels('log_buffer').set_function(lambda: len(self._lines))
+
+    async def start(self):
+        loop = asyncio.get_running_loop()
+        if self.scheme == 'fifo':
+            await self._open_fifo(loop)
+            return
+
+        # Сокет остался от прошлого запуска
+        if os.path.exists(self.path) and stat.S_ISSOCK(os.stat(self.path).st_mode):
+            os.unlink(self.path)
+        if self.scheme == 'unix':
+            self._server = await loop.create_unix_server(lambda: self._track(_LineProtocol(self)), self.path)
+        else:
+            sock = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, 4 * 1024 * 1024)
+            sock.bind(self.path)
+            self._transport, _ = await loop.create_datagram_endpoint(
+                lambda: _DatagramProtocol(self), sock=sock
+            )
+
+    def _track(self, protocol: _LineProtocol) -> _LineProtocol:
+        self._protocols.add(protocol)
+        return protocol
+
+    async def _open_fifo(self, loop: asyncio.AbstractEventLoop):
+        if not os.path.exists(self.path):
+            os.mkfifo(self.path, 0o620)
+        fd = os.open(self.path, os.O_RDONLY | os.O_NONBLOCK)
+        # Собственный писатель: без него рестарт xRay дал бы EOF и канал пришлось бы переоткрывать
+        if self._fifo_keepalive is None:
+            self._fifo_keepalive = os.open(self.path, os.O_WRONLY | os.O_NONBLOCK)
+        self._transport, _ = await loop.connect_read_pipe(
+            lambda: _LineProtocol(self), os.fdopen(fd, 'rb', buffering=0)
+        )
+
+    def connection_lost(self, protocol: _LineProtocol):
+        self._protocols.discard(protocol)
+
+    def feed(self, line: str):
+        """Горячий путь: фильтр шума и ограниченный буфер"""
+        self.stats['received'] += 1
+        if self.prefilter and not is_connection_line(line):
+            self.stats['filtered'] += 1
+            self._filtered.inc()
+            return
+        lines = self._lines
+        if len(lines) >= self.maxsize:
+            lines.popleft()
+            self.stats['dropped'] += 1
+            self._dropped.inc()
+        lines.append(line)
+        self._ready.set()
+
+    def discard(self, reason: str):
+        self.stats[reason] += 1
+        LOG_DISCARDED.labels(reason).inc()
+
+    @property
+    def depth(self) -> int:
+        return len(self._lines)
+
+    async def wait(self, timeout: float):
+        """До появления строк (но не дольше timeout), затем короткая пауза на добор пачки"""
+        if not self._lines:
+            self._ready.clear()
+            try:
+                await asyncio.wait_for(self._ready.wait(), timeout)
+            except asyncio.TimeoutError:
+                return
+        if self.coalesce:
+            await asyncio.sleep(self.coalesce)
+
+    async def read_new_lines(self) -> List[str]:
+        """Все накопленные строки; буфер освобождается"""
+        lines = list(self._lines)
+        self._lines.clear()
+        return lines
+
+    async def save_checkpoint(self):
+        """Позиции у потока нет: строки, пришедшие во время рестарта, теряются"""
+
+    def close(self):
+        if self._server is not None:
+            self._server.close()
+            self._server = None
+        # Закрытие сервера не трогает уже принятые соединения
+        for protocol in list(self._protocols):
+            protocol.transport.close()
+        self._protocols.clear()
+        if self._transport is not None:
+            self._transport.close()
+            self._transport = None
+        if self._fifo_keepalive is not None:
+            os.close(self._fifo_keepalive)
+            self._fifo_keepalive = None
+        if self.scheme in ('unix', 'unixgram') and os.path.exists(self.path):
+            os.unlink(self.path)
+
+
+def open_log_source(source: str, checkpoint_path: Optional[str] = None):
+    """Путь к файлу -> LogFollower, unix://, unixgram:// или fifo:// -> LogStream"""
+    if '://' in source:
+        return LogStream(source)
+    return LogFollower(source, checkpoint_path=checkpoint_path)
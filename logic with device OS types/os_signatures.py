@@ -0,0 +1,174 @@
+# База сигнатур ОС: загрузка из файла и компиляция в индексы
+
+import hashlib
+import json
+import os
+from typing import Dict, FrozenSet, Iterable, List, Optional, Tuple
+
+from tls_fingerprint import DeviceOS
+
+DEFAULT_SIGNATURES_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'os_signatures.json')
+
+# Веса совпадений, как в исходном скоринге
+CIPHER_WEIGHT = 2
+EXTENSION_WEIGHT = 1
+CURVE_WEIGHT = 2
+TTL_WEIGHT = 5
+WINDOW_WEIGHT = 3
+# Точная TCP сигнатура только добавляет очки: одинаковый стек TCP у iOS и macOS,
+# решающими остаются TLS и SNI (вес меньше разницы подсказки SNI для iOS и macOS)
+EXACT_TCP_WEIGHT = 4
+
+
+def ja3_hash(tls_data: dict) -> str:
+    """JA3-подобный хеш ClientHello: версия, шифры, расширения, кривые"""
+    fields = (
+        str(tls_data.get('version', '')),
+        '-'.join(map(str, tls_data.get('ciphers', ()))),
+        '-'.join(map(str, tls_data.get('extensions', ()))),
+        '-'.join(map(str, tls_data.get('curves', ()))),
+    )
+    return hashlib.md5(','.join(fields).encode()).hexdigest()
+
+
+def tcp_key(tcp_data: dict) -> Tuple:
+    """Ключ точного совпадения TCP: (ttl, window, options)"""
+    return (
+        tcp_data.get('ttl'),
+        tcp_data.get('window_size'),
+        tuple(tcp_data.get('tcp_options', ()))
+    )
+
+
+class _TokenIndex:
+    """Номер бита для каждого шифра/расширения/кривой"""
+
+    def __init__(self):
+        self.bits: Dict[str, int] = {}
+
+    def mask(self, tokens: Iterable[str], grow: bool = False) -> int:
+        mask = 0
+        for token in tokens:
+            bit = self.bits.get(token)
+            if bit is None:
+                if not grow:
+                    continue  # неизвестный токен не совпадет ни с одной ОС
+                bit = self.bits[token] = len(self.bits)
+            mask |= 1 << bit
+        return mask
+
+
+class _CompiledPattern:
+    __slots__ = ('os_type', 'ciphers', 'extensions', 'curves', 'ttls', 'windows')
+
+    def __init__(self, os_type: DeviceOS, ciphers: int, extensions: int, curves: int,
+                 ttls: FrozenSet[int], windows: FrozenSet[int]):
+        self.os_type = os_type
+        self.ciphers = ciphers
+        self.extensions = extensions
+        self.curves = curves
+        self.ttls = ttls
+        self.windows = windows
+
+
+class SignatureDB:
+    """Сигнатуры ОС, скомпилированные для быстрого поиска.
+
+    Точное совпадение по JA3/JA4 решает сразу, взвешенный скоринг по битовым
+    маскам работает при промахе. Точная TCP сигнатура (ttl, window, options)
+    входит в скоринг с весом EXACT_TCP_WEIGHT, а не решает сама.
+    """
+
+    def __init__(self, patterns: dict, exact: Optional[dict] = None):
+        self.tokens = _TokenIndex()
+        self.patterns: List[_CompiledPattern] = []
+        self.tls_index: Dict[str, DeviceOS] = {}
+        self.tcp_index: Dict[Tuple, DeviceOS] = {}
+
+        self._compile_patterns(patterns)
+        self._compile_exact(exact or {})
+
+    @classmethod
+    def load(cls, path: str = DEFAULT_SIGNATURES_PATH) -> 'SignatureDB':
+        with open(path, 'r') as f:
+            data = json.load(f)
+        return cls(data.get('patterns', {}), data.get('exact', {}))
+
+    def exact_match(self, tls_data: dict, tcp_data: dict) -> Optional[DeviceOS]:
+        """ОС по точной TLS сигнатуре; None если совпадения нет или TCP ему противоречит"""
+        tls_os = None
+        if tls_data and self.tls_index:
+            for key in (tls_data.get('ja4'), tls_data.get('ja3') or ja3_hash(tls_data)):
+                if key and key in self.tls_index:
+                    tls_os = self.tls_index[key]
+                    break
+
+        tcp_os = self.tcp_index.get(tcp_key(tcp_data)) if tcp_data else None
+
+        if tls_os and tcp_os and tls_os != tcp_os:
+            return None
+        return tls_os
+
+    def score(self, tls_data: dict, tcp_data: dict) -> Dict[DeviceOS, int]:
+        """Взвешенный скоринг по всем шаблонам"""
+        scores = {os_type: 0 for os_type in DeviceOS if os_type != DeviceOS.UNKNOWN}
+
+        if tls_data:
+            ciphers = self.tokens.mask(tls_data.get('ciphers', ()))
+            extensions = self.tokens.mask(tls_data.get('extensions', ()))
+            curves = self.tokens.mask(tls_data.get('curves', ()))
+            for pattern in self.patterns:
+                scores[pattern.os_type] += (
+                    CIPHER_WEIGHT * (ciphers & pattern.ciphers).bit_count()
+                    + EXTENSION_WEIGHT * (extensions & pattern.extensions).bit_count()
+                    + CURVE_WEIGHT * (curves & pattern.curves).bit_count()
+                )
+
+        if tcp_data:
+            ttl = tcp_data.get('ttl')
+            window = tcp_data.get('window_size')
+            for pattern in self.patterns:
+                if ttl and ttl in pattern.ttls:
+                    scores[pattern.os_type] += TTL_WEIGHT
+                if window and window in pattern.windows:
+                    scores[pattern.os_type] += WINDOW_WEIGHT
+            tcp_os = self.tcp_index.get(tcp_key(tcp_data))
+            if tcp_os is not None:
+                scores[tcp_os] += EXACT_TCP_WEIGHT
+
+        return scores
+
+    def _compile_patterns(self, patterns: dict):
+        for os_name, pattern in patterns.items():
+            tls = pattern.get('tls', {})
+            tcp = pattern.get('tcp', {})
+            self.patterns.append(_CompiledPattern(
+                os_type=DeviceOS(os_name),
+                ciphers=self.tokens.mask(tls.get('ciphers', ()), grow=True),
+                extensions=self.tokens.mask(tls.get('extensions', ()), grow=True),
+                curves=self.tokens.mask(tls.get('curves', ()), grow=True),
+                ttls=frozenset(tcp.get('ttl', ())),
+                windows=frozenset(tcp.get('window_size', ()))
+            ))
+
+    def _compile_exact(self, exact: dict):
+        for entry in exact.get('tls', ()):
+            os_type = DeviceOS(entry['os'])
+            for field in ('ja3', 'ja4'):
+                if entry.get(field):
+                    self._index(self.tls_index, entry[field], os_type)
+
+        for entry in exact.get('tcp', ()):
+            self._index(self.tcp_index, tcp_key(entry), DeviceOS(entry['os']))
+
+        # Неоднозначные сигнатуры из индекса убираем - для них работает скоринг
+        for index in (self.tls_index, self.tcp_index):
+            for key in [key for key, os_type in index.items() if os_type is None]:
+                del index[key]
+
+    @staticmethod
+    def _index(index: dict, key, os_type: DeviceOS):
+        if key in index and index[key] != os_type:
+            index[key] = None
+        else:
+            index[key] = os_type
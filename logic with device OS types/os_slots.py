@@ -0,0 +1,69 @@
+# Слоты устройств по ОС: занятые слоты пользователя в порядке последней активности
+
+import sys
+from typing import Dict, Iterator, Optional, Tuple
+
+from common.device_registry import DeviceRecord, DeviceRegistry
+
+_EMPTY: Dict[bytes, DeviceRecord] = {}
+
+
+class OSSlots:
+    """(user_id, код ОС) -> {отпечаток: DeviceRecord} от давно активного к недавнему.
+
+    dict сохраняет порядок вставки, поэтому поиск своего устройства, число
+    занятых слотов и самое давно активное устройство (первый ключ) - O(1);
+    повторное подключение переносит устройство в конец (pop + вставка).
+    Сами записи общие с DeviceRegistry, здесь только индекс по ОС.
+    """
+
+    def __init__(self):
+        self._slots: Dict[Tuple[str, int], Dict[bytes, DeviceRecord]] = {}
+
+    def get(self, user_id: str, os_code: int) -> Dict[bytes, DeviceRecord]:
+        """Занятые слоты ОС; пустой словарь, если слотов нет (не изменять)"""
+        return self._slots.get((user_id, os_code), _EMPTY)
+
+    def add(self, user_id: str, record: DeviceRecord):
+        key = (sys.intern(user_id), record.os_code)
+        slots = self._slots.get(key)
+        if slots is None:
+            self._slots[key] = {record.fingerprint: record}
+        else:
+            slots[record.fingerprint] = record
+
+    def touch(self, user_id: str, record: DeviceRecord):
+        """Устройство снова активно - в конец очереди вытеснения"""
+        slots = self._slots.get((user_id, record.os_code))
+        if slots is not None and slots.pop(record.fingerprint, None) is not None:
+            slots[record.fingerprint] = record
+
+    def remove(self, user_id: str, record: DeviceRecord):
+        key = (user_id, record.os_code)
+        slots = self._slots.get(key)
+        if slots is None:
+            return
+        slots.pop(record.fingerprint, None)
+        if not slots:
+            del self._slots[key]
+
+    def least_recent(self, user_id: str, os_code: int) -> Optional[DeviceRecord]:
+        """Кандидат на вытеснение: устройство, активное раньше остальных"""
+        slots = self._slots.get((user_id, os_code))
+        if not slots:
+            return None
+        return next(iter(slots.values()))
+
+    def rebuild(self, registry: DeviceRegistry):
+        """Индекс по реестру (после загрузки состояния): порядок по last_seen"""
+        self._slots = {}
+        for user_id in registry.users():
+            for record in sorted(registry.devices(user_id), key=lambda r: r.last_seen):
+                self.add(user_id, record)
+
+    def __iter__(self) -> Iterator[Tuple[str, int]]:
+        return iter(self._slots)
+
+    def __len__(self) -> int:
+        return len(self._slots)
+
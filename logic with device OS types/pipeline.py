@@ -0,0 +1,84 @@
+# Стадии мониторинга, связанные ограниченными очередями: decide -> enforce -> notify
+
+import asyncio
+import time
+from dataclasses import dataclass
+from typing import Awaitable, Callable, Hashable, List, Optional
+
+from common.metrics import ERRORS, PIPELINE_BLOCKED, QUEUE_DEPTH
+
+
+@dataclass
+class PipelineConfig:
+    """Параллелизм стадий и ограничения внешних вызовов"""
+    decide_lanes: int = 1  # проверка лимитов - работа CPU, параллелизм ей не помогает
+    enforce_lanes: int = 8
+    notify_lanes: int = 4
+    queue_size: int = 1024  # на одну полосу
+    stats_concurrency: int = 4  # одновременных update_user_stats из полос enforce
+    notify_concurrency: int = 8  # одновременных отправок уведомлений
+
+
+class Stage:
+    """Стадия с N полосами; у каждой полосы своя ограниченная очередь и свой воркер.
+
+    Полоса выбирается по ключу (user_id): элементы одного пользователя идут
+    через одну полосу и обрабатываются строго по порядку, разные пользователи
+    обрабатываются параллельно. Полная очередь заставляет put() ждать - это
+    и есть обратное давление на предыдущую стадию, время ожидания уходит в метрику.
+    """
+
+    def __init__(self, name: str, handler: Callable[..., Awaitable], lanes: int = 1,
+                 maxsize: int = 1024):
+        self.name = name
+        self.handler = handler
+        self.queues: List[asyncio.Queue] = [asyncio.Queue(maxsize) for _ in range(max(1, lanes))]
+        self._workers: List[Optional[asyncio.Task]] = [None] * len(self.queues)
+        self._blocked = PIPELINE_BLOCKED.labels(name)
+        self._errors = ERRORS.labels(f'pipeline_{name}')
+        QUEUE_DEPTH.labels(f'pipeline_{name}').set_function(lambda: self.depth)
+
+    @property
+    def depth(self) -> int:
+        return sum(queue.qsize() for queue in self.queues)
+
+    async def put(self, key: Hashable, *item):
+        lane = hash(key) % len(self.queues)
+        queue = self.queues[lane]
+        self._ensure_worker(lane)
+        if queue.full():
+            start = time.perf_counter()
+            await queue.put(item)
+            self._blocked.inc(time.perf_counter() - start)
+        else:
+            queue.put_nowait(item)
+
+    async def join(self):
+        """Все поставленные элементы обработаны"""
+        for queue in self.queues:
+            await queue.join()
+
+    def _ensure_worker(self, lane: int):
+        worker = self._workers[lane]
+        if worker is None or worker.done():
+            self._workers[lane] = asyncio.get_running_loop().create_task(self._run(self.queues[lane]))
+
+    async def _run(self, queue: asyncio.Queue):
+        handler = self.handler
+        while True:
+            item = await queue.get()
+            try:
+                await handler(*item)
+            except Exception as e:
+                self._errors.inc()
+                print(f"Pipeline {self.name} error: {e}")
+            finally:
+                queue.task_done()
+
+    async def close(self):
+        workers = [worker for worker in self._workers if worker is not None]
+        for worker in workers:
+            worker.cancel()
+        await asyncio.gather(*workers, return_exceptions=True)
+        self._workers = [None] * len(self.queues)
+
@@ -0,0 +1,398 @@
+# Воспроизведение архивных access.log: политики лимитов на прошлом трафике без блокировок
+#
+#   python replay.py /var/log/xray/ --policies policies.json --db devices-copy.db --workers 8
+#   python replay.py 'archive/access.log*' --tick 2
+#
+# policies.json - список политик, например:
+#   [{"name": "current"},
+#    {"name": "newest_wins", "newest_wins": true},
+#    {"name": "2h_idle", "idle_timeout": 7200, "plan_timeouts": {"premium": 86400}},
+#    {"name": "new_signatures", "signatures": "os_signatures_v2.json"}]
+#
+# Строки идут через тот же разбор -> определение ОС -> решение (AccessLogParser,
+# LimitEngine, DeviceManager), что и в XRayOSLimiter, но время берется из строк лога:
+# тики по --tick секунд, истечение простоя и кулдаун уведомлений - в модельном времени.
+# Блокировки, уведомления и запись в БД не выполняются, только считаются.
+# Логи читает и распаковывает один процесс: пачки строк раскладываются по
+# пользователям (shard_of) в очереди процессов-шардов.
+
+import argparse
+import asyncio
+import glob
+import gzip
+import json
+import mmap
+import multiprocessing
+import os
+import time
+import queue
+from dataclasses import dataclass, field
+from datetime import datetime
+from typing import Dict, Iterable, Iterator, List, Optional, Set, Tuple
+
+import common_path  # noqa: F401 - корень репозитория в sys.path: пакет common
+from common.device_expiry import DEFAULT_IDLE_TIMEOUT
+from limit_engine import LimitEngine
+from log_parser import TIMESTAMP_FORMAT, AccessLogParser
+from common.notify_outbox import DEFAULT_COOLDOWN
+from sharding import line_user, shard_of
+from state_loader import load_plans
+from system_os import DISPLACE_AFTER, DeviceManager
+
+BATCH = 20000
+# Пачек в очереди шарда: чтение не уходит далеко вперед воспроизведения
+QUEUE_BATCHES = 8
+COUNTERS = ('rejected', 'displaced', 'notifications', 'blocked_users', 'admitted', 'expired')
+
+
+@dataclass
+class ReplayPolicy:
+    """Проверяемая политика: лимиты, вытеснение, таймауты простоя, сигнатуры ОС"""
+    name: str = 'current'
+    default_limit: int = 1  # слотов на ОС без покупок
+    newest_wins: bool = False
+    displace_after: float = DISPLACE_AFTER  # простой, после которого устройство можно вытеснить
+    idle_timeout: float = DEFAULT_IDLE_TIMEOUT
+    plan_timeouts: Dict[str, float] = field(default_factory=dict)
+    signatures: Optional[str] = None  # os_signatures.json по умолчанию
+    notify_cooldown: float = DEFAULT_COOLDOWN
+
+
+def load_policies(path: Optional[str]) -> List[ReplayPolicy]:
+    if path is None:
+        return [ReplayPolicy()]
+    with open(path, encoding='utf-8') as f:
+        return [ReplayPolicy(**item) for item in json.load(f)]
+
+
+class DiscardStore:
+    """Вместо DeviceStore: при воспроизведении БД не меняется"""
+
+    def start(self):
+        pass
+
+    def upsert(self, user_id: str, device) -> None:
+        pass
+
+    def touch(self, fingerprint: bytes, last_seen: float, ip: Optional[str]) -> None:
+        pass
+
+    def deactivate(self, fingerprint: bytes) -> None:
+        pass
+
+    def close(self, timeout: Optional[float] = None):
+        pass
+
+
+def _first_timestamp(path: str) -> float:
+    """Время первой строки файла; если его не разобрать - mtime"""
+    try:
+        opener = gzip.open if path.endswith('.gz') else open
+        with opener(path, 'rt', encoding='utf-8', errors='replace') as f:
+            line = f.readline()
+        return datetime.strptime(line[:19], TIMESTAMP_FORMAT).timestamp()
+    except (OSError, ValueError, EOFError):
+        return os.path.getmtime(path)
+
+
+def order_logs(patterns: List[str]) -> List[str]:
+    """Файлы, каталоги и маски -> файлы логов от старых к новым.
+
+    Номера ротации (access.log.1, access.log.2.gz) и mtime ненадежны после
+    копирования архива, поэтому порядок определяется по времени первой строки.
+    """
+    paths = set()
+    for pattern in patterns:
+        if os.path.isdir(pattern):
+            # Из каталога - только логи (access.log, access.log.1, error.log.2.gz ...)
+            paths.update(
+                os.path.join(pattern, name) for name in os.listdir(pattern)
+                if '.log' in name and os.path.isfile(os.path.join(pattern, name))
+            )
+        else:
+            paths.update(p for p in glob.glob(pattern) if os.path.isfile(p))
+    return sorted(paths, key=lambda p: (_first_timestamp(p), p))
+
+
+def iter_log_lines(path: str) -> Iterator[str]:
+    """Строки файла: .gz потоком, несжатые - через mmap без копирования в буфер чтения"""
+    if path.endswith('.gz'):
+        with gzip.open(path, 'rt', encoding='utf-8', errors='replace') as f:
+            yield from f
+        return
+
+    with open(path, 'rb') as f:
+        if os.fstat(f.fileno()).st_size == 0:
+            return
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+            for raw in iter(mm.readline, b''):
+                yield raw.decode('utf-8', 'replace')
+
+
+def read_batches(paths: List[str]) -> Iterator[List[str]]:
+    """Пачки строк всех логов в порядке логов"""
+    batch = []
+    for path in paths:
+        for line in iter_log_lines(path):
+            batch.append(line)
+            if len(batch) >= BATCH:
+                yield batch
+                batch = []
+    if batch:
+        yield batch
+
+
+def split_batch(batch: List[str], shards: int) -> List[List[str]]:
+    """Строки пачки по шардам их пользователей; строки без пользователя отбрасываются"""
+    parts: List[List[str]] = [[] for _ in range(shards)]
+    for line in batch:
+        user_id = line_user(line)
+        if user_id is not None:
+            parts[shard_of(user_id, shards)].append(line)
+    return parts
+
+
+def queue_batches(batches: multiprocessing.Queue) -> Iterator[List[str]]:
+    """Пачки из очереди шарда до None"""
+    while True:
+        batch = batches.get()
+        if batch is None:
+            return
+        yield batch
+
+
+class PolicyRun:
+    """Состояние одной политики в шарде: реестр и движок с модельными часами"""
+
+    def __init__(self, policy: ReplayPolicy, index: int, shards: int, db_path: Optional[str]):
+        self.policy = policy
+        self.db_path = db_path
+        self.now = 0.0
+        self.device_manager = DeviceManager(
+            db_path or ':memory:',
+            user_filter=lambda user_id: shard_of(user_id, shards) == index,
+            idle_timeouts=policy.plan_timeouts,
+            newest_wins=policy.newest_wins,
+            displace_after=policy.displace_after,
+            signatures_path=policy.signatures,
+            clock=lambda: self.now
+        )
+        self.device_manager.store = DiscardStore()
+        self.device_manager.limits.default = policy.default_limit
+        self.device_manager.expiry.default_timeout = policy.idle_timeout
+        self.engine = LimitEngine(self.device_manager)
+
+        self.stats = dict.fromkeys(COUNTERS, 0)
+        self.blocked_users: Set[str] = set()
+        self._notified: Dict[Tuple[str, str], float] = {}  # (user_id, причина) -> время отправки
+
+    async def load(self):
+        """Купленные слоты и тарифы из копии БД; устройства - только из логов"""
+        if self.db_path is None:
+            return
+        device_manager = self.device_manager
+        await device_manager.limits.load()
+        plans = await asyncio.to_thread(load_plans, self.db_path, device_manager.user_filter)
+        for user_id, plan in plans.items():
+            device_manager.expiry.set_plan(user_id, plan)
+
+    async def tick(self, connections: Dict[str, List[dict]], now: float):
+        """Тик мониторинга в момент now: истечение простоя, затем проверка новых устройств"""
+        self.now = now
+        engine = self.engine
+        stats = self.stats
+        stats['expired'] += len(engine.expire(now))
+
+        for user_id, conn_list in engine.apply_events(connections).items():
+            admitted, rejected = await engine.evaluate(user_id, conn_list)
+            stats['admitted'] += len(admitted)
+            for _, reason in rejected:
+                self.record_block(user_id, reason)
+
+    def record_block(self, user_id: str, reason: str):
+        """Блокировка и уведомление, которые выполнил бы XRayOSLimiter (кулдаун как в outbox)"""
+        if reason.startswith('displaced:'):
+            self.stats['displaced'] += 1
+        else:
+            self.stats['rejected'] += 1
+        self.blocked_users.add(user_id)
+
+        key = (user_id, reason)
+        if self.now - self._notified.get(key, -self.policy.notify_cooldown) >= self.policy.notify_cooldown:
+            self._notified[key] = self.now
+            self.stats['notifications'] += 1
+
+    def result(self) -> Dict[str, int]:
+        return {**self.stats, 'blocked_users': len(self.blocked_users)}
+
+
+def _tick_end(ts: datetime, tick: float) -> datetime:
+    """Конец тика, в который попадает время ts"""
+    return datetime.fromtimestamp((ts.timestamp() // tick + 1) * tick)
+
+
+async def _replay_shard(index: int, shards: int, batches: Iterable[List[str]],
+                        policies: List[ReplayPolicy], db_path: Optional[str], tick: float) -> dict:
+    runs = [PolicyRun(policy, index, shards, db_path) for policy in policies]
+    for run in runs:
+        await run.load()
+
+    parser = AccessLogParser()
+    parsed = 0
+    pending: Dict[str, List[dict]] = {}
+    tick_end: Optional[datetime] = None
+
+    async def flush():
+        now = tick_end.timestamp()
+        for run in runs:
+            await run.tick(pending, now)
+
+    for batch in batches:
+        for conn in parser.parse_lines(batch):
+            parsed += 1
+            ts = conn['timestamp']
+            if tick_end is None:
+                tick_end = _tick_end(ts, tick)
+            elif ts >= tick_end:
+                await flush()
+                pending = {}
+                tick_end = _tick_end(ts, tick)
+            pending.setdefault(conn['user_id'], []).append(conn)
+
+    if pending:
+        await flush()
+
+    return {
+        'connections': parsed,
+        'policies': {run.policy.name: run.result() for run in runs},
+    }
+
+
+def replay_shard(index: int, shards: int, batches: multiprocessing.Queue, results: multiprocessing.Queue,
+                 policies: List[ReplayPolicy], db_path: Optional[str], tick: float):
+    """Точка входа процесса шарда: пачки своих пользователей из очереди, все политики"""
+    try:
+        result = asyncio.run(_replay_shard(index, shards, queue_batches(batches), policies, db_path, tick))
+    except Exception as e:
+        result = {'error': f"shard {index}: {e!r}"}
+    results.put((index, result))
+
+
+def _put(batches: multiprocessing.Queue, batch: Optional[List[str]], process: multiprocessing.Process):
+    """Пачка в очередь шарда; ждем, пока шард ее разберет, но не дольше его жизни"""
+    while True:
+        try:
+            batches.put(batch, timeout=1)
+            return
+        except queue.Full:
+            if not process.is_alive():
+                raise RuntimeError(f"{process.name} exited")
+
+
+def _replay_sharded(paths: List[str], policies: List[ReplayPolicy], workers: int,
+                    db_path: Optional[str], tick: float) -> Tuple[int, List[dict]]:
+    """Один проход чтения логов, строки - в очереди процессов-шардов"""
+    ctx = multiprocessing.get_context('spawn')
+    results = ctx.Queue()
+    queues = [ctx.Queue(QUEUE_BATCHES) for _ in range(workers)]
+    processes = [
+        ctx.Process(target=replay_shard, args=(index, workers, queues[index], results, policies, db_path, tick),
+                    name=f'replay-shard-{index}', daemon=True)
+        for index in range(workers)
+    ]
+    for process in processes:
+        process.start()
+
+    lines = 0
+    try:
+        for batch in read_batches(paths):
+            lines += len(batch)
+            for index, part in enumerate(split_batch(batch, workers)):
+                if part:
+                    _put(queues[index], part, processes[index])
+        for index in range(workers):
+            _put(queues[index], None, processes[index])
+
+        shard_results: List[Optional[dict]] = [None] * workers
+        waiting = set(range(workers))
+        while waiting:
+            try:
+                index, result = results.get(timeout=1)
+            except queue.Empty:
+                exited = [processes[i].name for i in waiting if not processes[i].is_alive()]
+                if exited:
+                    raise RuntimeError(f"{exited[0]} exited without a result")
+                continue
+            if 'error' in result:
+                raise RuntimeError(result['error'])
+            shard_results[index] = result
+            waiting.discard(index)
+    finally:
+        for process in processes:
+            process.join(1)
+            if process.is_alive():
+                process.terminate()
+    return lines, shard_results
+
+
+def run_replay(paths: List[str], policies: List[ReplayPolicy], workers: int = 1,
+               db_path: Optional[str] = None, tick: float = 2.0) -> dict:
+    """Воспроизведение по шардам в процессах; счетчики шардов складываются"""
+    if workers <= 1:
+        lines = 0
+
+        def counted():
+            nonlocal lines
+            for batch in read_batches(paths):
+                lines += len(batch)
+                yield batch
+
+        results = [asyncio.run(_replay_shard(0, 1, counted(), policies, db_path, tick))]
+    else:
+        lines, results = _replay_sharded(paths, policies, workers, db_path, tick)
+
+    # Пользователь целиком в одном шарде - суммы по шардам точные, в том числе blocked_users
+    merged = {
+        'lines': lines,
+        'connections': sum(r['connections'] for r in results),
+        'policies': {policy.name: dict.fromkeys(COUNTERS, 0) for policy in policies},
+    }
+    for result in results:
+        for name, stats in result['policies'].items():
+            total = merged['policies'][name]
+            for counter, value in stats.items():
+                total[counter] += value
+    return merged
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('logs', nargs='+', help='файлы (.gz тоже), каталоги или маски логов')
+    parser.add_argument('--policies', default=None, help='JSON со списком политик')
+    parser.add_argument('--db', default=None, help='копия БД: купленные слоты и тарифы')
+    parser.add_argument('--workers', type=int, default=os.cpu_count() or 1)
+    parser.add_argument('--tick', type=float, default=2.0, help='секунд лога на тик мониторинга')
+    args = parser.parse_args()
+
+    paths = order_logs(args.logs)
+    if not paths:
+        parser.error('логи не найдены')
+    policies = load_policies(args.policies)
+    print(f"файлов {len(paths)}, политик {len(policies)}, процессов {args.workers}, тик {args.tick} с")
+
+    start = time.perf_counter()
+    result = run_replay(paths, policies, args.workers, args.db, args.tick)
+    elapsed = time.perf_counter() - start
+
+    print(f"строк {result['lines']:,}, подключений {result['connections']:,} за {elapsed:.1f} с "
+          f"({result['lines'] / elapsed:,.0f} строк/с)")
+    for name, stats in result['policies'].items():
+        print(
+            f"{name:>20}  отклонено {stats['rejected']:>9,}  вытеснено {stats['displaced']:>9,}  "
+            f"пользователей в блоке {stats['blocked_users']:>8,}  уведомлений {stats['notifications']:>9,}  "
+            f"допущено {stats['admitted']:>9,}  истекло {stats['expired']:>8,}"
+        )
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,335 @@
+# Шардированный режим: пользователи распределены по N процессам-воркерам
+
+import asyncio
+import itertools
+import multiprocessing
+import threading
+import time
+import zlib
+from typing import Dict, List, Optional, Tuple
+
+from common.device_registry import DeviceRecord
+from limit_engine import LimitEngine
+from log_parser import AccessLogParser
+from system_os import DeviceManager
+from tls_fingerprint import DeviceOS
+
+
+def shard_of(user_id: str, shards: int) -> int:
+    """Номер шарда пользователя; стабилен между процессами и рестартами (в отличие от hash())"""
+    return zlib.crc32(user_id.encode()) % shards
+
+
+def line_user(line: str) -> Optional[str]:
+    """Пользователь из строки access.log без полного разбора"""
+    _, sep, email = line.partition(' email: ')
+    if sep:
+        return email.split(' ', 1)[0].rstrip() or None
+    # Старый формат: ... user:[id] ...
+    start = line.find('user:[')
+    if start < 0:
+        return None
+    end = line.find(']', start)
+    return line[start + 6:end] if end > 0 else None
+
+
+def _brief(conn: dict) -> dict:
+    """Подключение без блоков tls/tcp - координатору они не нужны"""
+    return {
+        'ip': conn['ip'],
+        'port': conn['port'],
+        'user_id': conn['user_id'],
+        'timestamp': conn['timestamp'],
+        'device': conn.get('device'),
+    }
+
+
+class LimiterShard:
+    """Состояние и решения по пользователям одного шарда (в дочернем процессе).
+
+    Все устройства пользователя попадают в один шард, поэтому лимиты
+    считаются точно, без обмена состоянием между процессами.
+    """
+
+    def __init__(self, index: int, shards: int, db_path: str, newest_wins: bool = False,
+                 idle_timeouts: Optional[Dict[str, float]] = None):
+        self.index = index
+        self.shards = shards
+        self.parser = AccessLogParser()
+        self.device_manager = DeviceManager(
+            db_path,
+            # Число шардов в имени: при другом числе чужой снимок не подхватится
+            snapshot_path=f"{db_path}.shard{index}of{shards}.snapshot",
+            user_filter=self.owns,
+            idle_timeouts=idle_timeouts,
+            newest_wins=newest_wins
+        )
+        self.engine = LimitEngine(self.device_manager)
+
+    def owns(self, user_id: str) -> bool:
+        return shard_of(user_id, self.shards) == self.index
+
+    async def restore(self) -> dict:
+        """Восстановление состояния; снимки для бота - по всем восстановленным пользователям"""
+        stats = await self.device_manager.restore()
+        stats['views'] = {user_id: self.user_view(user_id) for user_id in self.device_manager.users()}
+        return stats
+
+    async def process_lines(self, lines: List[str]) -> dict:
+        """Строки лога своих пользователей -> решения для координатора"""
+        expired = self.engine.expire()
+
+        start = time.perf_counter()
+        connections: Dict[str, List[dict]] = {}
+        for conn in self.parser.parse_lines(lines):
+            connections.setdefault(conn['user_id'], []).append(conn)
+        parse_seconds = time.perf_counter() - start
+
+        rejected = []
+        admitted = {}
+        for user_id, conn_list in self.engine.apply_events(connections).items():
+            user_admitted, user_rejected = await self.engine.evaluate(user_id, conn_list)
+            for conn, reason in user_rejected:
+                rejected.append((user_id, _brief(conn), reason))
+            admitted[user_id] = {fp: _brief(conn) for fp, conn in user_admitted.items()}
+
+        # Снимки для бота - по пользователям, у которых что-то изменилось
+        changed = set(admitted)
+        changed.update(user_id for user_id, _ in expired)
+        return {
+            'rejected': rejected,
+            'admitted': admitted,
+            'expired': [(user_id, record.ip) for user_id, record in expired],
+            'views': {user_id: self.user_view(user_id) for user_id in changed},
+            'timings': {'parse': parse_seconds, **self.engine.drain_timings()},
+            'caches': self.cache_stats(),
+        }
+
+    async def refresh_limits(self, user_id: str) -> Dict[DeviceOS, int]:
+        """Лимиты пользователя изменились: перечитать их и переоценить его устройства"""
+        limits = await self.device_manager.limits.invalidate(user_id)
+        self.engine.connection_state.invalidate(user_id)
+        return limits
+
+    def cache_stats(self) -> Dict[str, Tuple[int, int]]:
+        return {'log_blob': self.parser.blob_cache_stats(), **self.engine.cache_stats()}
+
+    def user_view(self, user_id: str) -> Tuple[List[tuple], Dict[DeviceOS, int]]:
+        """Строки для ViewStore.publish и лимиты пользователя по каждой ОС"""
+        rows = [
+            (r.os_code, r.ip, r.first_seen, r.last_seen)
+            for r in self.device_manager.user_devices.devices(user_id)
+        ]
+        return rows, self.device_manager.limits.effective_limits(user_id)
+
+    def user_devices(self, user_id: str) -> List[tuple]:
+        return [
+            (r.fingerprint, r.ip, r.os_code, r.first_seen, r.last_seen, r.blocked)
+            for r in self.device_manager.user_devices.devices(user_id)
+        ]
+
+
+def _shard_main(index: int, shards: int, db_path: str, newest_wins: bool,
+                idle_timeouts: Optional[Dict[str, float]], conn):
+    """Цикл дочернего процесса: запрос (id, вид, данные) -> ответ (id, результат, ошибка)"""
+    shard = LimiterShard(index, shards, db_path, newest_wins, idle_timeouts)
+    loop = asyncio.new_event_loop()
+    handlers = {
+        'restore': lambda _: loop.run_until_complete(shard.restore()),
+        'lines': lambda lines: loop.run_until_complete(shard.process_lines(lines)),
+        'devices': shard.user_devices,
+        'view': shard.user_view,
+        'invalidate': lambda user_id: loop.run_until_complete(shard.refresh_limits(user_id)),
+        'flush': lambda _: shard.device_manager.store.close(),
+        'snapshot': lambda _: shard.device_manager.user_devices.save_snapshot(
+            shard.device_manager.snapshot_path
+        ),
+    }
+
+    while True:
+        try:
+            request_id, kind, payload = conn.recv()
+        except EOFError:
+            break
+        if kind == 'stop':
+            conn.send((request_id, None, None))
+            break
+        try:
+            conn.send((request_id, handlers[kind](payload), None))
+        except Exception as e:
+            conn.send((request_id, None, f"{type(e).__name__}: {e}"))
+
+    loop.close()
+
+
+class ShardClient:
+    """Канал к одному процессу-шарду; ответы разбирает отдельный поток чтения"""
+
+    def __init__(self, index: int, shards: int, db_path: str, newest_wins: bool,
+                 idle_timeouts: Optional[Dict[str, float]], ctx):
+        self.index = index
+        self._conn, child_conn = ctx.Pipe()
+        self.process = ctx.Process(
+            target=_shard_main,
+            args=(index, shards, db_path, newest_wins, idle_timeouts, child_conn),
+            name=f'limiter-shard-{index}',
+            daemon=True
+        )
+        self.process.start()
+        child_conn.close()
+
+        self._ids = itertools.count()
+        self._pending: Dict[int, Tuple[asyncio.AbstractEventLoop, asyncio.Future]] = {}
+        self._send_lock = threading.Lock()
+        self._exited = False  # поток чтения получил EOF - новые запросы не отправляются
+        self._reader = threading.Thread(target=self._read, name=f'shard-reader-{index}', daemon=True)
+        self._reader.start()
+
+    def _read(self):
+        while True:
+            try:
+                request_id, result, error = self._conn.recv()
+            except (EOFError, OSError):
+                break
+            loop, future = self._pending.pop(request_id, (None, None))
+            if future is not None:
+                loop.call_soon_threadsafe(self._resolve, future, result, error)
+
+        # Процесс завершился - ожидающие запросы не получат ответа.
+        # Флаг ставится под блокировкой отправки: запрос, зарегистрированный
+        # после этого, в _pending уже не попадет
+        with self._send_lock:
+            self._exited = True
+        for request_id in list(self._pending):
+            loop, future = self._pending.pop(request_id)
+            loop.call_soon_threadsafe(
+                self._resolve, future, None, f"shard {self.index} exited"
+            )
+
+    @staticmethod
+    def _resolve(future: asyncio.Future, result, error: Optional[str]):
+        if future.done():
+            return
+        if error is not None:
+            future.set_exception(RuntimeError(error))
+        else:
+            future.set_result(result)
+
+    async def call(self, kind: str, payload=None):
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        request_id = next(self._ids)
+        with self._send_lock:
+            if self._exited:
+                raise RuntimeError(f"shard {self.index} exited")
+            self._pending[request_id] = (loop, future)
+            try:
+                self._conn.send((request_id, kind, payload))
+            except BaseException:
+                # Запрос не ушел - ответа на него не будет
+                self._pending.pop(request_id, None)
+                raise
+        return await future
+
+    def close(self, timeout: Optional[float] = None):
+        self.process.join(timeout)
+        if self.process.is_alive():
+            self.process.terminate()
+        self._conn.close()
+
+
+class ShardPool:
+    """Координатор: раздает строки лога шардам по пользователю и собирает решения"""
+
+    def __init__(self, shards: int, db_path: str, newest_wins: bool = False,
+                 idle_timeouts: Optional[Dict[str, float]] = None):
+        self.shards = shards
+        # spawn: дочерние процессы не наследуют event loop и потоки родителя
+        ctx = multiprocessing.get_context('spawn')
+        self.clients = [
+            ShardClient(i, shards, db_path, newest_wins, idle_timeouts, ctx) for i in range(shards)
+        ]
+        self.stats = {'lines': 0, 'unrouted': 0}
+        # Последние счетчики кэшей каждого шарда: (hits, misses) по имени кэша
+        self.shard_caches: List[Dict[str, Tuple[int, int]]] = [{} for _ in range(shards)]
+
+    def route(self, lines: List[str]) -> List[List[str]]:
+        batches: List[List[str]] = [[] for _ in range(self.shards)]
+        shards = self.shards
+        unrouted = 0
+        for line in lines:
+            user_id = line_user(line)
+            if user_id is None:
+                unrouted += 1
+                continue
+            batches[shard_of(user_id, shards)].append(line)
+        self.stats['lines'] += len(lines)
+        self.stats['unrouted'] += unrouted
+        return batches
+
+    async def restore(self) -> dict:
+        results = await asyncio.gather(*(client.call('restore') for client in self.clients))
+        return {
+            'source': ','.join(sorted({r['source'] for r in results})),
+            'devices': sum(r['devices'] for r in results),
+            'seconds': max(r['seconds'] for r in results),
+            'views': {user_id: view for r in results for user_id, view in r['views'].items()},
+        }
+
+    async def process_lines(self, lines: List[str]) -> dict:
+        """Решения всех шардов за тик: отклоненные подключения и допущенные по ОС"""
+        batches = self.route(lines)
+        # Пустые пачки тоже отправляем: шард на каждом тике освобождает простаивающие слоты
+        results = await asyncio.gather(*(
+            client.call('lines', batch)
+            for client, batch in zip(self.clients, batches)
+        ))
+
+        merged = {'rejected': [], 'admitted': {}, 'expired': [], 'views': {}, 'timings': {}}
+        timings = merged['timings']
+        for index, result in enumerate(results):
+            merged['rejected'].extend(result['rejected'])
+            merged['admitted'].update(result['admitted'])
+            merged['expired'].extend(result['expired'])
+            merged['views'].update(result['views'])
+            # Шарды работают параллельно - время стадии тика определяет самый медленный
+            for stage, seconds in result['timings'].items():
+                timings[stage] = max(timings.get(stage, 0.0), seconds)
+            self.shard_caches[index] = result['caches']
+        return merged
+
+    def cache_stats(self) -> Dict[str, Tuple[int, int]]:
+        """Счетчики кэшей, просуммированные по шардам"""
+        total: Dict[str, Tuple[int, int]] = {}
+        for caches in self.shard_caches:
+            for name, (hits, misses) in caches.items():
+                prev_hits, prev_misses = total.get(name, (0, 0))
+                total[name] = (prev_hits + hits, prev_misses + misses)
+        return total
+
+    def client_for(self, user_id: str) -> ShardClient:
+        return self.clients[shard_of(user_id, self.shards)]
+
+    async def user_devices(self, user_id: str) -> List[DeviceRecord]:
+        rows = await self.client_for(user_id).call('devices', user_id)
+        devices = []
+        for fp, ip, os_code, first_seen, last_seen, blocked in rows:
+            record = DeviceRecord(fp, ip, os_code, first_seen, last_seen)
+            record.blocked = blocked
+            devices.append(record)
+        return devices
+
+    async def user_view(self, user_id: str) -> Tuple[List[tuple], Dict[DeviceOS, int]]:
+        return await self.client_for(user_id).call('view', user_id)
+
+    async def invalidate(self, user_id: str) -> Dict[DeviceOS, int]:
+        """Перечитать лимиты пользователя в шарде-владельце"""
+        return await self.client_for(user_id).call('invalidate', user_id)
+
+    async def close(self):
+        """Сначала все шарды дописывают БД, затем снимают снимки - иначе снимки окажутся старше БД"""
+        await asyncio.gather(*(client.call('flush') for client in self.clients))
+        await asyncio.gather(*(client.call('snapshot') for client in self.clients))
+        await asyncio.gather(*(client.call('stop') for client in self.clients))
+        for client in self.clients:
+            await asyncio.to_thread(client.close, 5)
@@ -0,0 +1,189 @@
+# Восстановление состояния устройств при старте (теплый рестарт)
+
+import gc
+import os
+import sqlite3
+import sys
+import time
+from typing import Callable, Dict, Optional
+
+from common.device_registry import DeviceRecord, DeviceRegistry
+from common.fingerprint import stored_fingerprint
+from tls_fingerprint import OS_CODES, DeviceOS
+
+FETCH_SIZE = 10000
+
+DEVICES_SQL = """
+SELECT user_id, device_fingerprint, ip_address, os_type,
+       CAST(strftime('%s', first_seen) AS INTEGER),
+       CAST(strftime('%s', last_seen) AS INTEGER),
+       is_blocked
+FROM user_devices
+WHERE is_active = 1
+"""
+
+OS_LIMITS_SQL = "SELECT user_id, os_type, device_limit FROM user_os_limits"
+USER_OS_LIMITS_SQL = OS_LIMITS_SQL + " WHERE user_id = ?"
+
+# Лимит тарифа из общей с панелью таблицы users: столько слотов на каждую ОС без покупок
+BASE_LIMITS_SQL = "SELECT uuid, device_limit FROM users WHERE device_limit IS NOT NULL"
+USER_BASE_LIMIT_SQL = BASE_LIMITS_SQL + " AND uuid = ?"
+
+PLANS_SQL = "SELECT user_id, plan FROM user_plans"
+
+
+def snapshot_is_fresh(snapshot_path: str, db_path: str) -> bool:
+    """Снимок годится, только если он записан после последней записи в БД"""
+    try:
+        snapshot_mtime = os.path.getmtime(snapshot_path)
+    except OSError:
+        return False
+
+    for path in (db_path, f"{db_path}-wal"):
+        try:
+            if os.path.getmtime(path) > snapshot_mtime:
+                return False
+        except OSError:
+            pass
+    return True
+
+
+def load_devices(db_path: str, registry: DeviceRegistry,
+                 user_filter: Optional[Callable[[str], bool]] = None) -> int:
+    """Потоковое чтение активных устройств из user_devices"""
+    codes = {os_type.value: code for os_type, code in OS_CODES.items()}
+    unknown = OS_CODES[DeviceOS.UNKNOWN]
+    add = registry.add
+    loaded = skipped = 0
+
+    conn = sqlite3.connect(db_path)
+    try:
+        cursor = conn.execute(DEVICES_SQL)
+        while True:
+            rows = cursor.fetchmany(FETCH_SIZE)
+            if not rows:
+                break
+            for user_id, fp, ip, os_type, first_seen, last_seen, blocked in rows:
+                if user_filter is not None and not user_filter(user_id):
+                    continue
+                fp = stored_fingerprint(fp)
+                if fp is None:
+                    skipped += 1
+                    continue
+                record = DeviceRecord(
+                    fp,
+                    sys.intern(ip) if ip else ip,
+                    codes.get(os_type, unknown),
+                    first_seen or 0,
+                    last_seen or first_seen or 0
+                )
+                record.blocked = bool(blocked)
+                add(user_id, record)
+                loaded += 1
+    except sqlite3.OperationalError as e:
+        # Таблицы еще нет - первый запуск
+        print(f"State restore skipped: {e}")
+    finally:
+        conn.close()
+
+    if skipped:
+        print(f"State restore: {skipped} devices with unreadable fingerprints skipped")
+    return loaded
+
+
+def load_os_limits(db_path: str,
+                   user_filter: Optional[Callable[[str], bool]] = None,
+                   user_id: Optional[str] = None) -> Dict[str, Dict[DeviceOS, int]]:
+    """Купленные лимиты по ОС: user_id -> {ОС: лимит}; user_id - только один пользователь"""
+    limits: Dict[str, Dict[DeviceOS, int]] = {}
+    if user_id is None:
+        query = (OS_LIMITS_SQL, ())
+    else:
+        query = (USER_OS_LIMITS_SQL, (user_id,))
+
+    conn = sqlite3.connect(db_path)
+    try:
+        for user_id, os_type, device_limit in conn.execute(*query):
+            if user_filter is not None and not user_filter(user_id):
+                continue
+            try:
+                limits.setdefault(user_id, {})[DeviceOS(os_type)] = device_limit
+            except ValueError:
+                continue
+    except sqlite3.OperationalError as e:
+        print(f"OS limits restore skipped: {e}")
+    finally:
+        conn.close()
+
+    return limits
+
+
+def load_base_limits(db_path: str,
+                     user_filter: Optional[Callable[[str], bool]] = None,
+                     user_id: Optional[str] = None) -> Dict[str, int]:
+    """Лимиты тарифа: user_id -> users.device_limit; user_id - только один пользователь"""
+    if user_id is None:
+        query = (BASE_LIMITS_SQL, ())
+    else:
+        query = (USER_BASE_LIMIT_SQL, (user_id,))
+
+    conn = sqlite3.connect(db_path)
+    try:
+        return {
+            user_id: device_limit for user_id, device_limit in conn.execute(*query)
+            if user_filter is None or user_filter(user_id)
+        }
+    except sqlite3.OperationalError as e:
+        print(f"Base limits restore skipped: {e}")
+        return {}
+    finally:
+        conn.close()
+
+
+def load_plans(db_path: str,
+               user_filter: Optional[Callable[[str], bool]] = None) -> Dict[str, str]:
+    """Тарифы пользователей: user_id -> тариф (таймаут простоя устройств)"""
+    conn = sqlite3.connect(db_path)
+    try:
+        return {
+            user_id: plan for user_id, plan in conn.execute(PLANS_SQL)
+            if user_filter is None or user_filter(user_id)
+        }
+    except sqlite3.OperationalError as e:
+        print(f"Plans restore skipped: {e}")
+        return {}
+    finally:
+        conn.close()
+
+
+def restore_state(db_path: str, registry: DeviceRegistry,
+                  snapshot_path: Optional[str] = None,
+                  user_filter: Optional[Callable[[str], bool]] = None) -> dict:
+    """Заполнение registry из снимка или из БД; возвращает статистику загрузки"""
+    start = time.perf_counter()
+    source = 'db'
+    devices = 0
+
+    # Миллионы новых объектов запускают сборщик циклов снова и снова - отключаем на время загрузки
+    gc_was_enabled = gc.isenabled()
+    gc.disable()
+    try:
+        if snapshot_path and snapshot_is_fresh(snapshot_path, db_path):
+            try:
+                devices = registry.load_snapshot(snapshot_path, user_filter)
+                source = 'snapshot'
+            except (OSError, EOFError, ValueError, TypeError) as e:
+                print(f"Snapshot ignored: {e}")
+                registry.clear()
+
+        if source == 'db':
+            devices = load_devices(db_path, registry, user_filter)
+    finally:
+        if gc_was_enabled:
+            gc.enable()
+
+    return {
+        'source': source,
+        'devices': devices,
+        'seconds': time.perf_counter() - start
+    }
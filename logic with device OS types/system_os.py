@@ -1,72 +1,262 @@
 # Система управления устройствами по ОС
 
+import asyncio
+import json
+import sys
+import time
+from typing import Callable, Dict, List, Optional, Set, Tuple
+
+from common.cluster import ClusterPresence
+from common.device_expiry import IdleExpiry
+from common.device_registry import DeviceRecord, DeviceRegistry
+from device_store import DeviceStore
+from common.fingerprint import canonical, fingerprint
+from limits import LimitService
+from os_slots import OSSlots
+from state_loader import load_plans, restore_state
+from tls_fingerprint import OS_BY_CODE, OS_CODES, DeviceOS, DeviceSignature, OSDetector
+
+# newest_wins: вытесняется только устройство, простаивающее дольше этого, секунд.
+# Иначе два активных устройства одной ОС вытесняли бы друг друга на каждом тике
+DISPLACE_AFTER = 300.0
+
 class DeviceManager:
-    def __init__(self, db_path: str):
+    def __init__(self, db_path: str, snapshot_path: Optional[str] = None,
+                 user_filter: Optional[Callable[[str], bool]] = None,
+                 cluster: Optional[ClusterPresence] = None,
+                 idle_timeouts: Optional[Dict[str, float]] = None, newest_wins: bool = False,
+                 signatures_path: Optional[str] = None, clock: Callable[[], float] = time.time,
+                 displace_after: float = DISPLACE_AFTER):
         self.db_path = db_path
-        self.os_detector = OSDetector()
-        self.user_devices: Dict[str, Dict[DeviceOS, DeviceSignature]] = {}
+        self.os_detector = OSDetector(signatures_path)
+        # Источник времени для last_seen; при воспроизведении логов - время из строк лога
+        self.clock = clock
+        # Компактные записи устройств: user_id -> fingerprint -> DeviceRecord
+        self.user_devices = DeviceRegistry()
+        # Индекс тех же записей по (пользователь, ОС) в порядке активности
+        self.slots = OSSlots()
+        # Все слоты ОС заняты: False - новое устройство отклоняется,
+        # True - оно вытесняет самое давно активное устройство этой ОС
+        self.newest_wins = newest_wins
+        self.displace_after = displace_after
+        # Вытесненные устройства (user_id, запись) - их забирает LimitEngine
+        self.displaced: List[Tuple[str, DeviceRecord]] = []
+        # Запись в SQLite идет в фоне пачками, проверка лимита диск не ждет
+        self.store = DeviceStore(db_path)
+        self.snapshot_path = snapshot_path or f"{db_path}.snapshot"
+        # Шард загружает из БД только своих пользователей
+        self.user_filter = user_filter
+        # Купленные лимиты по ОС: user_id -> {ОС: лимит}, после покупки - limits.invalidate()
+        self.limits = LimitService(db_path, user_filter)
+        # Кластерный режим: слот ОС занят и устройством на другом узле
+        self.cluster = cluster
+        # Версия устройств пользователя на других узлах при последней сверке
+        self.cluster_versions: Dict[str, int] = {}
+        # Слот ОС освобождается, если устройство простаивает дольше таймаута тарифа
+        self.expiry = IdleExpiry(self.user_devices, plan_timeouts=idle_timeouts)
+    
+    async def restore(self) -> dict:
+        """Загрузка устройств и лимитов из снимка/БД, затем запуск записи в БД"""
+        stats = await asyncio.to_thread(
+            restore_state, self.db_path, self.user_devices, self.snapshot_path, self.user_filter
+        )
+        await self.limits.load()
+        plans = await asyncio.to_thread(load_plans, self.db_path, self.user_filter)
+        for user_id, plan in plans.items():
+            self.expiry.set_plan(user_id, plan)
+        self.expiry.track_all()
+        self.slots.rebuild(self.user_devices)
+        self.store.start()
+        
+        if self.cluster is not None:
+            for user_id in self.user_devices.users():
+                for record in self.user_devices.devices(user_id):
+                    self.cluster.add(user_id, record.fingerprint, record.os_code, record.first_seen)
+        return stats
         
-    async def check_device_limit(self, user_id: str, connection_data: dict) -> tuple[bool, Optional[str]]:
+    async def check_device_limit(self, user_id: str, connection_data: dict,
+                                 detected_os: Optional[DeviceOS] = None,
+                                 device_fingerprint: Optional[bytes] = None) -> tuple[bool, Optional[str]]:
         """Проверка лимита устройств по типу ОС"""
         
-        # Определяем ОС
-        detected_os = self.os_detector.detect_os_from_connection(connection_data)
+        # Определяем ОС, если вызывающий код еще не сделал этого
+        if detected_os is None:
+            detected_os = self.os_detector.detect_os_from_connection(connection_data)
         
         # Создаем отпечаток устройства
-        device_fingerprint = self.create_device_fingerprint(connection_data, detected_os)
+        if device_fingerprint is None:
+            device_fingerprint = self.create_device_fingerprint(connection_data, detected_os)
+        
+        os_code = OS_CODES[detected_os]
+        
+        # Занятые слоты этой ОС
+        slots = self.slots.get(user_id, os_code)
+        record = slots.get(device_fingerprint)
+        if record is not None:
+            # То же устройство - разрешаем, оно становится самым недавно активным
+            self.seen(user_id, record, connection_data.get('ip'))
+            return True, None
         
-        # Получаем текущие устройства пользователя
-        user_devices = self.user_devices.get(user_id, {})
+        # Слотов ОС: 1 или купленное число (словарь в памяти, без запроса в БД)
+        limit = self.limits.get(user_id, detected_os)
+        occupied = len(slots)
         
-        # Проверяем, есть ли уже устройство с этой ОС
-        if detected_os in user_devices:
-            existing_device = user_devices[detected_os]
-            
-            # Если это то же устройство - разрешаем
-            if existing_device.fingerprint == device_fingerprint:
-                existing_device.last_seen = datetime.now()
-                return True, None
-            
-            # Если другое устройство с той же ОС - блокируем
-            return False, f"already_exists:{detected_os.value}"
+        # Слот ОС может быть занят устройством на другом узле (кэш, без запроса в сеть)
+        if self.cluster is not None:
+            occupied += sum(
+                1 for fp, (_, remote_os) in self.cluster.remote_devices(user_id).items()
+                if remote_os == os_code and fp != device_fingerprint
+            )
+        
+        if occupied >= limit:
+            # Вытеснять можно только свое устройство, и только если это освободит слот
+            if not self.newest_wins or not slots or occupied - 1 >= limit:
+                return False, f"already_exists:{detected_os.value}"
+            displaced = self.slots.least_recent(user_id, os_code)
+            if self.clock() - displaced.last_seen < self.displace_after:
+                # Давно неактивного устройства нет - все заняты активными
+                return False, f"already_exists:{detected_os.value}"
+            self.release(user_id, displaced)
+            self.displaced.append((user_id, displaced))
         
         # Добавляем новое устройство
+        record, created = self.user_devices.upsert(
+            user_id, device_fingerprint, connection_data.get('ip'), os_code, self.clock()
+        )
+        if created:
+            self.expiry.track(user_id, record)
+        self.slots.add(user_id, record)
+        
+        # Полная сигнатура нужна только для БД, в памяти держим компактную запись
         new_device = DeviceSignature(
             os_type=detected_os,
-            ip_address=connection_data.get('ip'),
+            ip_address=record.ip,
             fingerprint=device_fingerprint,
             tls_signature=self.extract_tls_signature(connection_data),
             tcp_signature=self.extract_tcp_signature(connection_data),
-            first_seen=datetime.now(),
-            last_seen=datetime.now()
+            first_seen=record.first_seen_dt,
+            last_seen=record.last_seen_dt
         )
         
-        if user_id not in self.user_devices:
-            self.user_devices[user_id] = {}
-        
-        self.user_devices[user_id][detected_os] = new_device
-        
-        # Сохраняем в БД
-        await self.save_device_to_db(user_id, new_device)
+        # Сохраняем в БД (буфер, запись при ближайшем сбросе)
+        self.store.upsert(user_id, new_device)
+        if self.cluster is not None:
+            self.cluster.add(user_id, device_fingerprint, os_code, record.first_seen)
         
         return True, None
     
-    def create_device_fingerprint(self, connection_data: dict, os_type: DeviceOS) -> str:
-        """Создание уникального отпечатка устройства"""
-        fingerprint_data = {
-            'os': os_type.value,
-            'tls_ciphers': connection_data.get('tls', {}).get('ciphers', []),
-            'tls_extensions': connection_data.get('tls', {}).get('extensions', []),
-            'tcp_ttl': connection_data.get('tcp', {}).get('ttl'),
-            'tcp_window': connection_data.get('tcp', {}).get('window_size'),
-            'sni': connection_data.get('sni'),
-        }
+    def users(self) -> Set[str]:
+        """Пользователи с устройствами или купленными слотами (для снимков бота)"""
+        return set(self.user_devices.users()) | set(self.limits.users())
+    
+    def expire_idle(self, now: Optional[float] = None) -> List[Tuple[str, DeviceRecord]]:
+        """Освобождение слотов простаивающих устройств (в реестре, БД и кластере)"""
+        expired = self.expiry.expire(now)
+        for user_id, record in expired:
+            self.slots.remove(user_id, record)
+            self.store.deactivate(record.fingerprint)
+            if self.cluster is not None:
+                self.cluster.remove(user_id, record.fingerprint)
+        return expired
+    
+    def release(self, user_id: str, record: DeviceRecord):
+        """Освобождение слота вытесненного устройства (в реестре, индексе, БД и кластере)"""
+        self.user_devices.remove(user_id, record.fingerprint)
+        self.slots.remove(user_id, record)
+        self.store.deactivate(record.fingerprint)
+        if self.cluster is not None:
+            self.cluster.remove(user_id, record.fingerprint)
+    
+    def reconcile_cluster(self, user_id: str) -> List[DeviceRecord]:
+        """Сверка с устройствами других узлов после изменения их набора.
+
+        Слоты ОС делятся по first_seen (при равенстве - по отпечатку), как в
+        варианте по количеству: все узлы приходят к одному решению. Возвращает
+        свои устройства, которые не поместились в лимит, - их слоты освобождены.
+        """
+        if user_id not in self.user_devices:
+            self.cluster_versions.pop(user_id, None)
+            return []
+        version = self.cluster.version(user_id)
+        if self.cluster_versions.get(user_id) == version:
+            return []
+        self.cluster_versions[user_id] = version
+
+        remote = self.cluster.remote_devices(user_id)
+        if not remote:
+            return []
+
+        evicted = []
+        for os_code in {remote_os for _, remote_os in remote.values()}:
+            local = self.slots.get(user_id, os_code)
+            if not local:
+                continue
+            limit = self.limits.get(user_id, OS_BY_CODE[os_code])
+            ranked = sorted(
+                [(record.first_seen, fp, record) for fp, record in local.items()]
+                + [(first_seen, fp, None) for fp, (first_seen, remote_os) in remote.items()
+                   if remote_os == os_code and fp not in local],
+                key=lambda x: x[:2]
+            )
+            # Чужие устройства сверх лимита освобождает их узел
+            evicted.extend(record for _, _, record in ranked[limit:] if record is not None)
+
+        for record in evicted:
+            self.release(user_id, record)
+        return evicted
+    
+    def drain_displaced(self) -> List[Tuple[str, DeviceRecord]]:
+        displaced, self.displaced = self.displaced, []
+        return displaced
+    
+    def seen(self, user_id: str, record: DeviceRecord, ip: Optional[str]):
+        """Устройство снова активно: last_seen, IP и место в очереди вытеснения"""
+        record.touch(int(self.clock()))
+        if ip and record.ip != ip:
+            record.ip = sys.intern(ip)
+        self.slots.touch(user_id, record)
+        self.store.touch(record.fingerprint, record.last_seen, record.ip)
+    
+    def touch_device(self, user_id: str, device_fingerprint: bytes, ip: Optional[str]) -> bool:
+        """Повторное подключение уже допущенного устройства: только last_seen"""
+        record = self.user_devices.get(user_id, device_fingerprint)
+        if record is None:
+            return False
+        self.seen(user_id, record, ip)
+        return True
+    
+    def close(self):
+        """Запись накопленных изменений, остановка потока БД и снимок состояния"""
+        self.store.close()
+        self.user_devices.save_snapshot(self.snapshot_path)
+    
+    def extract_tls_signature(self, connection_data: dict) -> str:
+        """Параметры TLS для хранения в БД"""
+        return json.dumps(connection_data.get('tls', {}), sort_keys=True)
+    
+    def extract_tcp_signature(self, connection_data: dict) -> str:
+        """Параметры TCP для хранения в БД"""
+        return json.dumps(connection_data.get('tcp', {}), sort_keys=True)
+    
+    def create_device_fingerprint(self, connection_data: dict, os_type: DeviceOS) -> bytes:
+        """Создание уникального отпечатка устройства (16 байт)"""
+        tls_data = connection_data.get('tls', {})
+        tcp_data = connection_data.get('tcp', {})
         
-        # Добавляем специфичные для ОС параметры
-        if os_type in [DeviceOS.IOS, DeviceOS.MACOS]:
-            fingerprint_data['apple_specific'] = connection_data.get('apple_push_token')
+        # Специфичный для ОС параметр
+        if os_type in (DeviceOS.IOS, DeviceOS.MACOS):
+            os_specific = connection_data.get('apple_push_token')
         elif os_type == DeviceOS.ANDROID:
-            fingerprint_data['android_id'] = connection_data.get('android_id')
+            os_specific = connection_data.get('android_id')
+        else:
+            os_specific = None
         
-        fingerprint_str = json.dumps(fingerprint_data, sort_keys=True)
-        return hashlib.sha256(fingerprint_str.encode()).hexdigest()
\ No newline at end of file
+        return fingerprint((
+            os_type.value,
+            canonical(tls_data.get('ciphers', [])),
+            canonical(tls_data.get('extensions', [])),
+            tcp_data.get('ttl'),
+            tcp_data.get('window_size'),
+            connection_data.get('sni'),
+            os_specific,
+        ))
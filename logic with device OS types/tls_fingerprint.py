@@ -2,8 +2,9 @@
 
 import hashlib
 import json
+from collections import OrderedDict
 from enum import Enum
-from typing import Dict, Optional, Set
+from typing import Dict, Optional, Set, Tuple
 from dataclasses import dataclass
 from datetime import datetime
 
@@ -15,11 +16,15 @@ class DeviceOS(Enum):
     LINUX = "linux"
     UNKNOWN = "unknown"
 
+# Компактные коды ОС для хранения в DeviceRegistry
+OS_BY_CODE = list(DeviceOS)
+OS_CODES = {os_type: code for code, os_type in enumerate(OS_BY_CODE)}
+
 @dataclass
 class DeviceSignature:
     os_type: DeviceOS
     ip_address: str
-    fingerprint: str
+    fingerprint: bytes
     tls_signature: str
     tcp_signature: str
     first_seen: datetime
@@ -27,151 +32,97 @@ class DeviceSignature:
     is_active: bool = True
 
 class OSDetector:
-    def __init__(self):
-        # TLS signatures для разных ОС
-        self.tls_patterns = {
-            DeviceOS.IOS: {
-                'ciphers': [
-                    'TLS_AES_128_GCM_SHA256',
-                    'TLS_AES_256_GCM_SHA384',
-                    'TLS_CHACHA20_POLY1305_SHA256'
-                ],
-                'extensions': ['0x0017', '0x0000', '0x0023'],
-                'curves': ['x25519', 'secp256r1', 'secp384r1'],
-                'alpn': ['h2', 'http/1.1'],
-                'versions': ['TLS 1.3', 'TLS 1.2']
-            },
-            DeviceOS.ANDROID: {
-                'ciphers': [
-                    'TLS_AES_128_GCM_SHA256',
-                    'TLS_AES_256_GCM_SHA384',
-                    'TLS_ECDHE_ECDSA_WITH_AES_128_GCM_SHA256'
-                ],
-                'extensions': ['0x0000', '0x0017', '0x0010'],
-                'curves': ['x25519', 'secp256r1'],
-                'alpn': ['h2', 'http/1.1'],
-                'versions': ['TLS 1.3', 'TLS 1.2']
-            },
-            DeviceOS.WINDOWS: {
-                'ciphers': [
-                    'TLS_ECDHE_RSA_WITH_AES_128_GCM_SHA256',
-                    'TLS_ECDHE_RSA_WITH_AES_256_GCM_SHA384',
-                    'TLS_DHE_RSA_WITH_AES_128_GCM_SHA256'
-                ],
-                'extensions': ['0x0000', '0x0023', '0x0017', '0x0033'],
-                'curves': ['secp256r1', 'secp384r1'],
-                'alpn': ['h2', 'http/1.1'],
-                'versions': ['TLS 1.2', 'TLS 1.3']
-            },
-            DeviceOS.MACOS: {
-                'ciphers': [
-                    'TLS_AES_128_GCM_SHA256',
-                    'TLS_AES_256_GCM_SHA384',
-                    'TLS_CHACHA20_POLY1305_SHA256'
-                ],
-                'extensions': ['0x0017', '0x0000', '0x0023', '0x0010'],
-                'curves': ['x25519', 'secp256r1', 'secp384r1', 'secp521r1'],
-                'alpn': ['h2', 'http/1.1'],
-                'versions': ['TLS 1.3', 'TLS 1.2']
-            }
-        }
+    def __init__(self, signatures_path: Optional[str] = None, cache_size: int = 8192):
+        # Результаты определения ОС по канонической сигнатуре (LRU)
+        self.cache_size = cache_size
+        self._cache: OrderedDict = OrderedDict()
+        self.cache_hits = 0
+        self.cache_misses = 0
         
-        # TCP/IP характеристики для разных ОС
-        self.tcp_patterns = {
-            DeviceOS.IOS: {
-                'ttl': [64, 255],
-                'window_size': [65535, 131072],
-                'tcp_options': ['mss', 'sackOK', 'timestamps', 'nop', 'wscale']
-            },
-            DeviceOS.ANDROID: {
-                'ttl': [64, 127],
-                'window_size': [65535, 131072, 262144],
-                'tcp_options': ['mss', 'sackOK', 'timestamps', 'nop', 'wscale']
-            },
-            DeviceOS.WINDOWS: {
-                'ttl': [128],
-                'window_size': [65535, 8192],
-                'tcp_options': ['mss', 'nop', 'wscale', 'sackOK', 'timestamps']
-            },
-            DeviceOS.MACOS: {
-                'ttl': [64],
-                'window_size': [65535, 131072],
-                'tcp_options': ['mss', 'nop', 'wscale', 'nop', 'nop', 'timestamps', 'sackOK']
-            }
-        }
+        # Сигнатуры ОС загружаются из файла и компилируются в индексы
+        from os_signatures import DEFAULT_SIGNATURES_PATH, SignatureDB
+        self.signatures = SignatureDB.load(signatures_path or DEFAULT_SIGNATURES_PATH)
     
     def detect_os_from_connection(self, connection_data: dict) -> DeviceOS:
-        """Определение ОС по данным подключения"""
+        """Определение ОС по данным подключения (с кэшем по сигнатуре)"""
+        key = self.signature_key(connection_data)
+        
+        detected = self._cache.get(key)
+        if detected is not None:
+            self._cache.move_to_end(key)
+            self.cache_hits += 1
+            return detected
+        
+        self.cache_misses += 1
+        detected = self._detect_os(connection_data)
         
-        # Получаем TLS fingerprint
-        tls_data = connection_data.get('tls', {})
-        tcp_data = connection_data.get('tcp', {})
+        self._cache[key] = detected
+        if len(self._cache) > self.cache_size:
+            self._cache.popitem(last=False)
+        return detected
+    
+    def signature_key(self, connection_data: dict) -> Tuple:
+        """Каноническая сигнатура: только то, что влияет на результат скоринга"""
+        tls_data = connection_data.get('tls') or {}
+        tcp_data = connection_data.get('tcp') or {}
         
-        scores = {os: 0 for os in DeviceOS if os != DeviceOS.UNKNOWN}
+        return (
+            tls_data.get('ja4'),
+            tls_data.get('ja3'),
+            tls_data.get('version'),
+            tuple(tls_data.get('ciphers', ())),
+            tuple(tls_data.get('extensions', ())),
+            tuple(tls_data.get('curves', ())),
+            tcp_data.get('ttl'),
+            tcp_data.get('window_size'),
+            tuple(tcp_data.get('tcp_options', ())),
+            self._sni_hint(connection_data.get('sni') or '')
+        )
+    
+    def cache_info(self) -> Dict[str, float]:
+        total = self.cache_hits + self.cache_misses
+        return {
+            'hits': self.cache_hits,
+            'misses': self.cache_misses,
+            'size': len(self._cache),
+            'hit_rate': self.cache_hits / total if total else 0.0
+        }
+    
+    @staticmethod
+    def _sni_hint(sni: str) -> Optional[str]:
+        sni = sni.lower()
+        if 'apple' in sni or 'icloud' in sni:
+            return 'apple'
+        if 'android' in sni or 'google' in sni:
+            return 'android'
+        if 'windows' in sni or 'microsoft' in sni:
+            return 'windows'
+        return None
+    
+    def _detect_os(self, connection_data: dict) -> DeviceOS:
+        """Точный поиск по JA3/JA4, при промахе - скоринг"""
+        tls_data = connection_data.get('tls') or {}
+        tcp_data = connection_data.get('tcp') or {}
         
-        # Анализируем TLS параметры
-        if tls_data:
-            for os_type, patterns in self.tls_patterns.items():
-                score = self._calculate_tls_score(tls_data, patterns)
-                scores[os_type] += score
+        # Точное совпадение по JA3/JA4 (точная TCP сигнатура учитывается в скоринге)
+        exact = self.signatures.exact_match(tls_data, tcp_data)
+        if exact is not None:
+            return exact
         
-        # Анализируем TCP параметры
-        if tcp_data:
-            for os_type, patterns in self.tcp_patterns.items():
-                score = self._calculate_tcp_score(tcp_data, patterns)
-                scores[os_type] += score
+        # Иначе взвешенный скоринг по TLS и TCP параметрам
+        scores = self.signatures.score(tls_data, tcp_data)
         
         # Дополнительные проверки по SNI и User-Agent
-        sni = connection_data.get('sni', '')
-        if 'apple' in sni.lower() or 'icloud' in sni.lower():
+        sni_hint = self._sni_hint(connection_data.get('sni') or '')
+        if sni_hint == 'apple':
             scores[DeviceOS.IOS] += 10
             scores[DeviceOS.MACOS] += 5
-        elif 'android' in sni.lower() or 'google' in sni.lower():
+        elif sni_hint == 'android':
             scores[DeviceOS.ANDROID] += 10
-        elif 'windows' in sni.lower() or 'microsoft' in sni.lower():
+        elif sni_hint == 'windows':
             scores[DeviceOS.WINDOWS] += 10
         
         # Возвращаем ОС с максимальным счетом
         if max(scores.values()) > 0:
             return max(scores, key=scores.get)
         return DeviceOS.UNKNOWN
-    
-    def _calculate_tls_score(self, tls_data: dict, patterns: dict) -> int:
-        """Расчет схожести TLS отпечатка"""
-        score = 0
-        
-        # Проверяем шифры
-        client_ciphers = tls_data.get('ciphers', [])
-        for cipher in patterns.get('ciphers', []):
-            if cipher in client_ciphers:
-                score += 2
-        
-        # Проверяем расширения
-        client_extensions = tls_data.get('extensions', [])
-        for ext in patterns.get('extensions', []):
-            if ext in client_extensions:
-                score += 1
-        
-        # Проверяем curves
-        client_curves = tls_data.get('curves', [])
-        for curve in patterns.get('curves', []):
-            if curve in client_curves:
-                score += 2
-        
-        return score
-    
-    def _calculate_tcp_score(self, tcp_data: dict, patterns: dict) -> int:
-        """Расчет схожести TCP параметров"""
-        score = 0
-        
-        # TTL
-        ttl = tcp_data.get('ttl')
-        if ttl and ttl in patterns.get('ttl', []):
-            score += 5
-        
-        # Window size
-        window = tcp_data.get('window_size')
-        if window and window in patterns.get('window_size', []):
-            score += 3
-        
-        return score
\ No newline at end of file
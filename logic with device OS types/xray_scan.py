@@ -1,106 +1,365 @@
 # Интеграция с xRay и мониторинг
 
 import asyncio
-from typing import Dict, List
-import sqlite3
+import time
+from typing import Callable, Dict, Iterable, List, Optional, Set, Tuple
 import grpc
 
+from common.cluster import ClusterPresence
+from common.device_registry import DeviceRecord
+from device_views import ViewStore
+from common.http_client import HTTPClient
+from limit_engine import LimitEngine
+from limits import record_slot_purchase
+from log_parser import AccessLogParser
+from log_stream import open_log_source
+from common.metrics import (CACHE_HIT_RATIO, CONNECTIONS, ERRORS, LOG_LINES, QUEUE_DEPTH, REJECTED,
+                     USERS_AT_LIMIT, MetricsServer, hit_ratio, observe_tick, stage_timings)
+from pipeline import PipelineConfig, Stage
+from common.routing_rules import RoutingRuleManager
+from sharding import ShardPool
+from system_os import DeviceManager
+from tls_fingerprint import DeviceOS
+
+XRAY_API_URL = 'http://localhost:10085'
+
 class XRayOSLimiter:
-    def __init__(self, xray_config: str, bot):
+    def __init__(self, xray_config: str, bot, db_path: str = "devices.db", shards: int = 0,
+                 cluster: Optional[ClusterPresence] = None, metrics_port: Optional[int] = None,
+                 access_log: str = '/var/log/xray/access.log', log_checkpoint: str = 'access.log.offset',
+                 xray_api_url: str = XRAY_API_URL, pipeline: Optional[PipelineConfig] = None,
+                 newest_wins: bool = False, idle_timeouts: Optional[Dict[str, float]] = None):
         self.xray_config = xray_config
+        self.xray_api_url = xray_api_url
         self.bot = bot
-        self.device_manager = DeviceManager("devices.db")
-        self.blocked_connections: Dict[str, List[str]] = {}
+        self.db_path = db_path
+        # shards > 1: разбор, определение ОС и проверка лимитов идут в N процессах,
+        # здесь остаются чтение лога, блокировки и уведомления
+        # newest_wins: новое устройство вытесняет давно неактивное той же ОС вместо отказа
+        # idle_timeouts: таймаут простоя по тарифу (тариф -> секунд), слот освобождается по нему
+        self.shard_pool = ShardPool(shards, db_path, newest_wins, idle_timeouts) if shards > 1 else None
+        if self.shard_pool is None:
+            self.device_manager = DeviceManager(db_path, cluster=cluster, idle_timeouts=idle_timeouts,
+                                                newest_wins=newest_wins)
+            self.engine = LimitEngine(self.device_manager)
+        # Кластерный режим (устройства на других узлах xRay) работает без шардов
+        self.cluster = cluster if self.shard_pool is None else None
+        self.http = HTTPClient()
+        # Заблокированные IP по пользователям, в xRay уходят пакетом раз в тик
+        self.routing = RoutingRuleManager(self.apply_xray_rules)
+        # Путь к файлу (опрос раз в тик) или unix://, unixgram://, fifo:// - строки приходят сами
+        self.log_source = open_log_source(access_log, checkpoint_path=log_checkpoint)
+        self.log_parser = AccessLogParser()
+        # Выставляется, когда состояние устройств восстановлено после рестарта
+        self.ready = asyncio.Event()
+        # Время стадий текущего тика и пользователи, упершиеся в лимит
+        self.stage_seconds = stage_timings()
+        self.users_at_limit: Set[str] = set()
+        # Отклоненные устройства за заблокированными IP: user_id -> ip -> {отпечаток: ОС}.
+        # За одним IP (NAT) бывают и допущенные устройства - IP разблокируется,
+        # только когда за ним не осталось отклоненных
+        self.blocked_devices: Dict[str, Dict[str, Dict[bytes, str]]] = {}
+        # Снимки устройств пользователей для /status и /devices, бот не читает живой реестр
+        self.views = ViewStore()
+        # Решения, блокировки и уведомления - стадии с ограниченными очередями;
+        # пользователь всегда попадает в одну полосу стадии, поэтому его события упорядочены
+        config = pipeline or PipelineConfig()
+        # Правила xRay уходят одним пакетом раз в тик (routing.sync) - ограничивать нечего;
+        # внешние вызовы из параллельных полос enforce - статистика пользователя
+        self.stats_calls = asyncio.Semaphore(config.stats_concurrency)
+        self.notify_calls = asyncio.Semaphore(config.notify_concurrency)
+        self.decide_stage = Stage('decide', self.process_user_connections,
+                                  config.decide_lanes, config.queue_size)
+        self.enforce_stage = Stage('enforce', self.enforce_user, config.enforce_lanes, config.queue_size)
+        self.notify_stage = Stage('notify', self.deliver_notification,
+                                  config.notify_lanes, config.queue_size)
+        self.metrics_server = MetricsServer(port=metrics_port) if metrics_port is not None else None
+        self.register_metrics()
+    
+    def register_metrics(self):
+        """Метрики, которые вычисляются при чтении /metrics, а не на горячем пути"""
+        QUEUE_DEPTH.labels('routing').set_function(lambda: self.routing.pending)
+        if self.shard_pool is None:
+            QUEUE_DEPTH.labels('device_store').set_function(lambda: self.device_manager.store.pending)
+        for name in ('log_blob', 'os_detector', 'fingerprint', 'connection_state'):
+            CACHE_HIT_RATIO.labels(name).set_function(
+                lambda name=name: hit_ratio(*self.cache_stats().get(name, (0, 0)))
+            )
+        USERS_AT_LIMIT.set_function(lambda: len(self.users_at_limit))
+    
+    def cache_stats(self) -> Dict[str, Tuple[int, int]]:
+        if self.shard_pool is not None:
+            return self.shard_pool.cache_stats()
+        return {'log_blob': self.log_parser.blob_cache_stats(), **self.engine.cache_stats()}
+    
+    async def restore_state(self):
+        """Восстановление устройств из снимка/БД до начала проверок"""
+        if self.shard_pool is not None:
+            stats = await self.shard_pool.restore()
+            for user_id, (rows, limits) in stats['views'].items():
+                self.publish_view(user_id, rows, limits)
+        else:
+            stats = await self.device_manager.restore()
+            # Снимки для бота: /status сразу после рестарта видит восстановленные устройства
+            for user_id in self.device_manager.users():
+                self.publish_view(user_id)
+        print(
+            f"State restored from {stats['source']}: "
+            f"{stats['devices']} devices in {stats['seconds']:.2f}s"
+        )
+        self.ready.set()
+    
+    async def close(self):
+        """Сохранение состояния и закрытие соединений"""
+        self.log_source.close()
+        for stage in (self.decide_stage, self.enforce_stage, self.notify_stage):
+            await stage.close()
+        if self.metrics_server is not None:
+            await self.metrics_server.close()
+        if self.shard_pool is not None:
+            await self.shard_pool.close()
+        else:
+            await asyncio.to_thread(self.device_manager.close)
+        if self.cluster is not None:
+            await self.cluster.close()
+        await self.http.close()
         
     async def monitor_connections(self):
         """Главный цикл мониторинга подключений"""
+        # Без восстановленного состояния все устройства выглядели бы новыми
+        if not self.ready.is_set():
+            await self.restore_state()
+        if self.metrics_server is not None:
+            await self.metrics_server.start()
+        await self.log_source.start()
+        
         while True:
             try:
-                # Получаем активные подключения из xRay
-                connections = await self.get_active_connections()
-                
-                for user_id, conn_list in connections.items():
-                    await self.process_user_connections(user_id, conn_list)
-                    
+                await self.tick()
             except Exception as e:
+                ERRORS.labels('monitor').inc()
                 print(f"Monitoring error: {e}")
                 
-            await asyncio.sleep(2)  # Проверяем каждые 2 секунды
+            # Файл проверяем каждые 2 секунды, сокет - как только пришли строки
+            await self.log_source.wait(2)
+    
+    async def tick(self):
+        """Один проход мониторинга; время тика и стадий уходит в метрики"""
+        start = time.perf_counter()
+        self.stage_seconds = stages = stage_timings()
+        
+        if self.shard_pool is not None:
+            await self.process_sharded()
+        else:
+            # Сначала освобождаем слоты простаивающих устройств
+            self.release_expired(self.engine.expire())
+            
+            # Получаем активные подключения из xRay
+            connections = await self.get_active_connections()
+            
+            # Проверяем только пользователей, у которых появились новые устройства
+            dirty = self.engine.apply_events(connections)
+            if self.cluster is not None:
+                # Набор устройств на других узлах мог измениться и у уже допущенных
+                await self.cluster.prefetch(connections.keys())
+                for user_id, rejected in self.engine.reconcile_cluster(connections.keys()).items():
+                    await self.enforce_stage.put(user_id, user_id, rejected, {})
+            for user_id, conn_list in dirty.items():
+                await self.decide_stage.put(user_id, user_id, conn_list)
+            # Тик ждет решений и блокировок; уведомления уходят в своем темпе
+            await self.decide_stage.join()
+            await self.enforce_stage.join()
+            
+            for stage, seconds in self.engine.drain_timings().items():
+                stages[stage] += seconds
+        
+        t0 = time.perf_counter()
+        await self.routing.sync()
+        stages['enforce'] += time.perf_counter() - t0
+        if self.cluster is not None:
+            await self.cluster.flush()
+        
+        # Запоминаем позицию в логе только после обработки
+        await self.log_source.save_checkpoint()
+        
+        observe_tick(time.perf_counter() - start, stages)
+    
+    def release_expired(self, expired: list):
+        """У пользователя освободился слот - он больше не упирается в лимит"""
+        for user_id, _ in expired:
+            self.users_at_limit.discard(user_id)
+            if self.shard_pool is None:
+                self.publish_view(user_id)
     
     async def get_active_connections(self) -> Dict[str, List[dict]]:
         """Получение активных подключений из xRay через API"""
         connections = {}
         
-        # Парсим логи xRay или используем API
+        # Читаем только строки, дописанные в лог с прошлого тика
         # Здесь нужно извлечь TLS/TCP информацию
-        with open('/var/log/xray/access.log', 'r') as f:
-            for line in f.readlines()[-1000:]:  # Последние 1000 строк
-                conn_data = self.parse_connection_log(line)
-                if conn_data:
-                    user_id = conn_data.get('user_id')
-                    if user_id not in connections:
-                        connections[user_id] = []
-                    connections[user_id].append(conn_data)
+        t0 = time.perf_counter()
+        lines = await self.log_source.read_new_lines()
+        t1 = time.perf_counter()
+        parsed = self.log_parser.parse_lines(lines)
+        for conn_data in parsed:
+            user_id = conn_data['user_id']
+            if user_id not in connections:
+                connections[user_id] = []
+            connections[user_id].append(conn_data)
         
+        self.stage_seconds['read'] += t1 - t0
+        self.stage_seconds['parse'] += time.perf_counter() - t1
+        LOG_LINES.inc(len(lines))
+        CONNECTIONS.inc(len(parsed))
         return connections
     
     def parse_connection_log(self, log_line: str) -> Optional[dict]:
         """Парсинг строки лога для извлечения данных подключения"""
-        import re
+        return self.log_parser.parse_line(log_line)
+    
+    async def process_sharded(self):
+        """Тик в шардированном режиме: строки уходят шардам, решения применяются здесь"""
+        stages = self.stage_seconds
+        t0 = time.perf_counter()
+        lines = await self.log_source.read_new_lines()
+        stages['read'] += time.perf_counter() - t0
+        LOG_LINES.inc(len(lines))
+        
+        decisions = await self.shard_pool.process_lines(lines)
+        for stage, seconds in decisions['timings'].items():
+            stages[stage] += seconds
+        self.release_expired(decisions['expired'])
         
-        # Парсим данные подключения из лога xRay
-        # Формат зависит от настроек логирования
-        pattern = r'(\d+\.\d+\.\d+\.\d+):(\d+).*user:$$([\w-]+)$$.*tls:(\{.*?\}).*tcp:(\{.*?\})'
-        match = re.search(pattern, log_line)
+        # Решения шардов по пользователям: (отклоненные, допущенные по ОС)
+        per_user: Dict[str, Tuple[list, dict]] = {}
+        for user_id, conn, reason in decisions['rejected']:
+            per_user.setdefault(user_id, ([], {}))[0].append((conn, reason))
+        for user_id, os_devices in decisions['admitted'].items():
+            per_user.setdefault(user_id, ([], {}))[1].update(os_devices)
         
-        if match:
-            return {
-                'ip': match.group(1),
-                'port': match.group(2),
-                'user_id': match.group(3),
-                'tls': json.loads(match.group(4)),
-                'tcp': json.loads(match.group(5)),
-                'timestamp': datetime.now()
-            }
-        return None
+        for user_id, (rejected, os_devices) in per_user.items():
+            await self.enforce_stage.put(user_id, user_id, rejected, os_devices)
+        await self.enforce_stage.join()
+        
+        for user_id, (rows, limits) in decisions['views'].items():
+            self.publish_view(user_id, rows, limits)
     
     async def process_user_connections(self, user_id: str, connections: List[dict]):
-        """Обработка подключений пользователя"""
-        os_devices = {}
-        
-        for conn in connections:
-            # Проверяем лимит устройства
-            allowed, reason = await self.device_manager.check_device_limit(user_id, conn)
-            
-            if not allowed:
-                # Блокируем подключение
+        """Стадия decide: проверка лимитов, решения уходят в стадию enforce"""
+        os_devices, rejected = await self.engine.evaluate(user_id, connections)
+        await self.enforce_stage.put(user_id, user_id, rejected, os_devices)
+    
+    async def enforce_user(self, user_id: str, rejected: List[tuple], os_devices: dict):
+        """Стадия enforce: блокировки и снятие блокировок одного пользователя"""
+        start = time.perf_counter()
+        admitted_ips = {conn['ip'] for conn in os_devices.values()}
+        for conn, reason in rejected:
+            # Вытесненное устройство за тем же IP, что и допущенное (NAT), не блокируем:
+            # блокировка IP отключила бы и новое устройство
+            if not (reason.startswith('displaced:') and conn['ip'] in admitted_ips):
                 await self.block_connection(user_id, conn, reason)
-                
-                # Уведомляем пользователя
-                await self.notify_user_blocked(user_id, conn, reason)
-            else:
-                # Определяем ОС для статистики
-                os_type = self.device_manager.os_detector.detect_os_from_connection(conn)
-                os_devices[os_type] = conn
+            self.users_at_limit.add(user_id)
+            
+            # Уведомление ставится в очередь своей стадии (ждем, только если она переполнена)
+            await self.notify_stage.put(user_id, user_id, conn, reason)
+        REJECTED.inc(len(rejected))
+        
+        self.release_blocks(user_id, os_devices)
         
         # Обновляем статистику пользователя
-        await self.update_user_stats(user_id, os_devices)
+        async with self.stats_calls:
+            await self.update_user_stats(user_id, os_devices)
+        if self.shard_pool is None:
+            self.publish_view(user_id)
+        self.stage_seconds['enforce'] += time.perf_counter() - start
+    
+    async def deliver_notification(self, user_id: str, conn: dict, reason: str):
+        """Стадия notify: медленная отправка не задерживает блокировки"""
+        async with self.notify_calls:
+            start = time.perf_counter()
+            await self.notify_user_blocked(user_id, conn, reason)
+            self.stage_seconds['notify'] += time.perf_counter() - start
+    
+    def release_blocks(self, user_id: str, os_devices: dict):
+        """Устройство допущено (например, слот освободился по простою) - снимаем блокировку его IP,
+        если за ним нет отклоненных устройств пользователя (в том числе из этого же прохода)"""
+        for device_fingerprint, conn in os_devices.items():
+            self.release_ip(user_id, conn['ip'], lambda fp, _: fp == device_fingerprint)
+    
+    def release_ip(self, user_id: str, ip: str, released: Callable[[bytes, str], bool]) -> bool:
+        """Снятие блокировки с отклоненных устройств released(отпечаток, ОС) за IP;
+        сам IP разблокируется, когда за ним не осталось заблокированных устройств"""
+        user_blocked = self.blocked_devices.get(user_id, {})
+        devices = user_blocked.get(ip)
+        if devices is not None:
+            for fp in [fp for fp, os_name in devices.items() if released(fp, os_name)]:
+                del devices[fp]
+            if devices and self.routing.is_blocked(user_id, ip):
+                return False
+            del user_blocked[ip]
+            if not user_blocked:
+                del self.blocked_devices[user_id]
+        return self.routing.unblock(user_id, ip)
+    
+    async def add_os_slots(self, user_id: str, os_type: DeviceOS, slots: int = 1) -> Dict[DeviceOS, int]:
+        """Оплата слота прошла: запись в user_os_limits и новый лимит без рестарта"""
+        await asyncio.to_thread(record_slot_purchase, self.db_path, user_id, os_type, slots)
+        return await self.refresh_limits(user_id, os_type)
+    
+    async def refresh_limits(self, user_id: str, os_type: Optional[DeviceOS] = None) -> Dict[DeviceOS, int]:
+        """Лимиты пользователя изменились в БД - перечитываем их запись и переоцениваем устройства.
+
+        os_type - ОС, у которой изменился лимит (None - любая): блокировка
+        снимается с ее устройств, IP с устройствами других ОС остаются заблокированы.
+        """
+        if self.shard_pool is not None:
+            limits = await self.shard_pool.invalidate(user_id)
+        else:
+            limits = await self.device_manager.limits.invalidate(user_id)
+            self.engine.connection_state.invalidate(user_id)
+        # Заблокированное устройство не может подключиться и не появится в логе -
+        # снимаем блокировки, лишние устройства заблокируются при следующем подключении
+        for ip in self.routing.blocked_ips(user_id):
+            self.release_ip(user_id, ip, lambda _, os_name: os_type is None or os_name == os_type.value)
+        self.users_at_limit.discard(user_id)
+        if self.shard_pool is not None:
+            rows, limits = await self.shard_pool.user_view(user_id)
+            self.publish_view(user_id, rows, limits)
+        else:
+            self.publish_view(user_id)
+        return limits
+    
+    def publish_view(self, user_id: str, rows: Optional[Iterable[tuple]] = None,
+                     limits: Optional[Dict[DeviceOS, int]] = None):
+        """Новый снимок устройств пользователя для бота; в шардированном режиме rows и limits присылает шард"""
+        if rows is None:
+            rows = [
+                (r.os_code, r.ip, r.first_seen, r.last_seen)
+                for r in self.device_manager.user_devices.devices(user_id)
+            ]
+            limits = self.device_manager.limits.effective_limits(user_id)
+        self.views.publish(user_id, rows, limits, self.routing.blocked_ips(user_id))
+    
+    async def user_devices(self, user_id: str) -> List[DeviceRecord]:
+        """Устройства пользователя - из своего реестра или у шарда-владельца"""
+        if self.shard_pool is not None:
+            return await self.shard_pool.user_devices(user_id)
+        return self.device_manager.user_devices.devices(user_id)
     
     async def block_connection(self, user_id: str, connection: dict, reason: str):
         """Блокировка конкретного подключения"""
         
-        # Создаем правило блокировки для xRay
-        block_rule = {
-            "type": "field",
-            "ip": [connection['ip']],
-            "user": [user_id],
-            "outboundTag": "blocked"
-        }
-        
-        # Применяем правило через xRay API
-        await self.apply_xray_rule(block_rule)
-        
-        # Сохраняем в список заблокированных
-        if user_id not in self.blocked_connections:
-            self.blocked_connections[user_id] = []
-        self.blocked_connections[user_id].append(connection['ip'])
\ No newline at end of file
+        # Повторная блокировка того же IP только продлевает TTL правила
+        ip = connection['ip']
+        self.routing.block(user_id, ip)
+        device_fingerprint = connection.get('device')
+        if device_fingerprint is not None:
+            user_blocked = self.blocked_devices.setdefault(user_id, {})
+            # Блокировки, истекшие по TTL, больше не держат свои устройства
+            for stale_ip in [other for other in user_blocked if not self.routing.is_blocked(user_id, other)]:
+                del user_blocked[stale_ip]
+            user_blocked.setdefault(ip, {})[device_fingerprint] = reason.partition(':')[2]
+    
+    async def apply_xray_rules(self, batch: dict):
+        """Применение пакета правил блокировки через xRay API"""
+        return await self.http.post_json(f'{self.xray_api_url}/v1/routing/rules/batch', batch)
\ No newline at end of file
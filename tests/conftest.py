@@ -0,0 +1,60 @@
+# Тесты обоих вариантов в одном прогоне pytest.
+#
+# Модули вариантов импортируются по голому имени (state_loader, limits, db ...),
+# и у вариантов есть одноименные модули с разным содержимым. Перед сбором и
+# запуском тестов из tests/<вариант>/ каталог варианта ставится первым в sys.path,
+# а модули другого варианта убираются из sys.modules в отложенные. При возврате
+# к варианту возвращаются его прежние модули: иначе тесты, собранные раньше,
+# держали бы классы (например, DeviceOS) из одной копии модуля, а ленивые
+# импорты внутри вариантов получали бы другую.
+
+import os
+import sys
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+COMMON_DIR = os.path.join(ROOT, 'common')
+VARIANT_DIRS = {
+    'quantity': os.path.join(ROOT, 'Logic is only about quantity'),
+    'os': os.path.join(ROOT, 'logic with device OS types'),
+}
+
+# Пакет common - из корня репозитория, как при запуске через common_path
+if ROOT not in sys.path:
+    sys.path.append(ROOT)
+
+_active = None
+_stashed = {}  # вариант -> его модули, убранные из sys.modules
+
+
+def use_variant(name: str):
+    """Импорт модулей варианта name по голому имени"""
+    global _active
+    if name == _active:
+        return
+    variant_dirs = set(VARIANT_DIRS.values())
+    stash = _stashed.setdefault(_active, {})
+    for module_name, module in list(sys.modules.items()):
+        module_dir = os.path.dirname(getattr(module, '__file__', None) or '')
+        if module_dir in variant_dirs:
+            stash[module_name] = sys.modules.pop(module_name)
+    sys.modules.update(_stashed.pop(name, {}))
+    sys.path[:] = [path for path in sys.path if path not in variant_dirs]
+    sys.path.insert(0, VARIANT_DIRS[name])
+    _active = name
+
+
+def _variant_of(path) -> str:
+    parts = os.path.relpath(str(path), os.path.dirname(__file__)).split(os.sep)
+    return parts[0] if parts[0] in VARIANT_DIRS else None
+
+
+def pytest_collectstart(collector):
+    variant = _variant_of(collector.path)
+    if variant is not None:
+        use_variant(variant)
+
+
+def pytest_runtest_setup(item):
+    variant = _variant_of(item.path)
+    if variant is not None:
+        use_variant(variant)
@@ -0,0 +1,113 @@
+import asyncio
+import random
+import time
+from datetime import datetime
+
+import pytest
+
+from common.cluster import ClusterPresence, PresenceStore, SQLitePresenceStore
+from limit_engine import LimitEngine
+from common.loadgen import SyntheticDevice
+from system_os import DeviceManager
+
+
+class Clock:
+    def __init__(self):
+        self.now = time.time()  # SQLitePresenceStore чистит записи по настоящему времени
+
+    def __call__(self) -> float:
+        return self.now
+
+
+def connection(device: SyntheticDevice) -> dict:
+    return {
+        **device.connection(),
+        'user_id': 'u1',
+        'signature': hash((device.tls_blob, device.tcp_blob)),
+        'timestamp': datetime.now(),
+    }
+
+
+def ios_device(ip: str, seed: int) -> SyntheticDevice:
+    device = SyntheticDevice('ios', ip, random.Random(seed))
+    device.tcp['window_size'] = 65535 + seed  # разные отпечатки
+    device.sni = 'gateway.icloud.com'
+    return device
+
+
+class Node:
+    """Узел кластера: реестр, движок и присутствие в общем файле SQLite"""
+
+    def __init__(self, tmp_path, name: str, clock: Clock):
+        self.clock = clock
+        self.cluster = ClusterPresence(SQLitePresenceStore(str(tmp_path / 'presence.db')), name, lease=5)
+        self.manager = DeviceManager(str(tmp_path / f'{name}.db'), cluster=self.cluster, clock=clock)
+        self.engine = LimitEngine(self.manager)
+
+    async def tick(self, conns: list, publish: bool = True) -> list:
+        """Как XRayOSLimiter.tick: события, сверка с кластером, проверка новых устройств"""
+        connections = {'u1': conns}
+        dirty = self.engine.apply_events(connections)
+        await self.cluster.prefetch(connections.keys(), self.clock())
+        reasons = [reason for _, reason in self.engine.reconcile_cluster(connections.keys()).get('u1', ())]
+        for user_id, conn_list in dirty.items():
+            _, rejected = await self.engine.evaluate(user_id, conn_list)
+            reasons.extend(reason for _, reason in rejected)
+        if publish:
+            await self.cluster.flush(self.clock())
+        return reasons
+
+
+def test_admitted_device_is_reevaluated_when_remote_version_changes(tmp_path):
+    async def scenario():
+        clock = Clock()
+        first, second = Node(tmp_path, 'a', clock), Node(tmp_path, 'b', clock)
+        older, newer = ios_device('10.0.0.1', 1), ios_device('10.0.0.2', 2)
+
+        # Оба узла допускают свое устройство, пока не видят друг друга
+        assert await first.tick([connection(older)], publish=False) == []
+        clock.now += 1
+        assert await second.tick([connection(newer)]) == []
+        await first.cluster.flush(clock())
+
+        # После аренды оба видят чужое устройство: слот остается у более раннего first_seen
+        clock.now += 10
+        assert await first.tick([connection(older)]) == []
+        assert await second.tick([connection(newer)]) == ['already_exists:ios']
+        assert [r.ip for r in first.manager.user_devices.devices('u1')] == ['10.0.0.1']
+        assert second.manager.user_devices.devices('u1') == []
+
+        # Без изменений на других узлах повторной сверки нет
+        clock.now += 10
+        assert await first.tick([connection(older)]) == []
+
+        await first.cluster.close()
+        await second.cluster.close()
+
+    asyncio.run(scenario())
+
+
+def test_stale_remote_entries_are_pruned(tmp_path):
+    async def scenario():
+        clock = Clock()
+        node = Node(tmp_path, 'a', clock)
+        await node.cluster.prefetch(['u1', 'u2'], clock())
+        assert node.cluster.version('u1') == 0
+
+        clock.now += 10
+        await node.cluster.prefetch(['u1'], clock())
+        assert set(node.cluster._remote) == {'u1'}
+        await node.cluster.close()
+
+    asyncio.run(scenario())
+
+
+def test_presence_store_requires_publish_and_fetch():
+    class PublishOnly(PresenceStore):
+        async def publish(self, node_id, upserts, removals, expires_at):
+            pass
+
+    with pytest.raises(TypeError):
+        PresenceStore()
+    with pytest.raises(TypeError):
+        PublishOnly()
@@ -0,0 +1,52 @@
+from connection_state import ConnectionState
+
+FP1, FP2 = b'\x01' * 16, b'\x02' * 16
+
+
+def conn(ip: str, signature: int = 1) -> dict:
+    return {'ip': ip, 'signature': signature}
+
+
+def test_only_new_keys_make_user_dirty():
+    state = ConnectionState()
+    assert state.apply('u1', conn('10.0.0.1')) is None
+    state.remember('u1', conn('10.0.0.1'), FP1)
+    assert state.drain_dirty() == {'u1': [conn('10.0.0.1')]}
+
+    # Известное устройство - только отпечаток, проверки нет
+    assert state.apply('u1', conn('10.0.0.1')) == FP1
+    assert state.drain_dirty() == {}
+
+    # Тот же IP с другой сигнатурой и другой IP - новые устройства
+    state.apply('u1', conn('10.0.0.1', signature=2))
+    state.apply('u1', conn('10.0.0.2'))
+    state.apply('u2', conn('10.0.0.1'))
+    assert state.drain_dirty() == {
+        'u1': [conn('10.0.0.1', signature=2), conn('10.0.0.2')],
+        'u2': [conn('10.0.0.1')],
+    }
+    assert state.drain_dirty() == {}
+    assert state.stats == {'events': 5, 'known': 1, 'dirty': 4}
+
+
+def test_rejected_connection_is_rechecked_every_time():
+    state = ConnectionState()
+    for _ in range(2):
+        assert state.apply('u1', conn('10.0.0.1')) is None  # не запомнен - снова грязный
+        assert list(state.drain_dirty()) == ['u1']
+
+
+def test_forget_and_invalidate_require_recheck():
+    state = ConnectionState()
+    state.remember('u1', conn('10.0.0.1'), FP1)
+    state.remember('u1', conn('10.0.0.2'), FP1)  # то же устройство сменило IP
+    state.remember('u1', conn('10.0.0.3'), FP2)
+
+    state.forget('u1', FP1)
+    assert state.apply('u1', conn('10.0.0.1')) is None
+    assert state.apply('u1', conn('10.0.0.2')) is None
+    assert state.apply('u1', conn('10.0.0.3')) == FP2
+
+    state.invalidate('u1')
+    assert state.apply('u1', conn('10.0.0.3')) is None
+    assert len(state) == 0
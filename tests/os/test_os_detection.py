@@ -0,0 +1,70 @@
+import json
+import random
+
+from common.loadgen import SyntheticDevice
+from os_signatures import DEFAULT_SIGNATURES_PATH, ja3_hash
+from tls_fingerprint import DeviceOS, OSDetector
+
+
+def connection(tls_os: str, tcp_os: str, sni: str = '') -> dict:
+    """ClientHello одной ОС и TCP SYN другой (одна модель устройства - одинаковый Random)"""
+    tls = SyntheticDevice(tls_os, '10.0.0.1', random.Random(1)).tls
+    tcp = SyntheticDevice(tcp_os, '10.0.0.1', random.Random(1)).tcp
+    return {'tls': tls, 'tcp': tcp, 'sni': sni}
+
+
+def test_ios_hello_with_macos_tcp_stack_is_ios():
+    # Точная TCP сигнатура macOS не перебивает шифры iOS и SNI iCloud
+    detector = OSDetector()
+    conn = connection('ios', 'macos', 'gateway.icloud.com')
+    assert detector.detect_os_from_connection(conn) == DeviceOS.IOS
+
+
+def test_macos_profile_is_macos():
+    detector = OSDetector()
+    assert detector.detect_os_from_connection(connection('macos', 'macos', 'swscan.apple.com')) == DeviceOS.MACOS
+    assert detector.detect_os_from_connection(connection('macos', 'macos')) == DeviceOS.MACOS
+
+
+def test_ios_profile_is_ios():
+    detector = OSDetector()
+    assert detector.detect_os_from_connection(connection('ios', 'ios', 'gateway.icloud.com')) == DeviceOS.IOS
+
+
+def test_exact_tcp_signature_breaks_tie_without_tls():
+    detector = OSDetector()
+    conn = connection('macos', 'macos')
+    del conn['tls']
+    assert detector.detect_os_from_connection(conn) == DeviceOS.MACOS
+
+
+def detector_with_exact(tmp_path, exact_tls: list) -> OSDetector:
+    """Шаблоны из поставляемого файла и точные TLS сигнатуры фикстуры"""
+    with open(DEFAULT_SIGNATURES_PATH) as f:
+        data = json.load(f)
+    data['exact']['tls'] = exact_tls
+    path = tmp_path / 'signatures.json'
+    path.write_text(json.dumps(data))
+    return OSDetector(str(path))
+
+
+def test_exact_ja3_and_ja4_win_over_scoring(tmp_path):
+    android = connection('android', 'android', 'android.googleapis.com')
+    ios = connection('ios', 'ios', 'gateway.icloud.com')
+    ios['tls'] = {**ios['tls'], 'ja4': 't13d1516h2_8daaf6152771_e5627efa2ab1'}
+    detector = detector_with_exact(tmp_path, [
+        # По скорингу это Android и iOS - точные записи фикстуры говорят другое
+        {'os': 'linux', 'ja3': ja3_hash(android['tls'])},
+        {'os': 'macos', 'ja4': 't13d1516h2_8daaf6152771_e5627efa2ab1'},
+    ])
+    assert detector.detect_os_from_connection(android) == DeviceOS.LINUX
+    assert detector.detect_os_from_connection(ios) == DeviceOS.MACOS
+    # Без записи в фикстуре - скоринг
+    assert OSDetector().detect_os_from_connection(android) == DeviceOS.ANDROID
+
+
+def test_ambiguous_exact_entry_falls_back_to_scoring(tmp_path):
+    android = connection('android', 'android', 'android.googleapis.com')
+    key = ja3_hash(android['tls'])
+    detector = detector_with_exact(tmp_path, [{'os': 'linux', 'ja3': key}, {'os': 'windows', 'ja3': key}])
+    assert detector.detect_os_from_connection(android) == DeviceOS.ANDROID
@@ -0,0 +1,76 @@
+import sqlite3
+from datetime import datetime
+from types import SimpleNamespace
+
+from device_store import SCHEMA, DeviceStore
+from tls_fingerprint import DeviceOS
+
+FP1, FP2 = b'\x01' * 16, b'\x02' * 16
+NOW = 1_700_000_000
+
+
+def signature(fp: bytes, ip: str) -> SimpleNamespace:
+    """Поля DeviceSignature, которые пишет DeviceStore"""
+    seen = datetime.fromtimestamp(NOW)
+    return SimpleNamespace(os_type=DeviceOS.IOS, fingerprint=fp, ip_address=ip,
+                           tls_signature='tls', tcp_signature='tcp', first_seen=seen, last_seen=seen)
+
+
+def open_db(path: str, timeout: float = 5.0) -> sqlite3.Connection:
+    conn = sqlite3.connect(path, timeout=timeout)
+    conn.executescript(SCHEMA)
+    return conn
+
+
+def rows(conn: sqlite3.Connection) -> dict:
+    return {
+        fp: (ip, last_seen, active) for fp, ip, last_seen, active in
+        conn.execute("SELECT device_fingerprint, ip_address, last_seen, is_active FROM user_devices")
+    }
+
+
+def test_changes_coalesce_into_one_row_per_device(tmp_path):
+    path = str(tmp_path / 'devices.db')
+    store = DeviceStore(path)  # поток не запущен: сброс вызывается явно
+    store.upsert('u1', signature(FP1, '10.0.0.1'))
+    for i in range(3):
+        store.touch(FP1, NOW + i + 1, '10.0.0.2')  # касания вливаются в еще не записанный UPSERT
+    assert store.pending == 1
+
+    conn = open_db(path)
+    store._flush(conn)
+    assert rows(conn) == {FP1: ('10.0.0.2', '2023-11-14 22:13:23', 1)}
+
+    for i in range(3):
+        store.touch(FP1, NOW + 10 + i, '10.0.0.3')
+    store.deactivate(FP2)
+    assert store.pending == 2
+    store._flush(conn)
+    assert rows(conn) == {FP1: ('10.0.0.3', '2023-11-14 22:13:32', 1)}
+    assert store.stats['flushes'] == 2 and store.stats['rows'] == 3
+    conn.close()
+
+
+def test_locked_database_requeues_batch_and_keeps_newer_changes(tmp_path):
+    path = str(tmp_path / 'devices.db')
+    store = DeviceStore(path)
+    store.upsert('u1', signature(FP1, '10.0.0.1'))
+    store.upsert('u1', signature(FP2, '10.0.0.2'))
+
+    conn = open_db(path, timeout=0)
+    locker = open_db(path)
+    locker.execute('BEGIN EXCLUSIVE')
+    store._flush(conn)
+    assert store.stats['errors'] == 1
+    assert store.pending == 2  # пачка вернулась в буфер
+
+    # Пока БД занята: FP1 снова касался, FP2 истек
+    store.touch(FP1, NOW + 60, '10.0.0.9')
+    store.deactivate(FP2)
+    locker.rollback()
+    locker.close()
+
+    store._flush(conn)
+    assert rows(conn) == {FP1: ('10.0.0.9', '2023-11-14 22:14:20', 1)}
+    assert store.pending == 0
+    conn.close()
@@ -0,0 +1,13 @@
+import os
+
+from common import metrics
+import system_os
+import xray_scan
+
+from conftest import COMMON_DIR, VARIANT_DIRS
+
+
+def test_variant_modules_use_common_copies():
+    assert os.path.dirname(metrics.__file__) == COMMON_DIR
+    assert os.path.dirname(system_os.__file__) == VARIANT_DIRS['os']
+    assert xray_scan.XRayOSLimiter
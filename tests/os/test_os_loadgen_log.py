@@ -0,0 +1,19 @@
+from datetime import datetime
+
+from common.loadgen import SyntheticPopulation
+from log_parser import AccessLogParser
+
+
+def test_synthetic_log_lines_parse_back_to_devices():
+    population = SyntheticPopulation(30, seed=3)
+    now = datetime(2024, 1, 31, 12, 0, 0).timestamp()
+    parser = AccessLogParser()
+    parsed = parser.parse_lines(population.log_lines(200, now=now))
+
+    # Каждая строка разбирается быстрым путем и совпадает с устройством пользователя
+    assert len(parsed) == 200 and parser.fallback_lines == 0
+    for conn in parsed:
+        device = next(d for d in population.devices[conn['user_id']] if d.ip == conn['ip'])
+        assert conn['port'] == str(device.port)
+        assert conn['tls'] == device.tls and conn['tcp'] == device.tcp
+        assert conn['timestamp'].replace(microsecond=0) == datetime(2024, 1, 31, 12, 0, 0)
@@ -0,0 +1,87 @@
+import asyncio
+import os
+
+from log_follower import LogFollower
+
+
+def read(follower: LogFollower) -> list:
+    return asyncio.run(follower.read_new_lines())
+
+
+def append(path, text: str):
+    with open(path, 'a') as f:
+        f.write(text)
+
+
+def test_reads_only_new_complete_lines(tmp_path):
+    log = tmp_path / 'access.log'
+    log.write_text('old\n')
+    follower = LogFollower(str(log))
+    assert read(follower) == []
+
+    append(log, 'a\nb')
+    assert read(follower) == ['a']
+    append(log, 'c\n')
+    assert read(follower) == ['bc']
+    follower.close()
+
+
+def test_rotation_drains_old_file_then_follows_new(tmp_path):
+    log = tmp_path / 'access.log'
+    log.write_text('a\n')
+    follower = LogFollower(str(log), start_at_end=False)
+    assert read(follower) == ['a']
+
+    # Дописано перед ротацией, последняя строка без \n
+    append(log, 'b\ntail')
+    os.rename(log, tmp_path / 'access.log.1')
+    assert read(follower) == ['b', 'tail']
+
+    log.write_text('c\n')
+    assert read(follower) == ['c']
+    follower.close()
+
+
+def test_copytruncate_restarts_from_beginning(tmp_path):
+    log = tmp_path / 'access.log'
+    log.write_text('first line\nsecond line\n')
+    follower = LogFollower(str(log), start_at_end=False)
+    assert read(follower) == ['first line', 'second line']
+
+    with open(log, 'w') as f:
+        f.write('x\n')
+    assert read(follower) == ['x']
+    follower.close()
+
+
+def test_checkpoint_resumes_at_unfinished_line(tmp_path):
+    log = tmp_path / 'access.log'
+    checkpoint = str(tmp_path / 'access.log.offset')
+    log.write_text('1\n2\npart')
+    follower = LogFollower(str(log), checkpoint_path=checkpoint, start_at_end=False)
+    assert read(follower) == ['1', '2']
+    asyncio.run(follower.save_checkpoint())
+    follower.close()
+
+    # После рестарта недочитанная строка читается целиком, прочитанные - не повторяются
+    append(log, 'ial\n3\n')
+    restarted = LogFollower(str(log), checkpoint_path=checkpoint)
+    assert read(restarted) == ['partial', '3']
+    restarted.close()
+
+
+def test_checkpoint_of_rotated_file_starts_new_file_from_beginning(tmp_path):
+    log = tmp_path / 'access.log'
+    checkpoint = str(tmp_path / 'access.log.offset')
+    log.write_text('1\n2\n')
+    follower = LogFollower(str(log), checkpoint_path=checkpoint, start_at_end=False)
+    assert read(follower) == ['1', '2']
+    asyncio.run(follower.save_checkpoint())
+    follower.close()
+
+    # Ротация, пока сервис был остановлен
+    os.rename(log, tmp_path / 'access.log.1')
+    log.write_text('3\n')
+    restarted = LogFollower(str(log), checkpoint_path=checkpoint)
+    assert read(restarted) == ['3']
+    restarted.close()
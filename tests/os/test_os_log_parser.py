@@ -0,0 +1,36 @@
+from datetime import datetime
+
+from log_parser import AccessLogParser
+
+TLS = '{"version":"TLS 1.3","ciphers":["TLS_AES_128_GCM_SHA256"]}'
+TCP = '{"ttl":64,"window_size":65535}'
+STAMP = '2024/01/31 12:00:00.123456'
+
+# Одно подключение в формате xRay и в старом формате, который разбирает регулярка
+FAST = f'{STAMP} from tcp:10.0.0.1:5678 accepted tcp:example.com:443 [in >> direct] email: u1@vpn tls:{TLS} tcp:{TCP}'
+LEGACY = f'{STAMP} 10.0.0.1:5678 user:[u1@vpn] tls:{TLS} tcp:{TCP}'
+
+
+def test_fast_path_and_regex_fallback_agree():
+    parser = AccessLogParser()
+    fast, legacy = parser.parse_lines([FAST, LEGACY])
+
+    assert fast == legacy
+    assert fast['ip'] == '10.0.0.1' and fast['port'] == '5678' and fast['user_id'] == 'u1@vpn'
+    assert fast['tcp'] == {'ttl': 64, 'window_size': 65535}
+    assert fast['timestamp'] == datetime(2024, 1, 31, 12, 0, 0, 123456)
+    assert parser.fallback_lines == 1
+    assert parser.parse_line(LEGACY) == fast
+
+
+def test_ipv6_source_and_noise_lines():
+    parser = AccessLogParser()
+    lines = [
+        FAST.replace('tcp:10.0.0.1:5678', '[2001:db8::1]:5678'),
+        f'{STAMP} from 10.0.0.2:1 rejected  proxy/vless: invalid request',
+        f'{STAMP} [Info] app/dns: UDP:1.1.1.1:53 got answer',
+        f'{STAMP} from 10.0.0.3:1 accepted tcp:example.com:443 [in >> direct]',
+    ]
+    parsed = parser.parse_lines(lines)
+    assert [(conn['ip'], conn['user_id']) for conn in parsed] == [('2001:db8::1', 'u1@vpn')]
+    assert parser.fallback_lines == 0
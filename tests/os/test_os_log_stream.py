@@ -0,0 +1,14 @@
+from log_stream import MAX_LINE, LogStream, _LineProtocol
+
+
+def test_oversized_line_is_dropped_up_to_newline():
+    stream = LogStream('unix:///tmp/unused.sock', prefilter=False)
+    protocol = _LineProtocol(stream)
+
+    protocol.data_received(b'first\n' + b'x' * (MAX_LINE + 1))
+    protocol.data_received(b'y' * 100)
+    protocol.data_received(b'tail of oversized\nsecond\n')
+    protocol.eof_received()
+
+    assert stream.stats['oversized'] == 1
+    assert list(stream._lines) == ['first', 'second']
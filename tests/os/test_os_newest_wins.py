@@ -0,0 +1,76 @@
+import asyncio
+import random
+from datetime import datetime
+
+from limit_engine import LimitEngine
+from common.loadgen import SyntheticDevice
+from system_os import DeviceManager
+
+
+class Clock:
+    def __init__(self, now: float = 1_700_000_000.0):
+        self.now = now
+
+    def __call__(self) -> float:
+        return self.now
+
+
+def connection(device: SyntheticDevice) -> dict:
+    return {
+        **device.connection(),
+        'user_id': 'u1',
+        'signature': hash((device.tls_blob, device.tcp_blob)),
+        'timestamp': datetime.now(),
+    }
+
+
+def make_engine(tmp_path, clock: Clock) -> LimitEngine:
+    manager = DeviceManager(str(tmp_path / 'devices.db'), newest_wins=True, clock=clock,
+                            displace_after=300)
+    return LimitEngine(manager)
+
+
+def two_ios_devices():
+    first = SyntheticDevice('ios', '10.0.0.1', random.Random(1))
+    second = SyntheticDevice('ios', '10.0.0.2', random.Random(2))
+    second.tcp['window_size'] = first.tcp['window_size'] + 1  # разные отпечатки
+    first.sni = second.sni = 'gateway.icloud.com'  # обе определяются как iOS
+    return first, second
+
+
+def run_tick(engine: LimitEngine, conns: list) -> list:
+    rejected = []
+    for user_id, conn_list in engine.apply_events({'u1': conns}).items():
+        _, user_rejected = asyncio.run(engine.evaluate(user_id, conn_list))
+        rejected.extend(reason for _, reason in user_rejected)
+    return rejected
+
+
+def test_two_active_devices_do_not_displace_each_other(tmp_path):
+    clock = Clock()
+    engine = make_engine(tmp_path, clock)
+    first, second = two_ios_devices()
+
+    reasons = []
+    for _ in range(6):
+        clock.now += 2
+        reasons += run_tick(engine, [connection(first), connection(second)])
+
+    assert reasons and all(reason == 'already_exists:ios' for reason in reasons)
+    devices = engine.device_manager.user_devices.devices('u1')
+    assert [record.ip for record in devices] == ['10.0.0.1']
+
+
+def test_idle_device_is_displaced_after_grace(tmp_path):
+    clock = Clock()
+    engine = make_engine(tmp_path, clock)
+    first, second = two_ios_devices()
+    assert run_tick(engine, [connection(first)]) == []
+
+    clock.now += 100
+    assert run_tick(engine, [connection(second)]) == ['already_exists:ios']
+
+    clock.now += 300
+    assert run_tick(engine, [connection(second)]) == ['displaced:ios']
+    devices = engine.device_manager.user_devices.devices('u1')
+    assert [record.ip for record in devices] == ['10.0.0.2']
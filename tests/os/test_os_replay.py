@@ -0,0 +1,35 @@
+import gzip
+
+from common.loadgen import SyntheticPopulation
+from replay import ReplayPolicy, order_logs, run_replay
+
+START = 1_700_000_000.0
+
+
+def write_logs(tmp_path) -> list:
+    """Старый лог сжат после ротации, текущий - нет"""
+    population = SyntheticPopulation(200, churn=0.05)
+    older, newer = [], []
+    for step in range(10):
+        population.step()
+        (older if step < 5 else newer).extend(population.log_lines(100, START + step * 5))
+    with gzip.open(tmp_path / 'access.log.1.gz', 'wt', encoding='utf-8') as f:
+        f.write('\n'.join(older) + '\n')
+    (tmp_path / 'access.log').write_text('\n'.join(newer) + '\n', encoding='utf-8')
+    return order_logs([str(tmp_path)])
+
+
+def test_sharded_replay_matches_single_process(tmp_path):
+    paths = write_logs(tmp_path)
+    assert [path.rsplit('/', 1)[1] for path in paths] == ['access.log.1.gz', 'access.log']
+    policies = [ReplayPolicy('current'), ReplayPolicy('newest_wins', newest_wins=True, displace_after=0)]
+
+    single = run_replay(paths, policies, workers=1)
+    sharded = run_replay(paths, policies, workers=2)
+
+    # Логи прочитаны один раз: строки не дублируются по шардам
+    assert single['lines'] == sharded['lines'] == 1000
+    assert single['connections'] == sharded['connections'] == 1000
+    assert sharded['policies'] == single['policies']
+    assert single['policies']['current']['rejected'] > 0
+    assert single['policies']['newest_wins']['displaced'] > 0
@@ -0,0 +1,27 @@
+import asyncio
+
+from limits import record_slot_purchase
+from sharding import LimiterShard, shard_of
+from tls_fingerprint import DeviceOS
+
+from test_os_state_restore import legacy_db
+
+
+def test_shard_restore_returns_views_for_restored_users(tmp_path):
+    path = legacy_db(tmp_path)
+    record_slot_purchase(path, 'u1', DeviceOS.IOS, 2)
+    index = shard_of('u1', 2)
+
+    async def restore():
+        shard = LimiterShard(index, 2, path)
+        stats = await shard.restore()
+        shard.device_manager.store.close()
+        return stats
+
+    views = asyncio.run(restore())['views']
+    rows, limits = views['u1']
+    assert [ip for _, ip, _, _ in rows] == ['10.0.0.1']
+    # Лимит по каждой ОС: купленные слоты и лимит по умолчанию
+    assert limits[DeviceOS.IOS] == 3
+    assert limits[DeviceOS.ANDROID] == 1
+    assert DeviceOS.UNKNOWN not in limits
@@ -0,0 +1,29 @@
+import asyncio
+import multiprocessing
+import pickle
+
+import pytest
+
+from sharding import ShardClient
+
+
+def test_failed_send_and_exited_shard_leave_no_pending_requests(tmp_path):
+    async def scenario():
+        client = ShardClient(0, 1, str(tmp_path / 'devices.db'), False, None,
+                             multiprocessing.get_context('spawn'))
+        try:
+            # Запрос не сериализуется - ответа не будет, в ожидающих он не остается
+            with pytest.raises((pickle.PicklingError, AttributeError, TypeError)):
+                await client.call('devices', lambda: None)
+            assert client._pending == {}
+
+            # Шард завершился: ожидающие и новые запросы получают ошибку, а не висят
+            client.process.kill()
+            client._reader.join(10)
+            with pytest.raises(RuntimeError, match='exited'):
+                await asyncio.wait_for(client.call('devices', 'u1'), 10)
+            assert client._pending == {}
+        finally:
+            client.close(1)
+
+    asyncio.run(scenario())
@@ -0,0 +1,39 @@
+import asyncio
+
+from common.device_registry import DeviceRegistry
+from sharding import LimiterShard, shard_of
+
+from test_os_state_restore import legacy_db
+
+
+def restore_shard(path: str, index: int, shards: int, save: bool = False) -> LimiterShard:
+    async def restore():
+        shard = LimiterShard(index, shards, path)
+        await shard.restore()
+        if save:
+            shard.device_manager.close()  # запись в БД и снимок шарда
+        else:
+            shard.device_manager.store.close()
+        return shard
+
+    return asyncio.run(restore())
+
+
+def test_shard_snapshot_is_filtered_and_keyed_by_shard_count(tmp_path):
+    path = legacy_db(tmp_path)  # u1 и u3 с читаемыми отпечатками
+    users = {'u1', 'u3'}
+
+    # Один шард: снимок со всеми пользователями
+    shard = restore_shard(path, 0, 1, save=True)
+    assert set(shard.device_manager.user_devices.users()) == users
+
+    # Из снимка шард берет только своих пользователей
+    registry = DeviceRegistry()
+    registry.load_snapshot(shard.device_manager.snapshot_path, lambda user_id: user_id == 'u1')
+    assert set(registry.users()) == {'u1'}
+
+    # При другом числе шардов каждый шард загружает ровно своих пользователей
+    for index in range(2):
+        shard = restore_shard(path, index, 2)
+        expected = {user_id for user_id in users if shard_of(user_id, 2) == index}
+        assert set(shard.device_manager.user_devices.users()) == expected
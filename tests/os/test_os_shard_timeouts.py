@@ -0,0 +1,8 @@
+from sharding import LimiterShard
+
+
+def test_shard_device_manager_gets_plan_idle_timeouts(tmp_path):
+    shard = LimiterShard(0, 2, str(tmp_path / 'devices.db'), idle_timeouts={'premium': 86400})
+    expiry = shard.device_manager.expiry
+    expiry.set_plan('u1', 'premium')
+    assert expiry.timeout('u1') == 86400
@@ -0,0 +1,135 @@
+import asyncio
+import random
+from datetime import datetime
+
+from common.loadgen import SyntheticDevice
+from tls_fingerprint import DeviceOS
+from xray_scan import XRayOSLimiter
+
+NAT_IP = '1.2.3.4'
+
+
+class QuietLimiter(XRayOSLimiter):
+    """Лимитер без бота: уведомления и статистика не нужны"""
+
+    async def notify_user_blocked(self, user_id: str, connection: dict, reason: str):
+        pass
+
+    async def update_user_stats(self, user_id: str, os_devices: dict):
+        pass
+
+
+def make_limiter(tmp_path, **kwargs) -> QuietLimiter:
+    return QuietLimiter('config.json', None, db_path=str(tmp_path / 'devices.db'),
+                        access_log=str(tmp_path / 'access.log'),
+                        log_checkpoint=str(tmp_path / 'access.log.offset'), **kwargs)
+
+
+def device(os_name: str, seed: int, ip: str = NAT_IP) -> SyntheticDevice:
+    synthetic = SyntheticDevice(os_name, ip, random.Random(seed))
+    synthetic.tcp['window_size'] += seed  # разные отпечатки
+    synthetic.sni = {'ios': 'gateway.icloud.com', 'android': 'android.googleapis.com'}[os_name]
+    return synthetic
+
+
+def connection(synthetic: SyntheticDevice) -> dict:
+    return {
+        **synthetic.connection(),
+        'user_id': 'u1',
+        'signature': hash((synthetic.tls_blob, synthetic.tcp_blob, synthetic.tcp['window_size'])),
+        'timestamp': datetime.now(),
+    }
+
+
+async def run_tick(limiter: XRayOSLimiter, devices: list) -> list:
+    """decide + enforce одного тика без чтения лога"""
+    reasons = []
+    for user_id, conns in limiter.engine.apply_events({'u1': [connection(d) for d in devices]}).items():
+        os_devices, rejected = await limiter.engine.evaluate(user_id, conns)
+        await limiter.enforce_user(user_id, rejected, os_devices)
+        reasons.extend(reason for _, reason in rejected)
+    return reasons
+
+
+def test_rejected_device_keeps_shared_ip_blocked(tmp_path):
+    async def scenario():
+        limiter = make_limiter(tmp_path)
+        admitted, rejected = device('ios', 1), device('ios', 2)
+
+        # Тик 0: второй iOS за тем же IP отклонен - его блокировку не снимает допущенный
+        assert await run_tick(limiter, [admitted, rejected]) == ['already_exists:ios']
+        assert limiter.routing.is_blocked('u1', NAT_IP)
+
+        # Тики 1 и 2: допущенное устройство переподключается - блокировка остается
+        for _ in range(2):
+            assert await run_tick(limiter, [admitted]) == []
+            assert limiter.routing.is_blocked('u1', NAT_IP)
+        await limiter.close()
+
+    asyncio.run(scenario())
+
+
+def test_admitted_device_unblocks_ip_without_other_blocked_devices(tmp_path):
+    async def scenario():
+        limiter = make_limiter(tmp_path)
+        first, second = device('ios', 1, '10.0.0.1'), device('ios', 2, '10.0.0.2')
+        assert await run_tick(limiter, [first, second]) == ['already_exists:ios']
+        assert limiter.routing.blocked_ips('u1') == frozenset({'10.0.0.2'})
+
+        # Слот освободился: второе устройство допущено, его IP больше ничего не держит
+        limiter.device_manager.limits.set('u1', DeviceOS.IOS, 2)
+        limiter.engine.connection_state.invalidate('u1')
+        assert await run_tick(limiter, [second]) == []
+        assert not limiter.routing.is_blocked('u1', '10.0.0.2')
+        await limiter.close()
+
+    asyncio.run(scenario())
+
+
+def test_refresh_limits_keeps_ip_of_other_os_blocked(tmp_path):
+    async def scenario():
+        limiter = make_limiter(tmp_path)
+        devices = [device('ios', 1), device('ios', 2), device('android', 3), device('android', 4)]
+        assert sorted(await run_tick(limiter, devices)) == ['already_exists:android', 'already_exists:ios']
+
+        # Слот куплен для iOS: за IP остается отклоненный Android
+        await limiter.refresh_limits('u1', DeviceOS.IOS)
+        assert limiter.routing.is_blocked('u1', NAT_IP)
+
+        await limiter.refresh_limits('u1', DeviceOS.ANDROID)
+        assert not limiter.routing.is_blocked('u1', NAT_IP)
+        await limiter.close()
+
+    asyncio.run(scenario())
+
+
+def displacing_limiter(tmp_path) -> QuietLimiter:
+    limiter = make_limiter(tmp_path, newest_wins=True)
+    limiter.device_manager.displace_after = 0  # старое устройство вытесняется сразу
+    return limiter
+
+
+def test_displaced_device_behind_same_ip_is_not_blocked(tmp_path):
+    async def scenario():
+        limiter = displacing_limiter(tmp_path)
+        assert await run_tick(limiter, [device('ios', 1)]) == []
+
+        # Новое устройство за тем же NAT вытесняет старое - блокировка IP отключила бы и его
+        assert await run_tick(limiter, [device('ios', 2)]) == ['displaced:ios']
+        assert not limiter.routing.is_blocked('u1', NAT_IP)
+        assert len(limiter.device_manager.user_devices.devices('u1')) == 1
+        await limiter.close()
+
+    asyncio.run(scenario())
+
+
+def test_displaced_device_behind_other_ip_is_blocked(tmp_path):
+    async def scenario():
+        limiter = displacing_limiter(tmp_path)
+        assert await run_tick(limiter, [device('ios', 1, '10.0.0.1')]) == []
+
+        assert await run_tick(limiter, [device('ios', 2, '10.0.0.2')]) == ['displaced:ios']
+        assert limiter.routing.blocked_ips('u1') == frozenset({'10.0.0.1'})
+        await limiter.close()
+
+    asyncio.run(scenario())
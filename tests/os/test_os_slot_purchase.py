@@ -0,0 +1,49 @@
+import asyncio
+import sqlite3
+
+from tls_fingerprint import DeviceOS
+
+from test_os_shared_ip_blocks import device, make_limiter, run_tick
+
+
+def plan_db(tmp_path, device_limit: int):
+    """Общая с панелью таблица users: лимит тарифа на каждую ОС"""
+    conn = sqlite3.connect(str(tmp_path / 'devices.db'))
+    conn.execute("CREATE TABLE users (id INTEGER PRIMARY KEY, uuid VARCHAR(36) UNIQUE, device_limit INTEGER)")
+    conn.execute("INSERT INTO users (uuid, device_limit) VALUES ('u1', ?)", (device_limit,))
+    conn.commit()
+    conn.close()
+
+
+def test_plan_limit_and_purchase_apply_immediately(tmp_path):
+    async def scenario():
+        plan_db(tmp_path, 2)
+        limiter = make_limiter(tmp_path)
+        limits = limiter.device_manager.limits
+        await limits.load()
+        assert limits.get('u1', DeviceOS.IOS) == 2
+        assert limits.get('u2', DeviceOS.IOS) == 1
+
+        phones = [device('ios', seed, f'10.0.0.{seed}') for seed in (1, 2, 3)]
+        assert await run_tick(limiter, phones) == ['already_exists:ios']
+
+        # Покупка добавляет слот к лимиту тарифа, проверка видит его без рестарта
+        await limiter.add_os_slots('u1', DeviceOS.IOS)
+        assert limits.get('u1', DeviceOS.IOS) == 3
+        assert limits.get('u1', DeviceOS.ANDROID) == 2
+        assert not limiter.routing.is_blocked('u1', '10.0.0.3')
+        assert await run_tick(limiter, phones) == []
+        assert len(limiter.device_manager.user_devices.devices('u1')) == 3
+
+        # Тариф повысили после покупки - купленные слоты его не уменьшают
+        conn = sqlite3.connect(str(tmp_path / 'devices.db'))
+        with conn:
+            conn.execute("UPDATE users SET device_limit = 5 WHERE uuid = 'u1'")
+        conn.close()
+        await limiter.refresh_limits('u1')
+        assert limits.get('u1', DeviceOS.IOS) == 5
+        await limiter.add_os_slots('u1', DeviceOS.IOS)
+        assert limits.get('u1', DeviceOS.IOS) == 6
+        await limiter.close()
+
+    asyncio.run(scenario())
@@ -0,0 +1,78 @@
+import asyncio
+import sqlite3
+
+from common.device_registry import DeviceRegistry
+from state_loader import load_devices
+from system_os import DeviceManager
+from tls_fingerprint import OS_CODES, DeviceOS
+
+# Схема до компактных отпечатков: hex VARCHAR(64) и одно устройство на ОС
+LEGACY_SCHEMA = """
+CREATE TABLE user_devices (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    user_id VARCHAR(36) NOT NULL,
+    os_type VARCHAR(20) NOT NULL,
+    device_fingerprint VARCHAR(64) UNIQUE,
+    ip_address VARCHAR(45),
+    tls_signature TEXT,
+    tcp_signature TEXT,
+    first_seen TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+    last_seen TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+    is_active BOOLEAN DEFAULT TRUE,
+    is_blocked BOOLEAN DEFAULT FALSE,
+    UNIQUE(user_id, os_type)
+);
+"""
+
+LEGACY_FP = 'ab' * 32
+
+
+def legacy_db(tmp_path) -> str:
+    path = str(tmp_path / 'legacy.db')
+    conn = sqlite3.connect(path)
+    conn.executescript(LEGACY_SCHEMA)
+    rows = [
+        ('u1', 'ios', LEGACY_FP, '10.0.0.1'),
+        ('u1', 'android', 'not-hex', '10.0.0.2'),
+        ('u2', 'ios', None, '10.0.0.3'),
+        ('u3', 'windows', bytes(range(16)), '10.0.0.4'),
+    ]
+    conn.executemany(
+        "INSERT INTO user_devices (user_id, os_type, device_fingerprint, ip_address) VALUES (?, ?, ?, ?)",
+        rows
+    )
+    conn.commit()
+    conn.close()
+    return path
+
+
+def test_load_devices_converts_hex_and_skips_unreadable(tmp_path):
+    registry = DeviceRegistry()
+    assert load_devices(legacy_db(tmp_path), registry) == 2
+
+    record = registry.get('u1', bytes.fromhex(LEGACY_FP))
+    assert record is not None
+    assert record.os_code == OS_CODES[DeviceOS.IOS]
+    assert registry.count('u1') == 1
+    assert 'u2' not in registry
+    assert registry.get('u3', bytes(range(16))) is not None
+
+
+def test_device_manager_restores_and_migrates_legacy_db(tmp_path):
+    path = legacy_db(tmp_path)
+
+    async def restore():
+        manager = DeviceManager(path)
+        stats = await manager.restore()
+        manager.store.close()
+        return manager, stats
+
+    manager, stats = asyncio.run(restore())
+    assert stats['devices'] == 2
+
+    # Миграция сняла UNIQUE(user_id, os_type), строки перенесены как есть
+    conn = sqlite3.connect(path)
+    schema = conn.execute("SELECT sql FROM sqlite_master WHERE name = 'user_devices'").fetchone()[0]
+    assert 'UNIQUE(user_id, os_type)' not in ' '.join(schema.split())
+    assert conn.execute("SELECT COUNT(*) FROM user_devices").fetchone()[0] == 4
+    conn.close()
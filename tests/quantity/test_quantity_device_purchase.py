@@ -0,0 +1,49 @@
+import asyncio
+import sqlite3
+
+from sctatic_xray_api import DeviceLimiter
+
+from test_quantity_state_restore import SCHEMA
+
+
+class StaticLimiter(DeviceLimiter):
+    """Подключения задает тест вместо опроса xRay; превышения запоминаются"""
+
+    def __init__(self, **kwargs):
+        super().__init__(**kwargs)
+        self.connections = {}
+        self.exceeded = []
+
+    async def get_xray_stats(self):
+        return self.connections
+
+    async def handle_limit_exceeded(self, user_id, devices, limit):
+        self.exceeded.append((user_id, len(devices), limit))
+
+
+def test_purchase_raises_limit_without_restart(tmp_path):
+    async def scenario():
+        path = str(tmp_path / 'devices.db')
+        conn = sqlite3.connect(path)
+        conn.executescript(SCHEMA)
+        conn.execute("CREATE TABLE purchases (id INTEGER PRIMARY KEY, user_id INTEGER, device_slots INTEGER)")
+        conn.execute("INSERT INTO users (id, uuid, device_limit) VALUES (1, 'u1', 1)")
+        conn.commit()
+
+        limiter = StaticLimiter(db_path=path)
+        await limiter.device_limits.load()
+        limiter.connections = {'u1': [{'ip': '10.0.0.1'}, {'ip': '10.0.0.2'}]}
+        await limiter.tick()
+        assert limiter.exceeded == [('u1', 2, 1)]
+
+        # Покупка записана (как Database.add_purchase) - новый лимит на следующем же опросе
+        with conn:
+            conn.execute("INSERT INTO purchases (user_id, device_slots) VALUES (1, 1)")
+        conn.close()
+        assert await limiter.refresh_limit('u1') == 2
+        await limiter.tick()
+        assert limiter.exceeded == [('u1', 2, 1)]
+        assert 'u1' in limiter.users_at_limit
+        await limiter.close()
+
+    asyncio.run(scenario())
@@ -0,0 +1,56 @@
+import asyncio
+
+from firewall import NftablesFirewall
+
+
+def test_batch_script_touches_before_delete_and_add():
+    firewall = NftablesFirewall(dry_run=True)
+    script = firewall.batch_script({'10.0.0.1': 60, '2001:db8::1': 30}, ['10.0.0.2'])
+    assert script == (
+        "add element inet vpn_limiter blocked4 { 10.0.0.1 . 443, 10.0.0.2 . 443 }\n"
+        "delete element inet vpn_limiter blocked4 { 10.0.0.1 . 443, 10.0.0.2 . 443 }\n"
+        "add element inet vpn_limiter blocked4 { 10.0.0.1 . 443 timeout 60s }\n"
+        "add element inet vpn_limiter blocked6 { 2001:db8::1 . 443 }\n"
+        "delete element inet vpn_limiter blocked6 { 2001:db8::1 . 443 }\n"
+        "add element inet vpn_limiter blocked6 { 2001:db8::1 . 443 timeout 30s }\n"
+    )
+    assert firewall.batch_script({}, []) == ''
+
+
+def test_sync_prints_one_transaction_per_tick(capsys):
+    async def scenario():
+        firewall = NftablesFirewall(ttl=60, dry_run=True)
+        assert firewall.block('u1', '10.0.0.1')
+        assert not firewall.block('u1', 'not-an-ip')
+        assert firewall.pending == 1
+        assert await firewall.sync() == 1
+        assert await firewall.sync() == 0  # без изменений скрипт не отправляется
+        return firewall
+
+    firewall = asyncio.run(scenario())
+    out = capsys.readouterr().out
+    assert out.count('timeout 60s') == 1
+    assert out.endswith(firewall.last_script)
+    assert firewall.pending == 0
+
+
+def test_shared_ip_is_removed_when_last_owner_unblocks(capsys):
+    async def scenario():
+        firewall = NftablesFirewall(dry_run=True)
+        firewall.block('u1', '10.0.0.1')
+        firewall.block('u2', '10.0.0.1')
+        await firewall.sync()
+
+        # Элемент NAT адреса держит второй пользователь - ядро не трогаем
+        firewall.unblock('u1', '10.0.0.1')
+        firewall.last_script = ''
+        assert await firewall.sync() == 0
+        assert firewall.last_script == ''
+
+        firewall.unblock('u2', '10.0.0.1')
+        assert await firewall.sync() == 1
+        return firewall.last_script
+
+    script = asyncio.run(scenario())
+    assert 'delete element inet vpn_limiter blocked4 { 10.0.0.1 . 443 }' in script
+    assert 'timeout' not in script
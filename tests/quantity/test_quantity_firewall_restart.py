@@ -0,0 +1,52 @@
+import asyncio
+import sqlite3
+
+from firewall import NftablesFirewall
+from sctatic_xray_api import DeviceLimiter
+
+from test_quantity_state_restore import SCHEMA
+
+
+def blocked_db(tmp_path) -> str:
+    path = str(tmp_path / 'devices.db')
+    conn = sqlite3.connect(path)
+    conn.executescript(SCHEMA)
+    conn.execute("INSERT INTO users (id, uuid) VALUES (1, 'u1')")
+    conn.executemany(
+        "INSERT INTO devices (user_id, ip_address, is_blocked) VALUES (1, ?, ?)",
+        [('10.0.0.1', 0), ('10.0.0.2', 1)]
+    )
+    conn.commit()
+    conn.close()
+    return path
+
+
+def test_restart_seeds_blocks_from_db_before_flush(tmp_path):
+    async def start():
+        firewall = NftablesFirewall(dry_run=True)
+        limiter = DeviceLimiter(db_path=blocked_db(tmp_path), firewall=firewall)
+        restored = await limiter.restore_blocks()
+        stats = await firewall.reconcile(flush=restored)
+        await limiter.close()
+        return firewall, stats
+
+    firewall, stats = asyncio.run(start())
+    assert firewall.blocked_ips('u1') == frozenset({'10.0.0.2'})
+    assert stats['flushed'] and stats['elements'] == 1
+    script = firewall.last_script
+    assert 'flush set' in script
+    assert '10.0.0.2 . 443 timeout' in script
+
+
+def test_cold_start_keeps_previous_blocks(tmp_path):
+    async def start():
+        firewall = NftablesFirewall(dry_run=True)
+        limiter = DeviceLimiter(firewall=firewall)
+        restored = await limiter.restore_blocks()
+        stats = await firewall.reconcile(flush=restored)
+        await limiter.close()
+        return firewall, stats
+
+    firewall, stats = asyncio.run(start())
+    assert not stats['flushed']
+    assert 'flush set' not in firewall.last_script
@@ -0,0 +1,14 @@
+import os
+
+import limits
+from common import routing_rules
+import sctatic_xray_api
+
+from conftest import COMMON_DIR, VARIANT_DIRS
+
+
+def test_variant_modules_use_common_copies():
+    assert os.path.dirname(routing_rules.__file__) == COMMON_DIR
+    # limits.py есть в обоих вариантах - должен подхватиться свой
+    assert os.path.dirname(limits.__file__) == VARIANT_DIRS['quantity']
+    assert sctatic_xray_api.DeviceLimiter
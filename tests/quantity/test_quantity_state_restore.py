@@ -0,0 +1,35 @@
+import sqlite3
+
+from common.device_registry import DeviceRegistry
+from state_loader import load_devices
+
+SCHEMA = """
+CREATE TABLE users (id INTEGER PRIMARY KEY, uuid VARCHAR(36) UNIQUE, device_limit INTEGER DEFAULT 1);
+CREATE TABLE devices (
+    id INTEGER PRIMARY KEY,
+    user_id INTEGER REFERENCES users(id),
+    fingerprint VARCHAR(64),
+    ip_address VARCHAR(45),
+    first_seen TIMESTAMP,
+    last_seen TIMESTAMP,
+    is_blocked BOOLEAN DEFAULT FALSE
+);
+"""
+
+
+def test_load_devices_reads_legacy_hex_fingerprints(tmp_path):
+    path = str(tmp_path / 'legacy.db')
+    conn = sqlite3.connect(path)
+    conn.executescript(SCHEMA)
+    conn.execute("INSERT INTO users (id, uuid) VALUES (1, 'u1')")
+    conn.executemany(
+        "INSERT INTO devices (user_id, fingerprint, ip_address) VALUES (1, ?, ?)",
+        [('cd' * 32, '10.0.0.1'), ('zz', '10.0.0.2'), (bytes(16), '10.0.0.3')]
+    )
+    conn.commit()
+    conn.close()
+
+    registry = DeviceRegistry()
+    assert load_devices(path, registry) == 2
+    assert registry.get('u1', bytes.fromhex('cd' * 32)).ip == '10.0.0.1'
+    assert registry.get('u1', bytes(16)).ip == '10.0.0.3'
@@ -0,0 +1,81 @@
+import asyncio
+
+import grpc
+import pytest
+
+from fake_stats_server import FakeStatsService, start_server
+from stats_client import (
+    StatsClient, decode_get_request, decode_ip_list, decode_names, decode_query_request, decode_stats,
+    encode_get_request, encode_ip_list, encode_names, encode_query_request, encode_stats
+)
+
+UPLINK = 'user>>>a@vpn>>>traffic>>>uplink'
+DOWNLINK = 'user>>>a@vpn>>>traffic>>>downlink'
+
+
+def test_codec_round_trip():
+    patterns = ['user>>>a@vpn>>>', 'user>>>б@vpn>>>']
+    assert decode_query_request(encode_query_request(patterns, True)) == (patterns, True)
+    assert decode_query_request(encode_query_request(patterns)) == (patterns, False)
+    assert decode_get_request(encode_get_request('user>>>a@vpn>>>online')) == ('user>>>a@vpn>>>online', False)
+
+    # 0 не кодируется (значение по умолчанию), большие значения - многобайтный varint
+    stats = {UPLINK: 0, DOWNLINK: (1 << 40) + 5}
+    assert dict(decode_stats(encode_stats(stats.items()))) == stats
+
+    ips = {'10.0.0.1': 1_700_000_000, '10.0.0.2': 0}
+    assert decode_ip_list(encode_ip_list('user>>>a@vpn>>>online', ips)) == ips
+    assert decode_names(encode_names(['x', 'y'])) == ['x', 'y']
+
+
+def test_deltas_without_reset_and_counter_drop():
+    async def scenario():
+        service = FakeStatsService()
+        server = await start_server(service)
+        client = StatsClient(f'localhost:{server.port}')
+        try:
+            service.add_traffic('a@vpn', 100, 1000)
+            assert await client.poll_user_traffic() == {'a@vpn': [100, 1000]}
+
+            service.add_traffic('a@vpn', 10, 20)
+            assert await client.poll_user_traffic() == {'a@vpn': [10, 20]}
+            # Без сброса счетчики xRay остаются для других потребителей
+            assert service.counters == {UPLINK: 110, DOWNLINK: 1020}
+
+            # Счетчик упал (xRay перезапускался) - приращение равно новому значению
+            service.counters.update({UPLINK: 7, DOWNLINK: 3})
+            assert await client.poll_user_traffic() == {'a@vpn': [7, 3]}
+            assert await client.poll_user_traffic() == {'a@vpn': [0, 0]}
+        finally:
+            await client.close()
+            await server.stop(None)
+
+    asyncio.run(scenario())
+
+
+def test_reconnects_after_server_restart():
+    async def scenario():
+        service = FakeStatsService()
+        service.add_traffic('a@vpn', 1, 2)
+        server = await start_server(service)
+        port = server.port
+        client = StatsClient(f'localhost:{port}', timeout=1.0)
+        try:
+            assert await client.poll_user_traffic() == {'a@vpn': [1, 2]}
+
+            # xRay недоступен: канал пересоздается, повторный вызов тоже падает
+            await server.stop(None)
+            with pytest.raises(grpc.aio.AioRpcError) as error:
+                await client.poll_user_traffic()
+            assert error.value.code() in (grpc.StatusCode.UNAVAILABLE, grpc.StatusCode.DEADLINE_EXCEEDED)
+            assert client.stats['reconnects'] == 1
+
+            # xRay снова поднялся на том же порту - опрос идет по новому каналу
+            server = await start_server(service, f'localhost:{port}')
+            service.add_traffic('a@vpn', 5, 5)
+            assert await client.poll_user_traffic() == {'a@vpn': [5, 5]}
+        finally:
+            await client.close()
+            await server.stop(None)
+
+    asyncio.run(scenario())
@@ -0,0 +1,44 @@
+from common.device_registry import DeviceRecord, DeviceRegistry
+
+FP1, FP2 = b'\x01' * 16, b'\x02' * 16
+NOW = 1_700_000_000
+LAST_32BIT_SECOND = (1 << 32) - 1  # 2106-02-07 - предел упакованного времени
+
+
+def test_times_are_packed_into_one_int():
+    record = DeviceRecord(FP1, '10.0.0.1', 1, NOW, NOW + 5)
+    assert (record.first_seen, record.last_seen) == (NOW, NOW + 5)
+
+    record.touch(NOW + 60)
+    assert (record.first_seen, record.last_seen) == (NOW, NOW + 60)
+
+    edge = DeviceRecord(FP1, '10.0.0.1', 1, LAST_32BIT_SECOND, LAST_32BIT_SECOND)
+    edge.touch(LAST_32BIT_SECOND)
+    assert (edge.first_seen, edge.last_seen) == (LAST_32BIT_SECOND, LAST_32BIT_SECOND)
+    assert DeviceRecord(FP1, '10.0.0.1', 1, 0, 0).last_seen == 0
+
+
+def test_upsert_touches_known_device_and_keeps_first_seen():
+    registry = DeviceRegistry()
+    record, created = registry.upsert('u1', FP1, '10.0.0.1', os_code=2, now=NOW)
+    assert created
+    same, created = registry.upsert('u1', FP1, '10.0.0.9', now=NOW + 30)
+    assert not created and same is record
+    assert (record.first_seen, record.last_seen, record.ip, record.os_code) == (NOW, NOW + 30, '10.0.0.9', 2)
+
+
+def test_snapshot_keeps_packed_times_and_blocked_flag(tmp_path):
+    registry = DeviceRegistry()
+    registry.upsert('u1', FP1, '10.0.0.1', os_code=1, now=NOW)
+    registry.upsert('u1', FP1, '10.0.0.1', now=NOW + 100)
+    blocked, _ = registry.upsert('u2', FP2, '10.0.0.2', os_code=3, now=NOW + 7)
+    blocked.blocked = True
+    path = str(tmp_path / 'devices.snapshot')
+    registry.save_snapshot(path)
+
+    restored = DeviceRegistry()
+    assert restored.load_snapshot(path, user_filter=lambda user_id: user_id == 'u1') == 1
+    assert restored.load_snapshot(path, user_filter=lambda user_id: user_id == 'u2') == 1
+    first, second = restored.get('u1', FP1), restored.get('u2', FP2)
+    assert (first.first_seen, first.last_seen, first.blocked) == (NOW, NOW + 100, False)
+    assert (second.first_seen, second.last_seen, second.os_code, second.blocked) == (NOW + 7, NOW + 7, 3, True)
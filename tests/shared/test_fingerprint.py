@@ -0,0 +1,43 @@
+import os
+import subprocess
+import sys
+
+from common.fingerprint import DIGEST_SIZE, canonical, fingerprint, stored_fingerprint
+
+ROOT = os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+# Отпечаток с ключом по умолчанию: смена формата полей или ключа ломает совпадение с БД
+GOLDEN = '23731d14076dda6a74c54445f0f72240'
+GOLDEN_SCRIPT = (
+    "from common.fingerprint import canonical, fingerprint;"
+    "print(fingerprint(('10.0.0.1', None, canonical({'b': [1, 2], 'a': 'x'}))).hex())"
+)
+
+
+def test_canonical_ignores_dict_order_and_sequence_type():
+    assert canonical({'b': [1, {'y': 2, 'x': 1}], 'a': 'x'}) == canonical({'a': 'x', 'b': (1, {'x': 1, 'y': 2})})
+    assert fingerprint(canonical({'a': 1, 'b': 2})) == fingerprint(canonical({'b': 2, 'a': 1}))
+    assert fingerprint(('10.0.0.1',)) != fingerprint(('10.0.0.2',))
+    assert len(fingerprint(('10.0.0.1',))) == DIGEST_SIZE
+
+
+def test_fingerprint_is_stable_across_processes():
+    # Другой PYTHONHASHSEED и новый процесс - тот же отпечаток, что и при прошлых запусках
+    env = {key: value for key, value in os.environ.items() if key != 'DEVICE_FINGERPRINT_KEY'}
+    for seed in ('1', '2'):
+        output = subprocess.run(
+            [sys.executable, '-c', GOLDEN_SCRIPT], cwd=ROOT, capture_output=True, text=True, check=True,
+            env={**env, 'PYTHONHASHSEED': seed}
+        ).stdout.strip()
+        assert output == GOLDEN
+
+
+def test_stored_fingerprint_reads_blob_and_legacy_hex():
+    fp = fingerprint(('10.0.0.1',))
+    assert stored_fingerprint(fp) == fp
+    assert stored_fingerprint(memoryview(fp)) == fp
+    # Старые базы: hex-строка в VARCHAR(64)
+    assert stored_fingerprint(fp.hex()) == fp
+    assert stored_fingerprint('cd' * 32) == bytes.fromhex('cd' * 32)
+    assert stored_fingerprint('zz') is None
+    assert stored_fingerprint(None) is None
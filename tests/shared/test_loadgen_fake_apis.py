@@ -0,0 +1,71 @@
+import asyncio
+
+from common.fake_apis import FakeTelegramAPI, FakeXRayAPI
+from common.http_client import HTTPClient
+from common.loadgen import SyntheticPopulation
+from common.routing_rules import RoutingRuleManager
+
+
+def test_population_is_deterministic_by_seed():
+    first = SyntheticPopulation(50, seed=7)
+    second = SyntheticPopulation(50, seed=7)
+    assert first.log_lines(20, now=0) == second.log_lines(20, now=0)
+    assert first.step() == second.step()
+    assert first.online_connections() == second.online_connections()
+
+    other = SyntheticPopulation(50, seed=8)
+    assert other.log_lines(20, now=0) != SyntheticPopulation(50, seed=7).log_lines(20, now=0)
+
+
+def test_churn_replaces_devices_with_new_addresses():
+    population = SyntheticPopulation(100, devices_per_user=(2, 2), churn=0.1, seed=1)
+    before = {device.ip for devices in population.devices.values() for device in devices}
+    assert population.step() == 20
+    after = {device.ip for devices in population.devices.values() for device in devices}
+    assert len(after - before) == 20
+    assert population.device_count == 200
+
+
+def test_fake_xray_applies_and_removes_batches():
+    async def scenario():
+        api = FakeXRayAPI()
+        url = await api.start()
+        async with HTTPClient() as client:
+            routing = RoutingRuleManager(
+                lambda batch: client.post_json(f'{url}/v1/routing/rules/batch', batch))
+            routing.block('u1', '10.0.0.1')
+            routing.block('u1', '10.0.0.2')
+            routing.block('u2', '10.0.0.3')
+            assert await routing.sync() == 2
+            assert api.batches == 1 and api.blocked_ips == 3
+            assert api.rules[routing.rule_tag('u1')]['source'] == ['10.0.0.1', '10.0.0.2']
+
+            # Снятие последнего IP удаляет правило по ruleTag
+            routing.unblock('u2', '10.0.0.3')
+            assert await routing.sync() == 1
+            assert set(api.rules) == {routing.rule_tag('u1')}
+            assert api.batches == 2
+        await api.close()
+
+    asyncio.run(scenario())
+
+
+def test_fake_telegram_floods_every_nth_request():
+    async def scenario():
+        api = FakeTelegramAPI(flood_every=3, retry_after=5)
+        url = await api.start()
+        async with HTTPClient() as client:
+            responses = [
+                await client.post_json(f'{url}/botTOKEN/sendMessage', {'chat_id': 42, 'text': 'hi'},
+                                       check_status=False)
+                for _ in range(6)
+            ]
+        await api.close()
+
+        assert [r['ok'] for r in responses] == [True, True, False, True, True, False]
+        assert responses[2]['error_code'] == 429
+        assert responses[2]['parameters'] == {'retry_after': 5}
+        assert api.flooded == 2
+        assert api.messages == {'42': 4} and api.sent == 4
+
+    asyncio.run(scenario())
@@ -0,0 +1,67 @@
+import asyncio
+
+from common.metrics import Counter, Gauge, Histogram, MetricsServer, Registry
+
+
+def test_render_counter_gauge_and_labels():
+    registry = Registry()
+    lines = Counter('lines_total', 'Строки', registry=registry)
+    errors = Counter('errors_total', 'Ошибки', ('loop',), registry=registry)
+    depth = Gauge('queue_depth', 'Глубина', ('queue',), registry=registry)
+    lines.inc(3)
+    errors.labels('mon"itor').inc()
+    depth.labels('outbox').set(2.5)
+    depth.labels('routing').set_function(lambda: 7)
+
+    assert registry.render() == (
+        '# HELP lines_total Строки\n'
+        '# TYPE lines_total counter\n'
+        'lines_total 3\n'
+        '# HELP errors_total Ошибки\n'
+        '# TYPE errors_total counter\n'
+        'errors_total{loop="mon\\"itor"} 1\n'
+        '# HELP queue_depth Глубина\n'
+        '# TYPE queue_depth gauge\n'
+        'queue_depth{queue="outbox"} 2.5\n'
+        'queue_depth{queue="routing"} 7\n'
+    )
+
+
+def test_histogram_buckets_are_cumulative_with_inclusive_le():
+    registry = Registry()
+    stage = Histogram('stage_seconds', 'Стадии', ('stage',), buckets=(0.5, 0.1), registry=registry)
+    parse = stage.labels('parse')
+    for value in (0.1, 0.2, 0.5, 3):  # на границе - в этом же бакете (le включительно)
+        parse.observe(value)
+
+    assert registry.render().splitlines()[2:] == [
+        'stage_seconds_bucket{stage="parse",le="0.1"} 1',
+        'stage_seconds_bucket{stage="parse",le="0.5"} 3',
+        'stage_seconds_bucket{stage="parse",le="+Inf"} 4',
+        'stage_seconds_sum{stage="parse"} 3.8',
+        'stage_seconds_count{stage="parse"} 4',
+    ]
+
+
+def test_server_serves_metrics_and_404():
+    async def scenario():
+        registry = Registry()
+        Counter('up_total', 'Проверка', registry=registry).inc()
+        server = MetricsServer(port=0, registry=registry)
+        await server.start()
+
+        async def get(path: str) -> bytes:
+            reader, writer = await asyncio.open_connection('127.0.0.1', server.port)
+            writer.write(f'GET {path} HTTP/1.1\r\nHost: x\r\n\r\n'.encode())
+            response = await reader.read()
+            writer.close()
+            return response
+
+        try:
+            ok = await get('/metrics?x=1')
+            assert ok.startswith(b'HTTP/1.1 200 OK') and ok.endswith(b'up_total 1\n')
+            assert (await get('/')).startswith(b'HTTP/1.1 404')
+        finally:
+            await server.close()
+
+    asyncio.run(scenario())
@@ -0,0 +1,89 @@
+import asyncio
+import time
+
+from common.notify_outbox import NotificationOutbox, RetryAfter
+
+
+class Sender:
+    """Запоминает отправки; первые failures вызовов отвечают flood control"""
+
+    def __init__(self, failures: int = 0, retry_after: float = 0.0):
+        self.failures = failures
+        self.retry_after = retry_after
+        self.sent = []
+
+    async def __call__(self, user_id, payload: dict):
+        if self.failures:
+            self.failures -= 1
+            raise RetryAfter(self.retry_after)
+        self.sent.append((user_id, payload['text'], time.monotonic()))
+
+
+def fast_outbox(send, **kwargs) -> NotificationOutbox:
+    return NotificationOutbox(send, global_rate=1000, per_chat_interval=0, **kwargs)
+
+
+async def drain(outbox: NotificationOutbox, sender: Sender, count: int, timeout: float = 2.0):
+    deadline = time.monotonic() + timeout
+    while len(sender.sent) < count and time.monotonic() < deadline:
+        await asyncio.sleep(0.005)
+
+
+def test_dedupe_and_cooldown():
+    async def scenario():
+        sender = Sender()
+        outbox = fast_outbox(sender, cooldown=0.2)
+        assert outbox.enqueue('u1', 'already_exists:ios', {'text': 'a'})
+        # Пока первое не ушло - схлопывается
+        assert not outbox.enqueue('u1', 'already_exists:ios', {'text': 'b'})
+        # Другая причина и другой пользователь - отдельные уведомления
+        assert outbox.enqueue('u1', 'already_exists:android', {'text': 'c'})
+        assert outbox.enqueue('u2', 'already_exists:ios', {'text': 'd'})
+        await drain(outbox, sender, 3)
+        assert sorted(text for _, text, _ in sender.sent) == ['a', 'c', 'd']
+
+        # Отправлено - повтор только после кулдауна
+        assert not outbox.enqueue('u1', 'already_exists:ios', {'text': 'e'})
+        await asyncio.sleep(0.25)
+        assert outbox.enqueue('u1', 'already_exists:ios', {'text': 'f'})
+        await drain(outbox, sender, 4)
+        assert sender.sent[-1][1] == 'f'
+        assert outbox.stats['deduped'] == 1 and outbox.stats['cooldown'] == 1
+        await outbox.close()
+
+    asyncio.run(scenario())
+
+
+def test_retry_after_pauses_whole_queue():
+    async def scenario():
+        sender = Sender(failures=1, retry_after=0.2)
+        outbox = fast_outbox(sender)
+        start = time.monotonic()
+        outbox.enqueue('u1', 'limit', {'text': 'a'})
+        await asyncio.sleep(0.05)
+        # Flood control касается всего бота: сообщение другого чата тоже ждет
+        outbox.enqueue('u2', 'limit', {'text': 'b'})
+        await drain(outbox, sender, 2)
+
+        assert sorted(text for _, text, _ in sender.sent) == ['a', 'b']
+        assert all(sent_at - start >= 0.2 for _, _, sent_at in sender.sent)
+        assert outbox.stats['retried'] == 1 and outbox.stats['sent'] == 2
+        await outbox.close()
+
+    asyncio.run(scenario())
+
+
+def test_gives_up_after_max_retries():
+    async def scenario():
+        sender = Sender(failures=10)
+        outbox = fast_outbox(sender, max_retries=2)
+        outbox.enqueue('u1', 'limit', {'text': 'a'})
+        deadline = time.monotonic() + 2
+        while outbox.stats['failed'] == 0 and time.monotonic() < deadline:
+            await asyncio.sleep(0.005)
+        assert outbox.stats == {**outbox.stats, 'retried': 2, 'failed': 1, 'sent': 0}
+        # Неотправленное не держит ключ: новое уведомление принимается
+        assert outbox.enqueue('u1', 'limit', {'text': 'b'})
+        await outbox.close()
+
+    asyncio.run(scenario())
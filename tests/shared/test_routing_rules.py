@@ -0,0 +1,51 @@
+import asyncio
+
+from common.routing_rules import RoutingRuleManager
+
+
+def run(coro):
+    return asyncio.run(coro)
+
+
+class Recorder:
+    def __init__(self):
+        self.batches = []
+
+    async def __call__(self, batch: dict):
+        self.batches.append(batch)
+        return {'ok': True}
+
+
+def test_sync_sends_one_rule_per_user():
+    apply = Recorder()
+    routing = RoutingRuleManager(apply)
+    routing.block('u1', '1.1.1.1')
+    routing.block('u1', '2.2.2.2')
+    routing.block('u2', '3.3.3.3')
+
+    assert run(routing.sync()) == 2
+    rules = {rule['ruleTag']: rule['source'] for rule in apply.batches[0]['rules']}
+    assert rules == {'block-u1': ['1.1.1.1', '2.2.2.2'], 'block-u2': ['3.3.3.3']}
+    assert routing.pending == 0
+
+
+def test_repeated_block_is_not_resent():
+    apply = Recorder()
+    routing = RoutingRuleManager(apply)
+    routing.block('u1', '1.1.1.1')
+    run(routing.sync())
+
+    assert routing.block('u1', '1.1.1.1') is False
+    assert run(routing.sync()) == 0
+    assert len(apply.batches) == 1
+
+
+def test_expired_block_removes_rule():
+    apply = Recorder()
+    routing = RoutingRuleManager(apply, ttl=10)
+    routing.block('u1', '1.1.1.1')
+    run(routing.sync())
+
+    assert routing.expire(now=10 ** 12) == 1
+    run(routing.sync())
+    assert apply.batches[-1] == {'rules': [], 'removeRuleTags': ['block-u1']}
@@ -0,0 +1,69 @@
+import asyncio
+
+import aiohttp
+import pytest
+from aiohttp import web
+
+from common.http_client import HTTPClient
+from common.routing_rules import RoutingRuleManager
+
+
+class FlakyXRay:
+    """routing batch API: первые failures запросов отвечают 500 с JSON ошибкой"""
+
+    def __init__(self, failures: int):
+        self.failures = failures
+        self.batches = []
+
+    async def handle(self, request: web.Request) -> web.Response:
+        batch = await request.json()
+        if self.failures > 0:
+            self.failures -= 1
+            return web.json_response({'error': 'internal'}, status=500)
+        self.batches.append(batch)
+        return web.json_response({'ok': True})
+
+
+async def serve(api: FlakyXRay):
+    app = web.Application()
+    app.router.add_post('/v1/routing/rules/batch', api.handle)
+    runner = web.AppRunner(app)
+    await runner.setup()
+    site = web.TCPSite(runner, '127.0.0.1', 0)
+    await site.start()
+    port = site._server.sockets[0].getsockname()[1]
+    return runner, f'http://127.0.0.1:{port}/v1/routing/rules/batch'
+
+
+def test_post_json_raises_on_error_status():
+    async def scenario():
+        runner, url = await serve(FlakyXRay(failures=1))
+        async with HTTPClient() as http:
+            with pytest.raises(aiohttp.ClientResponseError):
+                await http.post_json(url, {})
+            # Bot API сообщает об ошибках в теле - статус не проверяем
+            assert await http.post_json(url, {}, check_status=False) == {'ok': True}
+        await runner.cleanup()
+
+    asyncio.run(scenario())
+
+
+def test_failed_sync_keeps_user_pending_and_retries():
+    async def scenario():
+        api = FlakyXRay(failures=1)
+        runner, url = await serve(api)
+        async with HTTPClient() as http:
+            routing = RoutingRuleManager(lambda batch: http.post_json(url, batch))
+            routing.block('u1', '1.2.3.4')
+
+            with pytest.raises(aiohttp.ClientResponseError):
+                await routing.sync()
+            assert routing.pending == 1
+            assert routing._applied == {}
+
+            assert await routing.sync() == 1
+            assert routing.pending == 0
+            assert api.batches[0]['rules'][0]['source'] == ['1.2.3.4']
+        await runner.cleanup()
+
+    asyncio.run(scenario())